@@ -1,45 +1,145 @@
-from django.contrib import admin
+import uuid
 
-from .models import Author, Book, BookInstance, Genre, Language
+from django.contrib import admin, messages
+from django.http import HttpResponseRedirect
+
+from . import branches, copycodes, refdata
+from .forms import CONFLICT_MESSAGE, BookForm, VersionedModelForm
+from .models import (Author, Book, BookInstance, Branch, ConcurrentUpdateError, DeletionJob, DuplicateCandidate,
+                     Genre, Language)
 
 
 class BookInline(admin.TabularInline):
     model = Book
+    form = BookForm
     extra = 0
 
 
 class BookInstanceInline(admin.TabularInline):
+    """Copies of a book in the default database; copies in branch databases are listed on the copy admin"""
     model = BookInstance
+    form = VersionedModelForm
     extra = 0
+    verbose_name_plural = 'copies in the default database'
+
+
+class DatabaseListFilter(admin.SimpleListFilter):
+    """Switches the copy list between the databases holding copies, the default one first"""
+    title = 'database'
+    parameter_name = 'database'
+
+    def lookups(self, request, model_admin):
+        return [(database, database) for database in branches.databases()]
+
+    def has_output(self):
+        return len(self.lookup_choices) > 1
+
+    def choices(self, changelist):
+        # A queryset reads a single database, so there is no choice showing them all
+        selected = self.value() or branches.databases()[0]
+        for database, title in self.lookup_choices:
+            yield {
+                'selected': database == selected,
+                'query_string': changelist.get_query_string({self.parameter_name: database}),
+                'display': title,
+            }
+
+    def queryset(self, request, queryset):
+        if self.value() in branches.databases():
+            return queryset.using(self.value())
+        return queryset
+
+
+class VersionedModelAdmin(admin.ModelAdmin):
+    """Admin for versioned models that reports a record changed while it was being saved instead of failing"""
+    form = VersionedModelForm
+
+    def changeform_view(self, request, object_id=None, form_url='', extra_context=None):
+        # The record and its inlines are saved in one transaction, which a conflict rolls back as a whole
+        try:
+            return super().changeform_view(request, object_id, form_url, extra_context)
+        except ConcurrentUpdateError:
+            self.message_user(request, CONFLICT_MESSAGE + ' The latest values are shown below.', messages.ERROR)
+            return HttpResponseRedirect(request.get_full_path())
 
 
 @admin.register(Author)
-class AuthorAdmin(admin.ModelAdmin):
+class AuthorAdmin(VersionedModelAdmin):
     list_display = ('last_name', 'first_name', 'date_of_birth', 'date_of_death')
-    fields = ['first_name', 'last_name', ('date_of_birth', 'date_of_death')]
+    fields = ['first_name', 'last_name', ('date_of_birth', 'date_of_death'), 'loaded_version']
     inlines = [BookInline]
 
 
 @admin.register(Book)
-class BookAdmin(admin.ModelAdmin):
+class BookAdmin(VersionedModelAdmin):
     list_display = ('title', 'author', 'display_genre')
+    form = BookForm
     inlines = [BookInstanceInline]
 
+    def get_changelist_instance(self, request):
+        changelist = super().get_changelist_instance(request)
+        # Genres of the whole page in one query; the genres themselves come from the reference data cache
+        refdata.attach_genre_ids(changelist.result_list)
+        return changelist
+
 
 @admin.register(BookInstance)
-class BookInstanceAdmin(admin.ModelAdmin):
-    list_display = ('book', 'status', 'borrower', 'due_back', 'id')
-    list_filter = ('status', 'due_back')
+class BookInstanceAdmin(VersionedModelAdmin):
+    list_display = ('book', 'status', 'borrower', 'due_back', 'code')
+    list_filter = (DatabaseListFilter, 'status', 'due_back', 'branch')
+    search_fields = ('book__title', 'imprint')
+    readonly_fields = ('code',)
 
     fieldsets = (
         (None, {
-            'fields': ('book', 'imprint', 'id')
+            'fields': ('book', 'imprint', 'code', 'branch')
         }),
         ('Availability', {
-            'fields': ('status', 'due_back', 'borrower')
+            'fields': ('status', 'due_back', 'borrower', 'loaded_version')
         }),
     )
 
+    def get_object(self, request, object_id, from_field=None):
+        # The copy number records which database holds the copy
+        try:
+            database = branches.copy_database(int(object_id))
+        except ValueError:
+            return None
+        return self.get_queryset(request).using(database).filter(pk=object_id).first()
+
+    def get_search_results(self, request, queryset, search_term):
+        # Scanning a copy's barcode (or pasting an old copy UUID) into the search box finds the copy
+        results, use_distinct = super().get_search_results(request, queryset, search_term)
+        term = search_term.strip()
+        try:
+            results |= queryset.filter(pk=copycodes.decode(term))
+        except ValueError:
+            try:
+                results |= queryset.filter(uuid=uuid.UUID(term))
+            except ValueError:
+                pass
+        return results, use_distinct
+
+
+@admin.register(Branch)
+class BranchAdmin(admin.ModelAdmin):
+    list_display = ('name', 'slug', 'database')
+    prepopulated_fields = {'slug': ('name',)}
+
+
+@admin.register(DeletionJob)
+class DeletionJobAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'processed', 'total', 'created_at', 'finished_at')
+    list_filter = ('model', 'finished_at')
+    readonly_fields = ('model', 'object_id', 'object_repr', 'total', 'processed', 'created_at', 'finished_at')
+
+
+@admin.register(DuplicateCandidate)
+class DuplicateCandidateAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'status', 'found_at')
+    list_filter = ('model', 'status')
+    readonly_fields = ('model', 'first_id', 'second_id', 'score', 'found_at')
+
 
 admin.site.register(Genre)
 admin.site.register(Language)
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class CatalogConfig(AppConfig):
     name = 'catalog'
+
+    def ready(self):
+        # Connect signal handlers and register system checks
+        from . import checks, signals  # noqa: F401
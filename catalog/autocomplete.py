@@ -0,0 +1,58 @@
+"""Choice search behind the autocomplete widgets of the book form.
+
+Rendering every author or genre as an <option> does not scale, so the book
+form only renders the selected choices (see catalog.widgets) and the browser
+fetches the rest from the choices view as the librarian types. Matches are name
+prefixes in any case, searched as a range over an index on case-folded copies
+of the name columns, and pages are read with keyset pagination (rows after the
+last one shown), so every page costs the same however far the librarian scrolls.
+"""
+from django.db.models import Q
+
+from .models import Author, Genre
+
+PAGE_SIZE = 20
+
+# Model and indexed case-folded name columns of each choice list, in index order
+SOURCES = {
+    'author': (Author, ('last_name_folded', 'first_name_folded')),
+    'genre': (Genre, ('name_folded',)),
+}
+
+
+def prefix_filter(field, text):
+    """Matches values of a case-folded field starting with text, in any case, with an index range scan"""
+    prefix = text.casefold()
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return Q(**{f'{field}__gte': prefix, f'{field}__lt': upper})
+
+
+def after_filter(fields, row):
+    """Matches rows sorting after row, ordered by fields and then primary key"""
+    condition = Q(pk__gt=row['pk'], **{field: row[field] for field in fields})
+    for index in reversed(range(len(fields))):
+        equal = {field: row[field] for field in fields[:index]}
+        condition |= Q(**{f'{fields[index]}__gt': row[fields[index]]}, **equal)
+    return condition
+
+
+def search(source, term='', after=None, page_size=PAGE_SIZE):
+    """Returns (objects, more) for a page of choices matching term, after the object with pk after"""
+    model, fields = SOURCES[source]
+    queryset = model.objects.order_by(*fields, 'pk')
+
+    # 'Smith, Jo' searches the first name among authors called Smith
+    term = term.strip()
+    parts = [part.strip() for part in term.split(',', len(fields) - 1)] if term else []
+    for field, value in zip(fields, parts[:-1]):
+        queryset = queryset.filter(**{field: value.casefold()})
+    if parts and parts[-1]:
+        queryset = queryset.filter(prefix_filter(fields[len(parts) - 1], parts[-1]))
+
+    if after is not None:
+        row = model._base_manager.filter(pk=after).values('pk', *fields).first()
+        if row is not None:
+            queryset = queryset.filter(after_filter(fields, row))
+
+    objects = list(queryset[:page_size + 1])
+    return objects[:page_size], len(objects) > page_size
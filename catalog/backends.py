@@ -0,0 +1,72 @@
+"""Authentication backend caching each user's permissions in the shared cache.
+
+Django's ModelBackend only remembers permissions on the user object, so every
+request queries the user, group and permission tables again. This backend keeps
+the permission set in the shared cache between requests. Signal handlers in
+catalog.signals drop a user's entry when their permissions or groups change,
+and bump the namespace version when a group's permissions change. If the cache
+is unavailable, or kept by each worker for itself so that a revocation would not
+reach the others, permissions are loaded from the database as usual.
+"""
+import logging
+
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache
+
+from . import metrics
+from .caching import bump_version, get_version, is_shared
+
+CACHE_NAMESPACE = 'perms'
+
+logger = logging.getLogger(__name__)
+
+
+def permission_cache_key(user_id):
+    return f'{CACHE_NAMESPACE}:{get_version(CACHE_NAMESPACE)}:{user_id}'
+
+
+def forget_permissions(user_id):
+    """Drops the cached permissions of a user"""
+    try:
+        cache.delete(permission_cache_key(user_id))
+    except Exception:
+        logger.exception('Could not drop cached permissions of user %s', user_id)
+
+
+def forget_all_permissions():
+    """Drops the cached permissions of every user"""
+    try:
+        bump_version(CACHE_NAMESPACE)
+    except Exception:
+        logger.exception('Could not drop cached permissions')
+
+
+class CachedModelBackend(ModelBackend):
+    """ModelBackend that keeps each user's permission set in the shared cache"""
+
+    def get_all_permissions(self, user_obj, obj=None):
+        if not user_obj.is_active or user_obj.is_anonymous or obj is not None:
+            return set()
+        if not hasattr(user_obj, '_perm_cache'):
+            user_obj._perm_cache = self._get_cached_permissions(user_obj)
+        return user_obj._perm_cache
+
+    def _get_cached_permissions(self, user_obj):
+        if not is_shared():
+            return super().get_all_permissions(user_obj)
+        try:
+            key = permission_cache_key(user_obj.pk)
+            perms = cache.get(key)
+        except Exception:
+            logger.exception('Could not read cached permissions of user %s', user_obj.pk)
+            return super().get_all_permissions(user_obj)
+
+        metrics.cache_lookup('permissions', perms is not None)
+        if perms is None:
+            perms = super().get_all_permissions(user_obj)
+            try:
+                cache.set(key, perms, getattr(settings, 'PERMISSION_CACHE_TIMEOUT', 300))
+            except Exception:
+                logger.exception('Could not cache permissions of user %s', user_obj.pk)
+        return perms
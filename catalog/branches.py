@@ -0,0 +1,161 @@
+"""Branch-scoped circulation queries.
+
+Copies of different branches may be stored in different databases (see
+catalog.routers), and a query on copies without an explicit database only
+reads the default one. Questions spanning branches are therefore answered by
+querying each database holding copies separately, in parallel threads where
+that pays off.
+"""
+import datetime
+import heapq
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import Count, F
+
+from . import routers
+from .models import BookInstance, Branch, CopyNumber
+
+
+def databases():
+    """Returns the aliases of the databases holding copies, the default database first"""
+    branch_databases = set(routers.branch_databases().values()) - {DEFAULT_DB_ALIAS}
+    return [DEFAULT_DB_ALIAS, *sorted(branch_databases)]
+
+
+def fan_out(queryset):
+    """Returns the queryset on copies run against each database holding copies"""
+    return [queryset.using(database) for database in databases()]
+
+
+def due_back_order(copy):
+    """Sort key listing copies by due date, as BookInstance's ordering does, whichever database they come from"""
+    return copy.due_back is not None, copy.due_back or datetime.date.min, copy.pk
+
+
+# The order of due_back_order in SQL, so the copies read from each database can be merged
+DUE_BACK_ORDERING = (F('due_back').asc(nulls_first=True), 'pk')
+
+
+class MergedCopies:
+    """Copies matching a queryset in every database, by due date.
+
+    Taking a slice reads only the first copies of each database, up to the end of
+    the slice, and merges them, so a page of a long list does not load every copy.
+    """
+
+    def __init__(self, queryset):
+        self.querysets = fan_out(queryset.order_by(*DUE_BACK_ORDERING))
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            self._count = sum(queryset.count() for queryset in self.querysets)
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        return heapq.merge(*self.querysets, key=due_back_order)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop = index.start or 0, index.stop
+            if index.step is not None or start < 0 or stop is None or stop < 0:
+                return list(self)[index]
+            return list(islice(heapq.merge(*(queryset[:stop] for queryset in self.querysets), key=due_back_order),
+                               start, stop))
+        if index < 0:
+            return list(self)[index]
+        found = self[index:index + 1]
+        if not found:
+            raise IndexError('copy index out of range')
+        return found[0]
+
+
+def copies(queryset):
+    """Returns the copies matching queryset in every database by due date, as a queryset if there is only one"""
+    if databases() == [DEFAULT_DB_ALIAS]:
+        return queryset.order_by(*DUE_BACK_ORDERING)
+    return MergedCopies(queryset)
+
+
+def count(queryset):
+    """Returns the number of copies matching queryset in every database"""
+    return sum(branch_queryset.count() for branch_queryset in fan_out(queryset))
+
+
+def copy_counts(book_ids):
+    """Returns {book id: number of copies} over every database, with one query per database"""
+    counts = defaultdict(int)
+    queryset = (BookInstance.objects
+                .filter(book_id__in=book_ids)
+                .order_by()
+                .values_list('book_id')
+                .annotate(copies=Count('pk')))
+    for branch_queryset in fan_out(queryset):
+        for book_id, copies_count in branch_queryset:
+            counts[book_id] += copies_count
+    return counts
+
+
+def copy_database(copy_id):
+    """Returns the alias of the database holding a copy, recorded when its number was handed out"""
+    database = CopyNumber.objects.filter(pk=copy_id).values_list('database', flat=True).first()
+    return database or DEFAULT_DB_ALIAS
+
+
+def _count_available(database, book_id, branch_ids, close_connection):
+    try:
+        return dict(BookInstance.objects.using(database)
+                    .filter(book_id=book_id, branch_id__in=branch_ids, status__exact='a')
+                    .order_by()
+                    .values_list('branch_id')
+                    .annotate(available=Count('pk')))
+    finally:
+        # Connections opened by worker threads are not closed by the request cycle
+        if close_connection:
+            connections[database].close()
+
+
+def availability(book):
+    """Returns [(branch, number of available copies)] for every branch"""
+    branches = list(Branch.objects.all())
+    branch_ids_by_database = defaultdict(list)
+    for branch in branches:
+        branch_ids_by_database[branch.database].append(branch.id)
+
+    available = {}
+    # Threads have connections of their own, which do not see changes not yet committed by this one
+    in_transaction = any(connections[database].in_atomic_block for database in branch_ids_by_database)
+    if len(branch_ids_by_database) == 1 or in_transaction:
+        for database, branch_ids in branch_ids_by_database.items():
+            available.update(_count_available(database, book.pk, branch_ids, close_connection=False))
+    elif branch_ids_by_database:
+        with ThreadPoolExecutor(max_workers=len(branch_ids_by_database)) as pool:
+            futures = [pool.submit(_count_available, database, book.pk, branch_ids, True)
+                       for database, branch_ids in branch_ids_by_database.items()]
+            for future in futures:
+                available.update(future.result())
+    return [(branch, available.get(branch.id, 0)) for branch in branches]
+
+
+def available_copies():
+    """Returns {book id: {branch id: number of available copies}} for every book, with one query per database"""
+    branch_ids_by_database = defaultdict(list)
+    for branch_id, database in Branch.objects.values_list('id', 'database'):
+        branch_ids_by_database[database].append(branch_id)
+
+    available = defaultdict(dict)
+    for database, branch_ids in branch_ids_by_database.items():
+        counts = (BookInstance.objects.using(database)
+                  .filter(branch_id__in=branch_ids, status__exact='a')
+                  .order_by()
+                  .values_list('book_id', 'branch_id')
+                  .annotate(available=Count('pk')))
+        for book_id, branch_id, count in counts:
+            available[book_id][branch_id] = count
+    return available
@@ -0,0 +1,54 @@
+"""Helpers for versioned keys in the shared cache.
+
+Cached data is stored under keys that include a namespace version. Bumping the
+version invalidates everything in the namespace at once, in every worker,
+without having to know which keys were written.
+
+That only holds if the cache is shared: the local-memory and dummy backends
+keep nothing other workers can see, so is_shared() tells callers to fall back,
+and data a worker keeps in memory then expires after UNSHARED_TIMEOUT seconds.
+"""
+import time
+
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+# Seconds a worker trusts data kept in its memory when other workers cannot bump the version
+UNSHARED_TIMEOUT = 30
+
+
+def is_shared():
+    """Returns whether what one worker writes to the cache is seen by the others"""
+    return not isinstance(caches[DEFAULT_CACHE_ALIAS], (DummyCache, LocMemCache))
+
+
+def is_outdated(loaded_at):
+    """Returns whether data a worker loaded at time.monotonic() loaded_at may miss changes made by other workers"""
+    return not is_shared() and time.monotonic() - loaded_at > UNSHARED_TIMEOUT
+
+
+def version_key(namespace):
+    return f'{namespace}:version'
+
+
+def initial_version():
+    # The current time in microseconds, so a lost version key never reuses a version bumped from an earlier start
+    return int(time.time() * 1000000)
+
+
+def get_version(namespace):
+    """Returns the current version of a cache namespace"""
+    version = cache.get(version_key(namespace))
+    if version is None:
+        cache.add(version_key(namespace), initial_version(), None)
+        version = cache.get(version_key(namespace), initial_version())
+    return version
+
+
+def bump_version(namespace):
+    """Invalidates every key of a cache namespace"""
+    try:
+        cache.incr(version_key(namespace))
+    except ValueError:
+        cache.set(version_key(namespace), initial_version(), None)
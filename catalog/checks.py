@@ -0,0 +1,17 @@
+from urllib.parse import urlparse
+
+from django.conf import settings
+from django.core.checks import Warning, register
+
+
+@register(deploy=True)
+def check_media_url(app_configs, **kwargs):
+    """Warns when nothing serves the book covers: Django serves MEDIA_URL only with DEBUG on"""
+    if urlparse(settings.MEDIA_URL).netloc:
+        return []
+    return [Warning(
+        'Book covers and their thumbnails are not served with DEBUG off.',
+        hint='Set MEDIA_URL to the public URL of object storage holding MEDIA_ROOT, or serve MEDIA_ROOT at '
+             'MEDIA_URL from the web server in front of Django and add catalog.W001 to SILENCED_SYSTEM_CHECKS.',
+        id='catalog.W001',
+    )]
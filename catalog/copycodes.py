@@ -0,0 +1,72 @@
+"""Short public codes for book copies.
+
+Copies are numbered by CopyNumber (see catalog.models), so the number of a copy
+is unique across the default and branch databases. The public code of a copy
+is its number in Crockford's base 32 (digits and upper case letters except I,
+L, O and U), padded to five characters, followed by a Luhn mod 32 check
+character: e.g. copy 1234 is "0016JK". Codes fit a short Code 128 barcode, and
+the check character catches any mistyped character and most swapped ones.
+
+Decoding is forgiving the way Crockford intended: lower case is accepted, O is
+read as 0, I and L as 1, and hyphens and spaces are ignored.
+"""
+ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+BASE = len(ALPHABET)
+MIN_LENGTH = 5
+# Copy numbers are 64-bit database integers
+MAX_NUMBER = 2 ** 63 - 1
+
+_values = {char: value for value, char in enumerate(ALPHABET)}
+_values.update({char.lower(): value for char, value in _values.items()})
+_values.update({'O': 0, 'o': 0, 'I': 1, 'i': 1, 'L': 1, 'l': 1})
+
+
+def check_character(digits):
+    """Returns the Luhn mod 32 check character of a sequence of base 32 digit values"""
+    total = 0
+    for position, value in enumerate(reversed(digits)):
+        if position % 2 == 0:
+            value *= 2
+            value = value // BASE + value % BASE
+        total += value
+    return ALPHABET[-total % BASE]
+
+
+def encode(number):
+    """Returns the public code of a copy number"""
+    if number < 0:
+        raise ValueError('Copy numbers are positive')
+    digits = []
+    while number or len(digits) < MIN_LENGTH:
+        number, value = divmod(number, BASE)
+        digits.append(value)
+    digits.reverse()
+    return ''.join(ALPHABET[value] for value in digits) + check_character(digits)
+
+
+def decode(code):
+    """Returns the copy number of a public code; raises ValueError if it is malformed or mistyped"""
+    try:
+        digits = [_values[char] for char in code if char not in '- ']
+    except KeyError:
+        raise ValueError(f'{code!r} is not a copy code') from None
+    if len(digits) <= MIN_LENGTH or ALPHABET[digits[-1]] != check_character(digits[:-1]):
+        raise ValueError(f'{code!r} is not a copy code')
+    number = 0
+    for value in digits[:-1]:
+        number = number * BASE + value
+    if number > MAX_NUMBER:
+        # e.g. an old copy UUID whose last character happens to pass the check
+        raise ValueError(f'{code!r} is not a copy code')
+    return number
+
+
+class CopyCodeConverter:
+    """URL converter turning a copy code into the copy's primary key, and back"""
+    regex = '[0-9A-Za-z]{6,14}'
+
+    def to_python(self, value):
+        return decode(value)
+
+    def to_url(self, value):
+        return encode(int(value))
@@ -0,0 +1,92 @@
+"""Cover thumbnails, made in the background.
+
+Saving a book with a new cover only stores the uploaded file. Once the
+transaction commits, the book is handed to a small thread pool that resizes
+the cover to each of Book.COVER_WIDTHS in WebP and JPEG, names the files after
+a hash of the cover's content, and then sets Book.cover_hash so that templates
+start showing them. Pages never process images themselves; until the
+thumbnails exist they simply show no cover.
+
+Thumbnails lost to a restarting worker are made by the build_cover_thumbnails
+command.
+"""
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from PIL import Image
+
+from .models import Book, ConcurrentUpdateError
+
+FORMATS = (
+    ('webp', 'WEBP'),
+    ('jpg', 'JPEG'),
+)
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+
+
+def schedule(book_id):
+    """Makes the thumbnails of a book's cover in the background once the current transaction commits"""
+    transaction.on_commit(lambda: _get_executor().submit(_make_thumbnails_in_background, book_id))
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=getattr(settings, 'COVER_THUMBNAIL_WORKERS', 2))
+    return _executor
+
+
+def _make_thumbnails_in_background(book_id):
+    try:
+        make_thumbnails(book_id)
+    except Exception:
+        logger.exception('Could not make cover thumbnails of book %s', book_id)
+    finally:
+        # Worker threads are outside the request cycle that would close their connection
+        connection.close()
+
+
+def make_thumbnails(book_id):
+    """Makes the thumbnails of a book's cover and records their content hash on the book"""
+    book = Book.all_objects.filter(pk=book_id).first()
+    if book is None or not book.cover:
+        return
+
+    with book.cover.open('rb') as cover:
+        data = cover.read()
+    book.cover_hash = hashlib.sha256(data).hexdigest()[:16]
+
+    image = Image.open(BytesIO(data))
+    image = image.convert('RGB')
+    for width in Book.COVER_WIDTHS:
+        height = max(1, round(image.height * width / image.width))
+        thumbnail = image.resize((width, height), Image.LANCZOS) if width < image.width else image
+        for extension, image_format in FORMATS:
+            name = book.cover_thumbnail_name(width, extension)
+            if default_storage.exists(name):
+                continue
+            output = BytesIO()
+            thumbnail.save(output, image_format, quality=85)
+            default_storage.save(name, ContentFile(output.getvalue()))
+
+    # Publish the thumbnails on the latest version of the book, unless its cover was replaced meanwhile
+    cover_hash = book.cover_hash
+    for _ in range(3):
+        book = Book.all_objects.filter(pk=book_id, cover=book.cover.name).first()
+        if book is None:
+            return
+        book.cover_hash = cover_hash
+        try:
+            book.save(update_fields=['cover_hash'])
+            return
+        except ConcurrentUpdateError:
+            continue
@@ -0,0 +1,109 @@
+"""Deferred deletion of authors and books.
+
+Deleting an author or book in the request would make Django's collector load
+every dependent row and null out or delete them one by one. Instead, schedule()
+hides the object straight away and records a DeletionJob; the process_deletions
+command then handles the dependent rows in bounded batches, committing after
+each one, and finally deletes the object itself. Jobs keep no state besides
+their progress counters, so an interrupted run simply picks up where it left off.
+
+The batches are bulk updates and deletes, which send no signals, so each batch
+invalidates the cached counts and snapshot and marks the affected pages stale
+itself, in the same transaction.
+"""
+from django.db import models, transaction
+from django.db.models import F
+from django.urls import reverse
+from django.utils import timezone
+
+from . import branches, facets, prerender, snapshot
+from .caching import bump_version
+from .models import Author, Book, BookInstance, DeletionJob, VersionedModel
+
+MODELS = {
+    'author': Author,
+    'book': Book,
+}
+
+
+def dependent_querysets(model, object_id):
+    """Yields (relation, queryset) for the rows referencing an object that deletion has to update"""
+    for relation in model._meta.related_objects:
+        if relation.many_to_many or relation.on_delete not in (models.SET_NULL, models.CASCADE):
+            continue
+        queryset = relation.related_model._base_manager.filter(**{relation.field.name: object_id})
+        if relation.related_model is BookInstance:
+            # Copies may be stored in any branch database
+            for branch_queryset in branches.fan_out(queryset):
+                yield relation, branch_queryset
+        else:
+            yield relation, queryset
+
+
+def affected_paths(model, object_id):
+    """Returns the pre-rendered pages showing an object or the books deleting it updates"""
+    if not prerender.is_enabled():
+        return set()
+    paths = {reverse('books')}
+    if model is Author:
+        paths.update((reverse('authors'), reverse('author-detail', args=[object_id])))
+        book_ids = Book._base_manager.filter(author_id=object_id).values_list('pk', flat=True)
+    else:
+        author_id = Book._base_manager.filter(pk=object_id).values_list('author_id', flat=True).first()
+        if author_id:
+            paths.add(reverse('author-detail', args=[author_id]))
+        book_ids = [object_id]
+    paths.update(reverse('book-detail', args=[pk]) for pk in book_ids)
+    return paths
+
+
+def invalidate(paths):
+    """Discards what bulk updates made out of date, as the signal handlers would for single saves and deletes"""
+    # Bump again on commit, so data cached by other requests before the commit is discarded too
+    for namespace in (facets.CACHE_NAMESPACE, facets.AVAILABILITY_NAMESPACE, snapshot.CACHE_NAMESPACE):
+        bump_version(namespace)
+        transaction.on_commit(lambda namespace=namespace: bump_version(namespace))
+    if paths:
+        prerender.mark_stale(paths)
+
+
+def schedule(obj):
+    """Hides an author or book and queues the deletion of it and its dependent rows"""
+    with transaction.atomic():
+        obj.deleted = True
+        obj.save(update_fields=['deleted'])
+        total = sum(queryset.count() for _, queryset in dependent_querysets(type(obj), obj.pk))
+        return DeletionJob.objects.create(model=obj._meta.model_name, object_id=obj.pk,
+                                          object_repr=str(obj)[:200], total=total)
+
+
+def run(job, batch_size=500, progress=None):
+    """Processes a deletion job in batches; progress, if given, is called with the job after each batch"""
+    model = MODELS[job.model]
+    # Looked up before the first batch, which may take the author's books off its page
+    paths = affected_paths(model, job.object_id)
+    for relation, queryset in dependent_querysets(model, job.object_id):
+        while True:
+            with transaction.atomic(), transaction.atomic(using=queryset.db):
+                ids = list(queryset.order_by().values_list('pk', flat=True)[:batch_size])
+                if not ids:
+                    break
+                batch = relation.related_model._base_manager.using(queryset.db).filter(pk__in=ids)
+                if relation.on_delete is models.SET_NULL:
+                    changes = {relation.field.name: None}
+                    if issubclass(relation.related_model, VersionedModel):
+                        # Make forms still showing the old value report a conflict
+                        changes['version'] = F('version') + 1
+                    batch.update(**changes)
+                else:
+                    batch.delete()
+                invalidate(paths)
+                DeletionJob.objects.filter(pk=job.pk).update(processed=F('processed') + len(ids))
+            job.processed += len(ids)
+            if progress:
+                progress(job)
+
+    with transaction.atomic():
+        model._base_manager.filter(pk=job.object_id).delete()
+        job.finished_at = timezone.now()
+        job.save(update_fields=['finished_at'])
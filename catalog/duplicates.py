@@ -0,0 +1,204 @@
+"""Detection of duplicate authors and books.
+
+Comparing every pair of records is quadratic, so candidate pairs come from
+blocking: records are sorted by a blocking key (e.g. the normalized last name
+of an author) and each record is paired with the next WINDOW records sharing
+its key (the "sorted neighbourhood" method). Several blocking passes with
+different keys catch records that differ in any one field, and the work stays
+linear in the number of records.
+
+Candidate pairs are scored all at once: each name or title becomes a vector of
+its character n-gram counts, scaled to unit length, and the similarity of two
+texts is the cosine of their vectors, computed for every pair with a few sparse
+matrix operations. Books score the similarity of their titles, or 1 with the
+same ISBN. Authors score the mean similarity of their last and first names,
+where first names that match by initials ("Tolkien, J.R.R." and "Tolkien,
+John") count as very similar.
+
+This module needs NumPy and SciPy, and is only imported by the find_duplicates
+command.
+"""
+import re
+import time
+import unicodedata
+
+import numpy as np
+from django.db import transaction
+from scipy import sparse
+
+from .models import Author, Book, DuplicateCandidate
+
+WINDOW = 20
+THRESHOLD = 0.75
+FEATURES = 2 ** 20
+
+# Similarity of first names matching by initials, and score of books with the same ISBN
+INITIALS_SCORE = 0.9
+ISBN_SCORE = 1.0
+
+# Pairs scored per sparse matrix operation
+CHUNK_SIZE = 100000
+
+
+def normalize(text):
+    """Returns text in lower case, without accents or punctuation: 'Tolkien, J.R.R.' -> 'tolkien j r r'"""
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return ' '.join(re.findall(r'[a-z0-9]+', text.lower()))
+
+
+def ngram_vectors(texts, n=3):
+    """Returns a sparse matrix whose rows are the unit-length character n-gram counts of the texts"""
+    rows, columns = [], []
+    for row, text in enumerate(texts):
+        padded = ' ' * (n - 1) + text + ' '
+        grams = [hash(padded[start:start + n]) % FEATURES for start in range(len(padded) - n + 1)]
+        rows.extend([row] * len(grams))
+        columns.extend(grams)
+    vectors = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, columns)),
+                                shape=(len(texts), FEATURES))
+    norms = np.sqrt(np.asarray(vectors.multiply(vectors).sum(axis=1)).ravel())
+    return sparse.diags(1 / np.maximum(norms, 1e-9)) @ vectors
+
+
+def cosine(vectors, left, right):
+    """Returns the cosine similarity of the rows left[i] and right[i] of unit-length vectors"""
+    scores = [np.asarray(vectors[left[start:start + CHUNK_SIZE]]
+                         .multiply(vectors[right[start:start + CHUNK_SIZE]])
+                         .sum(axis=1)).ravel()
+              for start in range(0, len(left), CHUNK_SIZE)]
+    return np.concatenate(scores) if scores else np.zeros(0, dtype=np.float32)
+
+
+def blocked_pairs(keys, sort_texts, window=WINDOW):
+    """Returns (left, right): indexes of records with the same non-empty key, near each other once sorted"""
+    keys = np.asarray(keys)
+    codes = np.unique(keys, return_inverse=True)[1]
+    order = np.lexsort((np.asarray(sort_texts), codes))
+    sorted_codes = codes[order]
+    has_key = keys[order] != ''
+
+    lefts, rights = [], []
+    for distance in range(1, min(window, len(order))):
+        same = (sorted_codes[:-distance] == sorted_codes[distance:]) & has_key[:-distance]
+        lefts.append(order[:-distance][same])
+        rights.append(order[distance:][same])
+    if not lefts:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(lefts), np.concatenate(rights)
+
+
+def unique_pairs(passes, count):
+    """Merges the pairs of several blocking passes, with the lower index first and each pair once"""
+    lefts = np.concatenate([left for left, _ in passes])
+    rights = np.concatenate([right for _, right in passes])
+    pairs = np.sort(np.minimum(lefts, rights).astype(np.int64) * count + np.maximum(lefts, rights))
+    pairs = pairs[np.r_[True, pairs[1:] != pairs[:-1]]] if len(pairs) else pairs
+    return pairs // count, pairs % count
+
+
+def author_pairs(first_names, last_names, window=WINDOW):
+    """Returns (left, right, scores) for candidate duplicates among authors"""
+    first = [normalize(name) for name in first_names]
+    last = [normalize(name) for name in last_names]
+    full = [f'{last_name} {first_name}' for first_name, last_name in zip(first, last)]
+    passes = [
+        # Same last name; same first name, sorted by last name; then the first initial with the start or
+        # the end of the last name: a typo in the last name leaves at least one of them intact
+        blocked_pairs(last, full, window),
+        blocked_pairs(first, full, window),
+        blocked_pairs([f'{last_name[:3]} {first_name[:1]}' if last_name else ''
+                       for first_name, last_name in zip(first, last)], full, window),
+        blocked_pairs([f'{last_name[-3:]} {first_name[:1]}' if last_name else ''
+                       for first_name, last_name in zip(first, last)], full, window),
+    ]
+    left, right = unique_pairs(passes, len(full))
+
+    # Names are short, so bigrams: a swapped pair of letters still leaves most of them in common
+    last_scores = cosine(ngram_vectors(last, 2), left, right)
+    first_scores = cosine(ngram_vectors(first, 2), left, right)
+    initials = np.array([all(len(part) == 1 for part in name.split()) for name in first])
+    first_initial = np.array([name[:1] for name in first])
+    by_initials = (first_initial[left] == first_initial[right]) & (initials[left] | initials[right])
+    first_scores = np.where(by_initials, np.maximum(first_scores, INITIALS_SCORE), first_scores)
+    return left, right, (last_scores + first_scores) / 2
+
+
+def book_pairs(titles, isbns, author_names, window=WINDOW):
+    """Returns (left, right, scores) for candidate duplicates among books"""
+    title = [normalize(text) for text in titles]
+    isbn = [re.sub(r'[^0-9X]', '', (text or '').upper()) for text in isbns]
+    isbn = [text if len(text) >= 10 else '' for text in isbn]
+    passes = [
+        blocked_pairs(isbn, title, window),
+        # Same author last name and first word of the title, so authors' duplicates do not hide books'
+        blocked_pairs([f'{normalize(name).split(" ")[-1]} {text.split(" ")[0]}' if text else ''
+                       for name, text in zip(author_names, title)], title, window),
+        blocked_pairs(title, title, window),
+    ]
+    left, right = unique_pairs(passes, len(title))
+    scores = cosine(ngram_vectors(title), left, right)
+    isbn = np.array(isbn)
+    same_isbn = (isbn[left] == isbn[right]) & (isbn[left] != '')
+    return left, right, np.where(same_isbn, np.maximum(scores, ISBN_SCORE), scores)
+
+
+def find(model, threshold=THRESHOLD, window=WINDOW):
+    """Returns (first ids, second ids, scores) of the likely duplicates among visible authors or books"""
+    if model == 'author':
+        records = list(Author.objects.order_by('id').values_list('id', 'first_name', 'last_name'))
+        ids, first_names, last_names = zip(*records) if records else ((), (), ())
+        left, right, scores = author_pairs(first_names, last_names, window)
+    else:
+        records = list(Book.objects.order_by('id').values_list('id', 'title', 'isbn', 'author__last_name'))
+        ids, titles, isbns, author_names = zip(*records) if records else ((), (), (), ())
+        left, right, scores = book_pairs(titles, isbns, [name or '' for name in author_names], window)
+    if not len(left):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+
+    likely = scores >= threshold
+    ids = np.array(ids)
+    return ids[left[likely]], ids[right[likely]], scores[likely]
+
+
+def store(model, first_ids, second_ids, scores):
+    """Replaces the pending candidates of a model, leaving out pairs already merged or dismissed"""
+    with transaction.atomic():
+        candidates = DuplicateCandidate.objects.filter(model=model)
+        decided = set(candidates.exclude(status='p').values_list('first_id', 'second_id'))
+        candidates.filter(status='p').delete()
+        new = [DuplicateCandidate(model=model, first_id=first, second_id=second, score=score)
+               for first, second, score in zip(first_ids.tolist(), second_ids.tolist(), scores.tolist())
+               if (first, second) not in decided]
+        DuplicateCandidate.objects.bulk_create(new, batch_size=1000)
+    return len(new)
+
+
+def benchmark(authors, duplicate_rate=0.01, threshold=THRESHOLD, window=WINDOW, seed=0):
+    """Finds duplicates among synthetic authors in memory; returns (seconds, candidates, planted duplicates found)"""
+    random = np.random.RandomState(seed)
+    syllables = np.array([consonant + vowel for consonant in 'bcdfghjklmnprstvwz' for vowel in 'aeiou'])
+    first_names = [''.join(parts).title() for parts in random.choice(syllables, size=(authors, 2))]
+    last_names = [''.join(parts).title() for parts in random.choice(syllables, size=(authors, 3))]
+
+    # Duplicates as entered by hand: initials instead of a first name, or a typo in the last name
+    planted = random.choice(authors, size=int(authors * duplicate_rate), replace=False)
+    for number, original in enumerate(planted):
+        if number % 2:
+            first_names.append(first_names[original][0] + '.')
+            last_names.append(last_names[original])
+        else:
+            name = last_names[original]
+            position = random.randint(1, len(name))
+            first_names.append(first_names[original])
+            last_names.append(name[:position] + name[position:][1:2] + name[position:position + 1]
+                              + name[position + 2:])
+
+    started = time.perf_counter()
+    left, right, scores = author_pairs(first_names, last_names, window)
+    seconds = time.perf_counter() - started
+
+    likely = scores >= threshold
+    found = set(zip(left[likely].tolist(), right[likely].tolist()))
+    planted_found = sum((int(original), authors + number) in found for number, original in enumerate(planted))
+    return seconds, int(likely.sum()), planted_found / max(len(planted), 1)
@@ -1,10 +1,127 @@
 from django import forms
 from django.core.validators import ValidationError
+from django.forms.models import ModelChoiceIterator
 import datetime
 
+from . import refdata
+from .models import Book
+from .widgets import AutocompleteSelect, AutocompleteSelectMultiple
+
+CONFLICT_MESSAGE = 'This record was changed by someone else while you were editing it.'
+
+
+class VersionedModelForm(forms.ModelForm):
+    """Model form for versioned models that refuses to save over changes made after it was displayed"""
+    # Named apart from the model field, which is not editable
+    loaded_version = forms.IntegerField(label='Version', widget=forms.HiddenInput, required=False)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.instance.pk is not None:
+            self.initial['loaded_version'] = self.instance.version
+
+    def clean(self):
+        cleaned_data = super().clean()
+        version = cleaned_data.get('loaded_version')
+        if self.instance.pk is not None and version is not None and version != self.instance.version:
+            raise ValidationError(CONFLICT_MESSAGE, code='conflict')
+        return cleaned_data
+
+    def _post_clean(self):
+        super()._post_clean()
+        # The record may still change before it is saved; the save compares against this version
+        version = self.cleaned_data.get('loaded_version')
+        if self.instance.pk is not None and version is not None:
+            self.instance.version = version
+        self._version_before_save = self.instance.version if self.instance.pk is not None else None
+
+    def _save_m2m(self):
+        # Many-to-many fields are not columns of the record, so when they are all that changed the
+        # record itself is not saved; compare and bump its version before writing them instead
+        many_to_many = {field.name for field in self.instance._meta.many_to_many}
+        if self.instance.version == self._version_before_save and many_to_many.intersection(self.changed_data):
+            self.instance.save(update_fields=())
+        super()._save_m2m()
+
+
+class ReferenceChoiceIterator(ModelChoiceIterator):
+    """Iterates over genres or languages from the reference data cache rather than the queryset"""
+
+    def __iter__(self):
+        if self.field.empty_label is not None:
+            yield ('', self.field.empty_label)
+        for obj in refdata.objects(self.queryset.model).values():
+            yield self.choice(obj)
+
+    def __len__(self):
+        return len(refdata.objects(self.queryset.model)) + (1 if self.field.empty_label is not None else 0)
+
+    def __bool__(self):
+        return self.field.empty_label is not None or bool(refdata.objects(self.queryset.model))
+
+
+class ReferenceChoiceField(forms.ModelChoiceField):
+    """Choice of a genre or language, offered and validated without querying the database"""
+    iterator = ReferenceChoiceIterator
+
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        model = self.queryset.model
+        try:
+            return refdata.objects(model)[model._meta.pk.to_python(value)]
+        except (KeyError, ValidationError):
+            raise ValidationError(self.error_messages['invalid_choice'], code='invalid_choice')
+
+
+class ReferenceMultipleChoiceField(forms.ModelMultipleChoiceField):
+    """Choice of several genres or languages, offered and validated without querying the database"""
+    iterator = ReferenceChoiceIterator
+
+    def _check_values(self, value):
+        model = self.queryset.model
+        objects = refdata.objects(model)
+        try:
+            value = frozenset(value)
+        except TypeError:
+            raise ValidationError(self.error_messages['list'], code='list')
+        selected = []
+        for pk in value:
+            try:
+                key = model._meta.pk.to_python(pk)
+            except ValidationError:
+                raise ValidationError(self.error_messages['invalid_pk_value'], code='invalid_pk_value',
+                                      params={'pk': pk})
+            if key not in objects:
+                raise ValidationError(self.error_messages['invalid_choice'], code='invalid_choice',
+                                      params={'value': pk})
+            selected.append(objects[key])
+        return selected
+
+
+class BookForm(VersionedModelForm):
+    """Book form taking its genre and language choices from the reference data cache.
+
+    Authors and genres are picked with autocomplete widgets, so only the selected
+    ones are rendered and only the submitted ones are looked up.
+    """
+
+    class Meta:
+        model = Book
+        fields = '__all__'
+        field_classes = {
+            'genre': ReferenceMultipleChoiceField,
+            'language': ReferenceChoiceField,
+        }
+        widgets = {
+            'author': AutocompleteSelect('author'),
+            'genre': AutocompleteSelectMultiple('genre'),
+        }
+
 
 class RenewBookForm(forms.Form):
     renewal_date = forms.DateField(help_text='Enter a date between now and 4 weeks (default 3)')
+    loaded_version = forms.IntegerField(label='Version', widget=forms.HiddenInput, required=False)
 
     def clean_renewal_date(self):
         data = self.cleaned_data['renewal_date']
@@ -0,0 +1,80 @@
+import os
+import random
+import sqlite3
+import tempfile
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+
+from catalog import copycodes
+
+# Key column of each layout, and a function making the key of the nth copy
+LAYOUTS = {
+    'uuid-text': ('id char(32) NOT NULL PRIMARY KEY', lambda n: uuid.uuid4().hex),
+    'uuid-binary': ('id blob NOT NULL PRIMARY KEY', lambda n: uuid.uuid4().bytes),
+    'copy-number': ('id integer NOT NULL PRIMARY KEY', lambda n: n),
+}
+
+
+class Command(BaseCommand):
+    help = ('Compares the size, insert and lookup throughput of the copy table keyed by text UUIDs (the old layout), '
+            'binary UUIDs and copy numbers, in scratch SQLite databases')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--copies', type=int, default=10000000)
+        parser.add_argument('--lookups', type=int, default=100000)
+        parser.add_argument('--batch-size', type=int, default=10000, help='Copies inserted per transaction')
+        parser.add_argument('--layout', action='append', choices=LAYOUTS, help='Layouts to run (default: all)')
+        parser.add_argument('--directory', help='Where to create the scratch databases (default: a temporary one)')
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory(dir=options['directory']) as directory:
+            for layout in options['layout'] or LAYOUTS:
+                result = self.run(os.path.join(directory, f'{layout}.sqlite3'), layout, options)
+                self.stdout.write('{:<12} {:>9,.0f} inserts/s  table {:>7.1f} MB  key index {:>7.1f} MB  '
+                                  '{:>7,.0f} lookups/s'.format(layout, *result))
+
+        # Copy numbers arrive as copy codes in URLs and barcodes
+        codes = [copycodes.encode(random.randrange(options['copies'])) for _ in range(10000)]
+        start = time.perf_counter()
+        for code in codes:
+            copycodes.decode(code)
+        microseconds = (time.perf_counter() - start) / len(codes) * 1e6
+        self.stdout.write(f'Decoding a copy code takes {microseconds:.1f} µs')
+
+    def run(self, filename, layout, options):
+        """Returns the insert rate, table and key index sizes in MB, and the lookup rate of a layout"""
+        key_column, make_key = LAYOUTS[layout]
+        copies, batch_size = options['copies'], options['batch_size']
+        connection = sqlite3.connect(filename, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute(f'CREATE TABLE catalog_bookinstance ({key_column}, book_id integer NULL, '
+                           'imprint varchar(200) NOT NULL, status varchar(1) NOT NULL)')
+        connection.execute('CREATE INDEX catalog_bookinstance_book_id ON catalog_bookinstance (book_id)')
+
+        # Every nth key is kept to be looked up later
+        sample_every = max(copies // options['lookups'], 1)
+        sample = []
+        start = time.perf_counter()
+        for first in range(1, copies + 1, batch_size):
+            rows = [(make_key(n), random.randrange(100000), '2016', 'a')
+                    for n in range(first, min(first + batch_size, copies + 1))]
+            sample.extend(row[0] for row in rows[::sample_every])
+            connection.execute('BEGIN')
+            connection.executemany('INSERT INTO catalog_bookinstance VALUES (?, ?, ?, ?)', rows)
+            connection.execute('COMMIT')
+        insert_rate = copies / (time.perf_counter() - start)
+
+        sizes = dict(connection.execute('SELECT name, SUM(pgsize) FROM dbstat GROUP BY name'))
+        table_size = sizes.get('catalog_bookinstance', 0)
+        key_index_size = sizes.get('sqlite_autoindex_catalog_bookinstance_1', 0)
+
+        random.shuffle(sample)
+        start = time.perf_counter()
+        for key in sample:
+            connection.execute('SELECT * FROM catalog_bookinstance WHERE id = ?', (key,)).fetchone()
+        lookup_rate = len(sample) / (time.perf_counter() - start)
+        connection.close()
+        return insert_rate, table_size / 1e6, key_index_size / 1e6, lookup_rate
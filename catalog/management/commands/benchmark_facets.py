@@ -0,0 +1,91 @@
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+
+from catalog import facets
+from catalog.models import Author, Book, BookInstance, Genre, Language
+
+ALIAS = 'facet_benchmark'
+
+# Books inserted per transaction
+CHUNK_SIZE = 50000
+
+
+class Command(BaseCommand):
+    help = 'Times building the facet index and counting facets over a synthetic catalog, in a scratch SQLite database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--books', type=int, default=1000000)
+        parser.add_argument('--copies-per-book', type=int, default=2)
+        parser.add_argument('--genres', type=int, default=40)
+        parser.add_argument('--languages', type=int, default=10)
+        parser.add_argument('--repeat', type=int, default=5, help='Runs of each query; the median is reported')
+        parser.add_argument('--directory', help='Where to create the scratch database (default: a temporary one)')
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory(dir=options['directory']) as directory:
+            connections.databases[ALIAS] = {'ENGINE': 'django.db.backends.sqlite3',
+                                            'NAME': os.path.join(directory, 'facets.sqlite3')}
+            connections.ensure_defaults(ALIAS)
+            try:
+                start = time.perf_counter()
+                self.populate(options)
+                self.stdout.write(f'Populated {options["books"]:,} books in {time.perf_counter() - start:.0f}s')
+
+                start = time.perf_counter()
+                index = facets.load_index(using=ALIAS)
+                index = index.with_availability(facets.load_available_book_ids(using=ALIAS), 0)
+                self.stdout.write(f'Loaded the facet index in {time.perf_counter() - start:.1f}s')
+
+                for label, filters in (('no filter', {}), ('genre', {'genre': 1}), ('language', {'language': 1}),
+                                       ('available', {'available': True}),
+                                       ('genre + language + available', {'genre': 1, 'language': 1,
+                                                                         'available': True})):
+                    timings = []
+                    for _ in range(options['repeat']):
+                        start = time.perf_counter()
+                        index.counts(filters)
+                        timings.append(time.perf_counter() - start)
+                    self.stdout.write(f'{label:<30} {statistics.median(timings) * 1000:>8.1f} ms')
+            finally:
+                connections[ALIAS].close()
+                del connections.databases[ALIAS]
+
+    def populate(self, options):
+        with connections[ALIAS].schema_editor() as editor:
+            for model in (Genre, Language, Author, Book, BookInstance):
+                editor.create_model(model)
+        Genre.objects.using(ALIAS).bulk_create(Genre(id=n, name=f'Genre {n}', name_folded=f'genre {n}')
+                                               for n in range(1, options['genres'] + 1))
+        Language.objects.using(ALIAS).bulk_create(Language(id=n, name=f'Language {n}')
+                                                  for n in range(1, options['languages'] + 1))
+
+        for first in range(1, options['books'] + 1, CHUNK_SIZE):
+            with transaction.atomic(using=ALIAS):
+                self.add_books(range(first, min(first + CHUNK_SIZE, options['books'] + 1)), options)
+        connections[ALIAS].cursor().execute('ANALYZE')
+
+    def add_books(self, book_ids, options):
+        """Adds books with one to three genres each, skewed towards the first genres as in real catalogs"""
+        genre_ids = range(1, options['genres'] + 1)
+        genre_weights = [1 / genre_id for genre_id in genre_ids]
+        Book.objects.using(ALIAS).bulk_create(
+            Book(id=book_id, title=f'Book {book_id}', summary='Summary', isbn='ABCDEFG',
+                 language_id=random.randint(1, options['languages'])) for book_id in book_ids)
+
+        through = Book.genre.through
+        links = {(book_id, genre_id) for book_id in book_ids
+                 for genre_id in random.choices(genre_ids, genre_weights, k=random.randint(1, 3))}
+        through.objects.using(ALIAS).bulk_create(through(book_id=book_id, genre_id=genre_id)
+                                                 for book_id, genre_id in links)
+
+        copies_per_book = options['copies_per_book']
+        BookInstance.objects.using(ALIAS).bulk_create(
+            BookInstance(id=book_id * copies_per_book + number, book_id=book_id, imprint='2016',
+                         status=random.choice('aoom'))
+            for book_id in book_ids for number in range(copies_per_book))
@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from catalog import snapshot
+
+
+class Command(BaseCommand):
+    help = 'Writes the memory-mapped catalog snapshot served by the book and author pages, if the catalog changed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='Rebuild even if the snapshot is up to date')
+
+    def handle(self, *args, **options):
+        filename = settings.CATALOG_SNAPSHOT_PATH
+        snapshot.expire()
+        if not options['force'] and snapshot.current() is not None:
+            self.stdout.write(f'{filename} is up to date')
+            return
+        books, authors = snapshot.build(filename)
+        self.stdout.write(f'Wrote {books} books and {authors} authors to {filename}')
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from catalog import covers
+from catalog.models import Book
+
+
+class Command(BaseCommand):
+    help = 'Makes the cover thumbnails of books whose covers have none yet'
+
+    def handle(self, *args, **options):
+        pending = Book.all_objects.exclude(cover='').filter(cover_hash='')
+        for book_id in pending.values_list('pk', flat=True).iterator():
+            covers.make_thumbnails(book_id)
+        self.stdout.write('Cover thumbnails are up to date')
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from catalog import recommendations
+
+
+class Command(BaseCommand):
+    help = 'Computes "patrons also borrowed" recommendations from the loan history'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true',
+                            help='Recompute every book, not only those affected by loans since the last build')
+        parser.add_argument('-k', type=int, default=10, help='Number of recommendations kept per book')
+        parser.add_argument('--benchmark', type=int, metavar='LOANS',
+                            help='Time a build over this many synthetic loans instead of touching the database')
+        parser.add_argument('--borrowers', type=int, default=100000, help='Borrowers in the synthetic benchmark')
+        parser.add_argument('--books', type=int, default=50000, help='Books in the synthetic benchmark')
+
+    def handle(self, *args, **options):
+        if options['benchmark']:
+            seconds, peak_memory_kb = recommendations.benchmark(
+                options['benchmark'], options['borrowers'], options['books'], options['k'])
+            self.stdout.write(f'{options["benchmark"]} synthetic loans: {seconds:.1f}s, '
+                              f'peak memory {peak_memory_kb // 1024} MB')
+            return
+
+        build = recommendations.build(options['k'], options['full'])
+        self.stdout.write(f'Recommendations for {build.books} books from {build.loans} loans: '
+                          f'{build.seconds:.1f}s, peak memory {build.peak_memory_kb // 1024} MB')
@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from catalog import duplicates
+
+
+class Command(BaseCommand):
+    help = 'Finds likely duplicate authors and books, to be merged or dismissed by staff'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', action='append', choices=['author', 'book'],
+                            help='Records to look at (default: authors and books)')
+        parser.add_argument('--threshold', type=float, default=duplicates.THRESHOLD,
+                            help='Lowest similarity, between 0 and 1, of the pairs kept')
+        parser.add_argument('--window', type=int, default=duplicates.WINDOW,
+                            help='Records compared with each record in every blocking pass')
+        parser.add_argument('--benchmark', type=int, metavar='AUTHORS',
+                            help='Time a search among this many synthetic authors instead of touching the database')
+
+    def handle(self, *args, **options):
+        if options['benchmark']:
+            seconds, candidates, recall = duplicates.benchmark(
+                options['benchmark'], threshold=options['threshold'], window=options['window'])
+            self.stdout.write(f'{options["benchmark"]} synthetic authors: {seconds:.1f}s, {candidates} candidates, '
+                              f'{recall:.1%} of the planted duplicates found')
+            return
+
+        for model in options['model'] or ['author', 'book']:
+            started = time.perf_counter()
+            pairs = duplicates.find(model, options['threshold'], options['window'])
+            stored = duplicates.store(model, *pairs)
+            self.stdout.write(f'{stored} pending {model} duplicates: {time.perf_counter() - started:.1f}s')
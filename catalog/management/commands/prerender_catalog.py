@@ -0,0 +1,51 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from catalog import prerender
+from catalog.models import StalePage
+
+
+# Fewer pages than this render faster in this process than by starting workers
+MIN_POOL_PAGES = 50
+
+
+class Command(BaseCommand):
+    help = 'Writes the public catalog pages to PRERENDER_ROOT as static HTML, re-rendering only stale pages'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true',
+                            help='Render every page, not only those changed since the last run')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='Number of processes rendering pages')
+
+    def handle(self, *args, **options):
+        root = settings.PRERENDER_ROOT
+        self.workers = max(1, options['workers'] or 1)
+
+        # Claim the stale pages before rendering, so changes made meanwhile are picked up next time
+        stale = list(StalePage.objects.values_list('id', 'path', 'marked_at'))
+
+        if options['full'] or not os.path.isdir(root):
+            written = prerender.rebuild(root, prerender.all_pages(), self.render_in_pool)
+        else:
+            pages = prerender.expand_stale_paths(root, (path for _, path, _ in stale))
+            written = self.render_in_pool(root, pages)
+
+        for page_id, _, marked_at in stale:
+            StalePage.objects.filter(id=page_id, marked_at=marked_at).delete()
+        self.stdout.write(f'Pre-rendered {written} pages to {root}')
+
+    def render_in_pool(self, root, pages):
+        if self.workers == 1 or len(pages) < MIN_POOL_PAGES:
+            return prerender.render_pages(root, pages)
+
+        # Forked workers must not share the parent's database connections
+        connections.close_all()
+        chunk_size = -(-len(pages) // (self.workers * 4))
+        chunks = [pages[i:i + chunk_size] for i in range(0, len(pages), chunk_size)]
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            return sum(pool.map(prerender.render_pages, [root] * len(chunks), chunks))
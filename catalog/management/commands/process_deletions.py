@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from catalog import deletion
+from catalog.models import DeletionJob
+
+
+class Command(BaseCommand):
+    help = 'Deletes hidden authors and books together with their dependent rows, in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of dependent rows updated per transaction')
+
+    def handle(self, *args, **options):
+        for job in DeletionJob.objects.filter(finished_at__isnull=True):
+            self.stdout.write(f'Deleting {job}')
+            deletion.run(job, options['batch_size'], progress=self.report_progress)
+            self.stdout.write(f'Deleted {job}')
+
+    def report_progress(self, job):
+        self.stdout.write(f'  {job.processed}/{job.total} dependent rows processed')
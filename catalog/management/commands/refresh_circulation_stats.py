@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+from catalog import branches
+from catalog.models import BookInstance, BookLoanStat, CirculationSummary, GenreLoanStat, Loan
+
+BATCH_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = 'Folds new loans and returns into the precomputed circulation statistics'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            summary = CirculationSummary.objects.select_for_update().get_or_create(pk=1)[0]
+
+            # Count loans made since the last refresh, per book and per genre
+            new_loans = Loan.objects.filter(loan_recorded=False)
+            while True:
+                ids = list(new_loans.order_by('id').values_list('id', flat=True)[:BATCH_SIZE])
+                if not ids:
+                    break
+                batch = Loan.objects.filter(id__in=ids).annotate(month=TruncMonth('loaned_on'))
+                book_counts = (batch.filter(book__isnull=False)
+                               .values('book', 'month').annotate(loans=Count('id')).order_by())
+                genre_counts = (batch.filter(book__genre__isnull=False)
+                                .values('book__genre', 'month').annotate(loans=Count('id')).order_by())
+
+                for row in book_counts:
+                    add_loans(BookLoanStat, {'book_id': row['book'], 'month': row['month']}, row['loans'])
+                for row in genre_counts:
+                    add_loans(GenreLoanStat, {'genre_id': row['book__genre'], 'month': row['month']},
+                              row['loans'])
+                Loan.objects.filter(id__in=ids).update(loan_recorded=True)
+
+            # Add the length of loans returned since the last refresh
+            new_returns = 0
+            returned = Loan.objects.filter(returned_on__isnull=False, duration_recorded=False)
+            while True:
+                batch = list(returned.order_by('id').values_list('id', 'loaned_on', 'returned_on')[:BATCH_SIZE])
+                if not batch:
+                    break
+                for loan_id, loaned_on, returned_on in batch:
+                    summary.total_loan_days += (returned_on - loaned_on).days
+                summary.returned_loans += len(batch)
+                new_returns += len(batch)
+                Loan.objects.filter(id__in=[loan[0] for loan in batch]).update(duration_recorded=True)
+
+            # Current circulation state is cheap to count from the status index, in each branch database
+            on_loan = BookInstance.objects.filter(status__exact='o')
+            summary.on_loan = branches.count(on_loan)
+            summary.overdue = branches.count(on_loan.filter(due_back__lt=timezone.localdate()))
+            summary.refreshed_at = timezone.now()
+            summary.save()
+
+        self.stdout.write(f'Circulation statistics refreshed ({summary.on_loan} on loan, '
+                          f'{new_returns} new returns)')
+
+
+def add_loans(model, key, loans):
+    """Adds loans to the statistics row identified by key, creating it if needed"""
+    if not model.objects.filter(**key).update(loans=F('loans') + loans):
+        model.objects.create(loans=loans, **key)
@@ -0,0 +1,111 @@
+"""Merging of duplicate authors and books.
+
+Merging moves every row referring to the duplicate over to the record kept,
+then deletes the duplicate. Each kind of row is moved with a single UPDATE, so
+a merge costs a handful of statements however many books, copies or loans are
+involved. Everything happens in one transaction on the default database.
+Copies stored in branch databases are moved in a transaction on each of those
+databases, committed just before the default one: should that fail, the copies
+already belong to the record kept, which still exists.
+
+The UPDATEs send no signals, so a merge invalidates the cached counts and
+snapshot and marks the affected pages stale itself, like deferred deletion
+(see catalog.deletion). Moved loans are flagged for the next recommendation build.
+"""
+from contextlib import ExitStack
+
+from django.db import transaction
+from django.db.models import F, OuterRef, Q, Subquery
+from django.urls import reverse
+
+from . import branches, deletion, prerender
+from .models import Author, Book, BookInstance, BookLoanStat, BookRecommendation, DuplicateCandidate, Loan
+
+MODELS = {
+    'author': Author,
+    'book': Book,
+}
+
+
+def merge_authors(keep, duplicate):
+    """Moves the books of the duplicate author to the author kept, and deletes the duplicate"""
+    with transaction.atomic():
+        books = Book.all_objects.filter(author_id=duplicate.pk)
+        book_ids = list(books.values_list('pk', flat=True))
+        # Bumping the version makes forms still showing the old author report a conflict
+        books.update(author_id=keep.pk, version=F('version') + 1)
+        forget_candidates('author', keep.pk, duplicate.pk)
+        duplicate.delete()
+        deletion.invalidate(affected_paths([keep.pk, duplicate.pk], book_ids))
+
+
+def merge_books(keep, duplicate):
+    """Moves the copies, genres, loans and loan statistics of the duplicate book to the book kept,
+    and deletes the duplicate"""
+    databases = branches.databases()
+    with ExitStack() as stack:
+        for database in databases:
+            stack.enter_context(transaction.atomic(using=database))
+        for database in databases:
+            (BookInstance.objects.using(database)
+             .filter(book_id=duplicate.pk)
+             .update(book_id=keep.pk, version=F('version') + 1))
+
+        # Genres the kept book lacks move over; the rest go with the duplicate
+        through = Book.genre.through.objects
+        (through.filter(book_id=duplicate.pk)
+         .exclude(genre_id__in=through.filter(book_id=keep.pk).values('genre_id'))
+         .update(book_id=keep.pk))
+
+        # The borrowers of the moved loans now share the kept book with their other books
+        Loan.objects.filter(book_id=duplicate.pk).update(book_id=keep.pk, in_recommendations=False)
+
+        # Monthly loan counts are added up for the months both books have, and moved for the others
+        duplicate_stats = BookLoanStat.objects.filter(book_id=duplicate.pk)
+        shared_months = BookLoanStat.objects.filter(book_id=keep.pk, month__in=duplicate_stats.values('month'))
+        shared_months.update(loans=F('loans') + Subquery(
+            duplicate_stats.filter(month=OuterRef('month')).values('loans')[:1]))
+        duplicate_stats.filter(month__in=BookLoanStat.objects.filter(book_id=keep.pk).values('month')).delete()
+        duplicate_stats.update(book_id=keep.pk)
+
+        # Recommendations of the duplicate are dropped; build_recommendations recomputes the kept book's
+        recommendations = BookRecommendation.objects.filter(Q(book_id=duplicate.pk) | Q(recommended_id=duplicate.pk))
+        book_ids = {keep.pk, duplicate.pk, *recommendations.values_list('book_id', flat=True)}
+        recommendations.delete()
+
+        forget_candidates('book', keep.pk, duplicate.pk)
+        duplicate.delete()
+        deletion.invalidate(affected_paths([keep.author_id, duplicate.author_id], book_ids))
+
+
+def affected_paths(author_ids, book_ids):
+    """Returns the pre-rendered pages of the authors and books a merge changed, and the lists showing them"""
+    if not prerender.is_enabled():
+        return set()
+    paths = {reverse('authors'), reverse('books')}
+    paths.update(reverse('author-detail', args=[pk]) for pk in author_ids if pk)
+    paths.update(reverse('book-detail', args=[pk]) for pk in book_ids)
+    return paths
+
+
+def forget_candidates(model, keep_id, duplicate_id):
+    """Marks the pair as merged; other pending pairs with the duplicate are found again with the record kept"""
+    first_id, second_id = sorted((keep_id, duplicate_id))
+    candidates = DuplicateCandidate.objects.filter(model=model)
+    candidates.filter(first_id=first_id, second_id=second_id).update(status='m')
+    (candidates.filter(status='p')
+     .filter(Q(first_id=duplicate_id) | Q(second_id=duplicate_id))
+     .delete())
+
+
+def merge(candidate, keep_id):
+    """Merges the two records of a duplicate candidate, keeping the one with keep_id"""
+    model = MODELS[candidate.model]
+    if keep_id not in (candidate.first_id, candidate.second_id):
+        raise ValueError(f'{keep_id} is not one of the records of {candidate}')
+    duplicate_id = candidate.second_id if keep_id == candidate.first_id else candidate.first_id
+    keep, duplicate = model.objects.get(pk=keep_id), model.objects.get(pk=duplicate_id)
+    if candidate.model == 'author':
+        merge_authors(keep, duplicate)
+    else:
+        merge_books(keep, duplicate)
@@ -0,0 +1,79 @@
+"""Prometheus metrics of the web processes, exposed at /metrics.
+
+Gunicorn forks several worker processes, each with its own counters. When the
+prometheus_multiproc_dir environment variable names a directory (gunicorn.conf.py
+sets it up), every worker writes its metrics to memory-mapped files there and
+render() adds up the files of all workers, so a scrape sees the whole site
+whichever worker answers it. Without it, as under runserver, the metrics of
+the current process are exposed.
+
+MetricsMiddleware (see catalog.middleware) records the latency, response size
+and database work of every request, labeled by URL name.
+"""
+import os
+import time
+from functools import lru_cache
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client import multiprocess
+
+REQUEST_LATENCY = Histogram('catalog_request_latency_seconds', 'Time taken to respond to requests', ['view'])
+RESPONSE_SIZE = Histogram('catalog_response_size_bytes', 'Size of response bodies', ['view'],
+                          buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304))
+DB_QUERIES = Counter('catalog_db_queries', 'Database queries run by requests', ['view'])
+DB_QUERY_SECONDS = Counter('catalog_db_query_seconds', 'Time requests spent running database queries', ['view'])
+
+# Hit ratio of the data cached by the application, e.g. cache="facets" and result="hit" or "miss"
+CACHE_LOOKUPS = Counter('catalog_cache_lookups', 'Lookups of cached data', ['cache', 'result'])
+
+LOANS = Counter('catalog_loans', 'Copies lent out')
+RETURNS = Counter('catalog_returns', 'Copies returned')
+RENEWALS = Counter('catalog_renewals', 'Loans renewed')
+
+
+@lru_cache(maxsize=None)
+def view_metrics(view):
+    """Returns the metrics of a URL name; looking labels up once keeps recording a request cheap"""
+    return (REQUEST_LATENCY.labels(view), RESPONSE_SIZE.labels(view),
+            DB_QUERIES.labels(view), DB_QUERY_SECONDS.labels(view))
+
+
+def cache_lookup(cache, hit):
+    CACHE_LOOKUPS.labels(cache, 'hit' if hit else 'miss').inc()
+
+
+class QueryTimer:
+    """Database execute wrapper counting the queries of a request and the time they take"""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += time.perf_counter() - start
+
+
+def observe_request(view, seconds, size, queries):
+    """Records a request; size is None for streaming responses"""
+    latency, response_size, db_queries, db_query_seconds = view_metrics(view)
+    latency.observe(seconds)
+    if size is not None:
+        response_size.observe(size)
+    if queries.count:
+        db_queries.inc(queries.count)
+        db_query_seconds.inc(queries.seconds)
+
+
+def render():
+    """Returns the metrics of every worker process in the Prometheus text format, and its content type"""
+    if 'prometheus_multiproc_dir' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
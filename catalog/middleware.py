@@ -0,0 +1,193 @@
+import math
+import os
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.http import FileResponse, HttpResponse
+from django.urls import Resolver404, resolve
+from django.utils.cache import patch_vary_headers
+
+from . import metrics, prerender, profiling
+
+
+class MetricsMiddleware:
+    """Records the latency, response size and database queries of every request (see catalog.metrics).
+
+    Placed before PrerenderedPageMiddleware, so pre-rendered pages are counted
+    under the URL name of the view they stand in for.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        queries = metrics.QueryTimer()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(queries))
+            response = self.get_response(request)
+        if response.streaming:
+            size = int(response['Content-Length']) if response.has_header('Content-Length') else None
+        else:
+            size = len(response.content)
+        metrics.observe_request(self.view_name(request), time.perf_counter() - start, size, queries)
+        return response
+
+    def view_name(self, request):
+        match = getattr(request, 'resolver_match', None)
+        if match is None:
+            # Requests answered before URL resolution, such as pre-rendered pages
+            try:
+                match = resolve(request.path_info)
+            except Resolver404:
+                return 'unresolved'
+        return match.url_name or 'unnamed'
+
+
+class PrerenderedPageMiddleware:
+    """Serves pages written by the prerender_catalog command to anonymous visitors.
+
+    Placed before SessionMiddleware, so anonymous requests for pre-rendered
+    pages never reach the session, authentication or the views. Requests that
+    carry a session cookie or any query parameter other than page go through
+    to Django as usual. Only logging in creates a session: pages that anonymous
+    visitors see keep their state in cookies of their own (see views.index).
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.serve(request)
+        return response if response is not None else self.get_response(request)
+
+    def serve(self, request):
+        root = getattr(settings, 'PRERENDER_ROOT', None)
+        if not root or request.method not in ('GET', 'HEAD') or settings.SESSION_COOKIE_NAME in request.COOKIES:
+            return None
+
+        page = request.GET.get('page', '1')
+        # int() would also accept digits other than 0-9, such as '²', and fail on them
+        if set(request.GET) - {'page'} or not (page.isascii() and page.isdigit()):
+            return None
+        filename = prerender.page_file(root, request.path_info, int(page))
+        if filename is None or not os.path.isfile(filename):
+            return None
+
+        encoding = None
+        accepted = request.META.get('HTTP_ACCEPT_ENCODING', '')
+        for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if candidate in accepted and os.path.isfile(filename + suffix):
+                encoding, filename = candidate, filename + suffix
+                break
+
+        response = FileResponse(open(filename, 'rb'), content_type='text/html; charset=utf-8')
+        if encoding:
+            response['Content-Encoding'] = encoding
+        patch_vary_headers(response, ('Accept-Encoding', 'Cookie'))
+        return response
+
+
+class ProfilingMiddleware:
+    """Runs a sampling profiler during the requests chosen by catalog.profiling.should_profile().
+
+    Placed after AuthenticationMiddleware, which staff-only profiling needs.
+    Sampling starts before the view is called and stops once the response,
+    including any template, has been rendered.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        sampler = getattr(request, 'profile_sampler', None)
+        if sampler is not None:
+            profiling.record(request.resolver_match.url_name or 'unnamed', sampler.stop())
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if profiling.should_profile(request):
+            request.profile_sampler = profiling.Sampler().start()
+
+
+class ThrottleMiddleware:
+    """Limits how often each client may request the URLs named in settings.THROTTLE_RATES.
+
+    Every client (a logged-in user, or the IP address of an anonymous visitor)
+    gets a token bucket per URL name, holding up to `requests` tokens that
+    refill at `requests` per `seconds`. A bucket is two cache keys: the time
+    it was last full and the number of tokens taken since, which is increased
+    with the cache's atomic incr. Requests finding the bucket empty get a 429
+    response with a Retry-After header, before the view runs.
+
+    To keep the common path at one incr and one get, an idle bucket is only
+    reset once a whole bucket's worth of unused tokens has built up, so a
+    client returning after a pause may briefly burst up to twice `requests`.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        rates = getattr(settings, 'THROTTLE_RATES', {}).get(request.resolver_match.url_name)
+        if not rates:
+            return None
+
+        if request.user.is_authenticated:
+            rate, client = rates.get('user'), f'user:{request.user.pk}'
+        else:
+            rate, client = rates.get('anon'), f'ip:{client_ip(request)}'
+        if rate is None:
+            return None
+
+        retry_after = take_token(f'throttle:{request.resolver_match.url_name}:{client}', *rate)
+        if retry_after is None:
+            return None
+        response = HttpResponse('Too many requests, please slow down.', status=429, content_type='text/plain')
+        response['Retry-After'] = math.ceil(retry_after)
+        return response
+
+
+def client_ip(request):
+    """Returns the client's IP address, skipping THROTTLE_PROXY_COUNT trusted proxies"""
+    proxies = getattr(settings, 'THROTTLE_PROXY_COUNT', 0)
+    if proxies:
+        forwarded = request.META.get('HTTP_X_FORWARDED_FOR', '').split(',')
+        if len(forwarded) >= proxies:
+            return forwarded[-proxies].strip()
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def take_token(key, capacity, seconds):
+    """Takes a token from a bucket; returns None, or the seconds until a token is available"""
+    now = time.time()
+    try:
+        taken = cache.incr(key)
+    except ValueError:
+        # New (or expired) bucket: it starts full
+        timeout = max(seconds * 10, 60)
+        cache.add(key + ':since', now, timeout)
+        cache.add(key, 0, timeout)
+        taken = cache.incr(key)
+    since = cache.get(key + ':since', now)
+
+    rate = capacity / seconds
+    refilled = (now - since) * rate
+    if refilled >= taken + capacity:
+        # A whole bucket of unused tokens has built up; restart counting so they do not pile up further
+        cache.set_many({key + ':since': now, key: 1}, max(seconds * 10, 60))
+        return None
+    missing = taken - refilled - capacity
+    if missing <= 0:
+        return None
+    # Rejected requests do not use up tokens
+    cache.decr(key)
+    return missing / rate
@@ -0,0 +1,94 @@
+# Generated by Django 2.2.28 on 2026-10-19 07:43
+
+import datetime
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('catalog', '0004_auto_20180806_0051'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CirculationSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('on_loan', models.PositiveIntegerField(default=0)),
+                ('overdue', models.PositiveIntegerField(default=0)),
+                ('returned_loans', models.PositiveIntegerField(default=0)),
+                ('total_loan_days', models.PositiveIntegerField(default=0)),
+                ('last_loan_id', models.PositiveIntegerField(default=0)),
+                ('refreshed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='author',
+            name='date_of_death',
+            field=models.DateField(blank=True, null=True, verbose_name='died'),
+        ),
+        migrations.AlterField(
+            model_name='bookinstance',
+            name='status',
+            field=models.CharField(blank=True, choices=[('m', 'Maintenance'), ('o', 'On loan'), ('a', 'Available'), ('r', 'Reserved')], db_index=True, default='m', help_text='Book availability', max_length=1),
+        ),
+        migrations.CreateModel(
+            name='Loan',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('loaned_on', models.DateField(default=datetime.date.today)),
+                ('returned_on', models.DateField(blank=True, null=True)),
+                ('duration_recorded', models.BooleanField(db_index=True, default=False)),
+                ('book', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='catalog.Book')),
+                ('book_instance', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='catalog.BookInstance')),
+                ('borrower', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-loaned_on'],
+            },
+        ),
+        migrations.CreateModel(
+            name='GenreLoanStat',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(help_text='First day of the month')),
+                ('loans', models.PositiveIntegerField(default=0)),
+                ('genre', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='catalog.Genre')),
+            ],
+            options={
+                'ordering': ['-month', '-loans'],
+            },
+        ),
+        migrations.CreateModel(
+            name='BookLoanStat',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(help_text='First day of the month')),
+                ('loans', models.PositiveIntegerField(default=0)),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='catalog.Book')),
+            ],
+            options={
+                'ordering': ['-month', '-loans'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='genreloanstat',
+            index=models.Index(fields=['month', '-loans'], name='catalog_gen_month_5a1890_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='genreloanstat',
+            unique_together={('genre', 'month')},
+        ),
+        migrations.AddIndex(
+            model_name='bookloanstat',
+            index=models.Index(fields=['month', '-loans'], name='catalog_boo_month_9990ad_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='bookloanstat',
+            unique_together={('book', 'month')},
+        ),
+    ]
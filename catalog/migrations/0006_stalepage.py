@@ -0,0 +1,21 @@
+# Generated by Django 2.2.28 on 2026-10-19 07:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0005_circulation_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StalePage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=200, unique=True)),
+                ('marked_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 2.2.28 on 2026-10-19 07:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0006_stalepage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeletionJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(choices=[('author', 'Author'), ('book', 'Book')], max_length=20)),
+                ('object_id', models.PositiveIntegerField()),
+                ('object_repr', models.CharField(max_length=200)),
+                ('total', models.PositiveIntegerField(default=0, help_text='Dependent rows when the deletion was requested')),
+                ('processed', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['created_at'],
+            },
+        ),
+        migrations.AddField(
+            model_name='author',
+            name='deleted',
+            field=models.BooleanField(db_index=True, default=False, editable=False),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='deleted',
+            field=models.BooleanField(db_index=True, default=False, editable=False),
+        ),
+    ]
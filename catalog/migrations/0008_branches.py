@@ -0,0 +1,48 @@
+# Generated by Django 2.2.28 on 2026-10-19 07:50
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0007_deferred_deletion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Branch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('slug', models.SlugField(unique=True)),
+                ('database', models.CharField(default='default', help_text='Database alias storing the copies and loans of this branch', max_length=100)),
+            ],
+            options={
+                'verbose_name_plural': 'branches',
+                'ordering': ['name'],
+            },
+        ),
+        migrations.AlterField(
+            model_name='bookinstance',
+            name='book',
+            field=models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to='catalog.Book'),
+        ),
+        migrations.AlterField(
+            model_name='bookinstance',
+            name='borrower',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='loan',
+            name='book_instance',
+            field=models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to='catalog.BookInstance'),
+        ),
+        migrations.AddField(
+            model_name='bookinstance',
+            name='branch',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to='catalog.Branch'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 2.2.28 on 2026-10-19 07:53
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0008_branches'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecommendationBuild',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('built_at', models.DateTimeField(auto_now_add=True)),
+                ('full', models.BooleanField(default=True)),
+                ('last_loan_id', models.PositiveIntegerField(help_text='Highest Loan id included in the build')),
+                ('loans', models.PositiveIntegerField()),
+                ('books', models.PositiveIntegerField(help_text='Books whose recommendations were computed')),
+                ('seconds', models.FloatField()),
+                ('peak_memory_kb', models.PositiveIntegerField()),
+            ],
+            options={
+                'ordering': ['-built_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='BookRecommendation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rank', models.PositiveSmallIntegerField()),
+                ('score', models.FloatField(help_text="Cosine similarity of the two books' borrowers")),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recommendations', to='catalog.Book')),
+                ('recommended', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='catalog.Book')),
+            ],
+            options={
+                'ordering': ['book', 'rank'],
+                'unique_together': {('book', 'rank')},
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-19 07:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0009_recommendations'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='cover',
+            field=models.ImageField(blank=True, help_text='Image of the front cover', upload_to='covers/'),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='cover_hash',
+            field=models.CharField(blank=True, editable=False, max_length=16),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 2.2.28 on 2026-10-19 08:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0011_versions'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='genre',
+            name='name',
+            field=models.CharField(db_index=True, help_text='Enter a book genre (e.g. Science Fiction)', max_length=200),
+        ),
+        migrations.AddIndex(
+            model_name='author',
+            index=models.Index(fields=['deleted', 'last_name', 'first_name'], name='catalog_aut_deleted_031bda_idx'),
+        ),
+    ]
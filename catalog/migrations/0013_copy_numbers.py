@@ -0,0 +1,74 @@
+"""Numbers existing copies, first step of moving copies from UUID to copy number keys.
+
+Copy numbers come from CopyNumber in the default database, and loans (also in
+the default database) remember the number of their copy. With branch databases,
+run "migrate catalog 0013" on the default database, then on every branch
+database, before migrating any of them further: 0014 replaces the UUID keys.
+"""
+from django.db import DEFAULT_DB_ALIAS, migrations, models, transaction
+from django.db.models import Case, OuterRef, Subquery, Value, When
+
+BATCH_SIZE = 250
+
+
+def number_copies(apps, schema_editor):
+    database = schema_editor.connection.alias
+    BookInstance = apps.get_model('catalog', 'BookInstance')
+    CopyNumber = apps.get_model('catalog', 'CopyNumber')
+    Loan = apps.get_model('catalog', 'Loan')
+
+    copies = BookInstance.objects.using(database).filter(number__isnull=True).order_by('book_id', 'id')
+    loans = Loan.objects.using(DEFAULT_DB_ALIAS).filter(copy_number__isnull=True)
+    with transaction.atomic(using=DEFAULT_DB_ALIAS), transaction.atomic(using=database):
+        # Numbered copies drop out of the queryset, so each batch takes the next ones
+        while True:
+            uuids = list(copies.values_list('id', flat=True)[:BATCH_SIZE])
+            if not uuids:
+                break
+            numbers = [number.id for number in CopyNumber.objects.using(DEFAULT_DB_ALIAS).bulk_create(
+                CopyNumber(database=database) for _ in uuids)]
+            if None in numbers:
+                # The backend does not return inserted ids; nothing else hands out numbers during the migration
+                numbers = sorted(CopyNumber.objects.using(DEFAULT_DB_ALIAS)
+                                 .order_by('-id').values_list('id', flat=True)[:len(uuids)])
+            by_uuid = Case(*(When(id=uuid, then=Value(number)) for uuid, number in zip(uuids, numbers)),
+                           output_field=models.BigIntegerField())
+            BookInstance.objects.using(database).filter(id__in=uuids).update(number=by_uuid)
+            if database != DEFAULT_DB_ALIAS:
+                by_copy = Case(*(When(book_instance_id=uuid, then=Value(number))
+                                 for uuid, number in zip(uuids, numbers)), output_field=models.BigIntegerField())
+                loans.filter(book_instance_id__in=uuids).update(copy_number=by_copy)
+
+        if database == DEFAULT_DB_ALIAS:
+            # Loans of copies in the same database take their numbers in one UPDATE joined to the copies
+            copies = BookInstance.objects.using(database)
+            loans.filter(book_instance_id__in=copies.values('id')).update(copy_number=Subquery(
+                copies.filter(id=OuterRef('book_instance_id')).values('number')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0012_name_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CopyNumber',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('database', models.CharField(default='default', help_text='Database alias storing the copy', max_length=100)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='bookinstance',
+            name='number',
+            field=models.BigIntegerField(null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='loan',
+            name='copy_number',
+            field=models.BigIntegerField(db_index=True, null=True),
+        ),
+        migrations.RunPython(number_copies, migrations.RunPython.noop),
+    ]
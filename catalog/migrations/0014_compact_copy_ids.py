@@ -0,0 +1,71 @@
+"""Keys copies by their copy number, keeping their UUID for old links (run 0013 on every database first).
+
+The copies are copied into a new table, as primary keys cannot be changed in
+place on every database, and loans switch to the copy numbers 0013 stored.
+"""
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def copy_copies(apps, schema_editor):
+    old = apps.get_model('catalog', 'BookInstance')._meta
+    new = apps.get_model('catalog', 'CompactBookInstance')._meta
+    quote = schema_editor.quote_name
+    columns = {'id': 'number', 'uuid': 'id'}
+    columns.update((name, name) for name in ('version', 'book_id', 'branch_id', 'imprint', 'due_back',
+                                             'borrower_id', 'status'))
+    schema_editor.execute('INSERT INTO {} ({}) SELECT {} FROM {}'.format(
+        quote(new.db_table), ', '.join(map(quote, columns)), ', '.join(map(quote, columns.values())),
+        quote(old.db_table)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('catalog', '0013_copy_numbers'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='loan',
+            name='book_instance',
+        ),
+        migrations.CreateModel(
+            name='CompactBookInstance',
+            fields=[
+                ('version', models.PositiveIntegerField(default=0, editable=False)),
+                ('id', models.BigIntegerField(editable=False, help_text='Copy number, unique across branches', primary_key=True, serialize=False)),
+                ('uuid', models.UUIDField(blank=True, editable=False, help_text='ID of copies catalogued before copy numbers, still accepted in URLs', null=True, unique=True)),
+                ('imprint', models.CharField(max_length=200)),
+                ('due_back', models.DateField(blank=True, null=True)),
+                ('status', models.CharField(blank=True, choices=[('m', 'Maintenance'), ('o', 'On loan'), ('a', 'Available'), ('r', 'Reserved')], db_index=True, default='m', help_text='Book availability', max_length=1)),
+                ('book', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to='catalog.Book')),
+                ('borrower', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+                ('branch', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to='catalog.Branch')),
+            ],
+            options={
+                'ordering': ['due_back'],
+                'permissions': (('can_mark_returned', 'Set book as returned'),),
+            },
+        ),
+        migrations.RunPython(copy_copies),
+        migrations.DeleteModel(
+            name='BookInstance',
+        ),
+        migrations.RenameModel(
+            old_name='CompactBookInstance',
+            new_name='BookInstance',
+        ),
+        migrations.RenameField(
+            model_name='loan',
+            old_name='copy_number',
+            new_name='book_instance',
+        ),
+        migrations.AlterField(
+            model_name='loan',
+            name='book_instance',
+            field=models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to='catalog.BookInstance'),
+        ),
+    ]
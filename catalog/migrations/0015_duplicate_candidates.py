@@ -0,0 +1,29 @@
+# Generated by Django 2.2.28 on 2026-10-19 08:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0014_compact_copy_ids'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DuplicateCandidate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(choices=[('author', 'Author'), ('book', 'Book')], max_length=20)),
+                ('first_id', models.PositiveIntegerField(help_text='The lower of the two ids')),
+                ('second_id', models.PositiveIntegerField()),
+                ('score', models.FloatField(help_text='Similarity of the two records, from 0 to 1')),
+                ('status', models.CharField(choices=[('p', 'Pending'), ('m', 'Merged'), ('d', 'Not duplicates')], db_index=True, default='p', max_length=1)),
+                ('found_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['-score', 'id'],
+                'unique_together': {('model', 'first_id', 'second_id')},
+            },
+        ),
+    ]
@@ -0,0 +1,43 @@
+"""Marks the loans already counted in the monthly loan statistics, instead of keeping the highest counted id.
+
+Loan ids are allocated when a loan is inserted but become visible when its
+transaction commits, so a loan can appear after one with a higher id was
+already counted, and a highest-id mark would skip it for good.
+"""
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def mark_recorded_loans(apps, schema_editor):
+    db = schema_editor.connection.alias
+    summary = apps.get_model('catalog', 'CirculationSummary').objects.using(db).filter(pk=1).first()
+    if summary is not None:
+        apps.get_model('catalog', 'Loan').objects.using(db).filter(id__lte=summary.last_loan_id).update(
+            loan_recorded=True)
+
+
+def store_last_loan_id(apps, schema_editor):
+    db = schema_editor.connection.alias
+    Loan = apps.get_model('catalog', 'Loan')
+    last_loan_id = Loan.objects.using(db).filter(loan_recorded=True).aggregate(last=Max('id'))['last'] or 0
+    apps.get_model('catalog', 'CirculationSummary').objects.using(db).filter(pk=1).update(last_loan_id=last_loan_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0015_duplicate_candidates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='loan',
+            name='loan_recorded',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.RunPython(mark_recorded_loans, store_last_loan_id),
+        migrations.RemoveField(
+            model_name='circulationsummary',
+            name='last_loan_id',
+        ),
+    ]
@@ -0,0 +1,48 @@
+"""Marks the loans already included in a recommendation build, instead of keeping the highest included id.
+
+A loan can become visible after one with a higher id was already included (see
+0016), and a highest-id mark would never recompute its borrower's books.
+"""
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def mark_included_loans(apps, schema_editor):
+    db = schema_editor.connection.alias
+    build = apps.get_model('catalog', 'RecommendationBuild').objects.using(db).order_by('-built_at').first()
+    if build is not None:
+        apps.get_model('catalog', 'Loan').objects.using(db).filter(id__lte=build.last_loan_id).update(
+            in_recommendations=True)
+
+
+def store_last_loan_id(apps, schema_editor):
+    db = schema_editor.connection.alias
+    Loan = apps.get_model('catalog', 'Loan')
+    last_loan_id = Loan.objects.using(db).filter(in_recommendations=True).aggregate(last=Max('id'))['last'] or 0
+    apps.get_model('catalog', 'RecommendationBuild').objects.using(db).update(last_loan_id=last_loan_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0016_loan_recorded'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='loan',
+            name='in_recommendations',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.RunPython(mark_included_loans, store_last_loan_id),
+        # With a default, the field can be added back to existing builds when unapplying
+        migrations.AlterField(
+            model_name='recommendationbuild',
+            name='last_loan_id',
+            field=models.PositiveIntegerField(default=0, help_text='Highest Loan id included in the build'),
+        ),
+        migrations.RemoveField(
+            model_name='recommendationbuild',
+            name='last_loan_id',
+        ),
+    ]
@@ -0,0 +1,67 @@
+"""Adds case-folded copies of the author and genre names for the autocomplete search.
+
+Django cannot index an expression such as LOWER(name), and SQL's LOWER does not
+fold case the way Python does outside ASCII, so the names are folded in Python
+and stored alongside. Existing rows are filled in with one UPDATE per batch.
+"""
+from django.db import migrations, models
+from django.db.models import Case, Value, When
+
+BATCH_SIZE = 500
+
+
+def fold_names(apps, schema_editor):
+    db = schema_editor.connection.alias
+    for model_name, fields in (('Author', ('last_name', 'first_name')), ('Genre', ('name',))):
+        model = apps.get_model('catalog', model_name)
+        rows = model._base_manager.using(db).order_by('pk').values_list('pk', *fields)
+        last_pk = 0
+        while True:
+            batch = list(rows.filter(pk__gt=last_pk)[:BATCH_SIZE])
+            if not batch:
+                break
+            last_pk = batch[-1][0]
+            model._base_manager.using(db).filter(pk__in=[row[0] for row in batch]).update(**{
+                f'{field}_folded': Case(*(When(pk=row[0], then=Value(row[index + 1].casefold())) for row in batch),
+                                        output_field=models.CharField())
+                for index, field in enumerate(fields)
+            })
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0017_in_recommendations'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='author',
+            name='first_name_folded',
+            field=models.CharField(default='', editable=False, max_length=100),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='author',
+            name='last_name_folded',
+            field=models.CharField(default='', editable=False, max_length=100),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='genre',
+            name='name_folded',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=200),
+            preserve_default=False,
+        ),
+        migrations.AlterField(
+            model_name='genre',
+            name='name',
+            field=models.CharField(help_text='Enter a book genre (e.g. Science Fiction)', max_length=200),
+        ),
+        migrations.AddIndex(
+            model_name='author',
+            index=models.Index(fields=['deleted', 'last_name_folded', 'first_name_folded'],
+                               name='catalog_aut_deleted_61817a_idx'),
+        ),
+        migrations.RunPython(fold_names, migrations.RunPython.noop),
+    ]
@@ -1,19 +1,29 @@
-import uuid
-
 from django.contrib.auth.models import User
-from django.db import models
+from django.core.files.storage import default_storage
+from django.db import models, router, transaction
+from django.db.models.fields.related_descriptors import ForwardManyToOneDescriptor
 from django.urls import reverse
 from datetime import date
 
+from . import copycodes
+
 
 class Genre(models.Model):
     """Model representing a book genre"""
     name = models.CharField(max_length=200, help_text='Enter a book genre (e.g. Science Fiction)')
+    # Case-folded name, so the autocomplete search ignores case and still scans an index
+    name_folded = models.CharField(max_length=200, db_index=True, editable=False)
 
     def __str__(self):
         """String for representing the genre object"""
         return self.name
 
+    def save(self, *args, **kwargs):
+        self.name_folded = self.name.casefold()
+        if kwargs.get('update_fields') is not None and 'name' in kwargs['update_fields']:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'name_folded'}
+        super().save(*args, **kwargs)
+
 
 class Language(models.Model):
     """Model representing a book's natural language"""
@@ -24,15 +34,131 @@ class Language(models.Model):
         return self.name
 
 
-class Author(models.Model):
+class ReferenceDescriptor(ForwardManyToOneDescriptor):
+    """Reads the related genre or language from the reference data cache instead of querying it"""
+
+    def __get__(self, instance, cls=None):
+        if instance is not None and not self.field.is_cached(instance):
+            from . import refdata
+            pk = getattr(instance, self.field.attname)
+            related = refdata.get(self.field.related_model, pk) if pk is not None else None
+            if related is not None:
+                self.field.set_cached_value(instance, related)
+        return super().__get__(instance, cls)
+
+
+class ReferenceForeignKey(models.ForeignKey):
+    """Foreign key to a genre or language, served from the process-local cache in catalog.refdata"""
+    forward_related_accessor_class = ReferenceDescriptor
+
+    def deconstruct(self):
+        # Migrations see a plain foreign key; the difference is only in how it is read
+        name, path, args, kwargs = super().deconstruct()
+        return name, 'django.db.models.ForeignKey', args, kwargs
+
+
+class ConcurrentUpdateError(Exception):
+    """Raised when saving a record that someone else changed (or deleted) since it was loaded"""
+
+
+class VersionedModel(models.Model):
+    """Abstract model saved with optimistic concurrency control.
+
+    Updates only write the fields that changed since the record was loaded, and
+    only if its version is still the one that was loaded (compare-and-swap), so
+    two people editing the same record can never silently overwrite each other
+    and no row locks are taken. Set version to the value a form was rendered
+    with to detect changes made while the form was being filled in.
+    """
+    version = models.PositiveIntegerField(default=0, editable=False)
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._remember_values()
+        return instance
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        self._remember_values()
+
+    def _remember_values(self):
+        deferred = self.get_deferred_fields()
+        self._loaded_values = {field.attname: field.get_prep_value(getattr(self, field.attname))
+                               for field in self._meta.concrete_fields if field.attname not in deferred}
+
+    def changed_fields(self):
+        """Returns the names of the fields modified since the record was loaded or saved"""
+        loaded = getattr(self, '_loaded_values', {})
+        return [field.name for field in self._meta.concrete_fields
+                if field.attname in loaded and field.attname not in (self._meta.pk.attname, 'version')
+                and field.get_prep_value(getattr(self, field.attname)) != loaded[field.attname]]
+
+    def save(self, *args, **kwargs):
+        if self._state.adding or kwargs.get('force_insert') or not hasattr(self, '_loaded_values'):
+            super().save(*args, **kwargs)
+        else:
+            update_fields = kwargs.get('update_fields')
+            if update_fields is None:
+                update_fields = self.changed_fields()
+                if not update_fields:
+                    return
+            kwargs['update_fields'] = {*update_fields, 'version'}
+
+            # A savepoint keeps a conflict from breaking the surrounding transaction
+            using = kwargs.get('using') or router.db_for_write(type(self), instance=self)
+            self._expected_version = self.version
+            self.version += 1
+            try:
+                with transaction.atomic(using=using):
+                    super().save(*args, **kwargs)
+            except Exception:
+                self.version = self._expected_version
+                raise
+            finally:
+                del self._expected_version
+        self._remember_values()
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        expected_version = getattr(self, '_expected_version', None)
+        if expected_version is None:
+            return super()._do_update(base_qs, using, pk_val, values, update_fields, forced_update)
+        if not super()._do_update(base_qs.filter(version=expected_version), using, pk_val, values,
+                                  update_fields, forced_update):
+            raise ConcurrentUpdateError(f'{self._meta.verbose_name} {pk_val} was changed or deleted by someone else')
+        return True
+
+
+class VisibleManager(models.Manager):
+    """Manager leaving out records hidden while they wait for deferred deletion"""
+
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted=False)
+
+
+class Author(VersionedModel):
     """Model representing an author"""
     first_name = models.CharField(max_length=100)
     last_name = models.CharField(max_length=100)
     date_of_birth = models.DateField(null=True, blank=True)
     date_of_death = models.DateField('died', null=True, blank=True)
+    deleted = models.BooleanField(default=False, editable=False, db_index=True)
+
+    # Case-folded names, so the autocomplete search ignores case and still scans an index
+    last_name_folded = models.CharField(max_length=100, editable=False)
+    first_name_folded = models.CharField(max_length=100, editable=False)
+
+    objects = VisibleManager()
+    all_objects = models.Manager()
 
     class Meta:
         ordering = ['last_name', 'first_name']
+        # Serve the author list and the autocomplete search, which only look at visible authors
+        indexes = [models.Index(fields=['deleted', 'last_name', 'first_name']),
+                   models.Index(fields=['deleted', 'last_name_folded', 'first_name_folded'])]
 
     def get_absolute_url(self):
         """Returns the URL to access a specific author"""
@@ -42,38 +168,135 @@ class Author(models.Model):
         """String for representing the author object"""
         return f'{self.last_name}, {self.first_name}'
 
+    def save(self, *args, **kwargs):
+        self.last_name_folded, self.first_name_folded = self.last_name.casefold(), self.first_name.casefold()
+        if kwargs.get('update_fields') is not None:
+            changed = {'last_name', 'first_name'}.intersection(kwargs['update_fields'])
+            kwargs['update_fields'] = {*kwargs['update_fields'], *(f'{name}_folded' for name in changed)}
+        super().save(*args, **kwargs)
+
 
-class Book(models.Model):
+class Book(VersionedModel):
     """Model representing a book definition (but not an actual copy of a book)"""
     title = models.CharField(max_length=200)
     author = models.ForeignKey(Author, on_delete=models.SET_NULL, null=True)
     summary = models.TextField(max_length=1000, help_text='Enter a brief description of the book')
     isbn = models.CharField('ISBN', max_length=13, help_text='13 Character ISBN number')
     genre = models.ManyToManyField(Genre, help_text="Select a genre for this book")
-    language = models.ForeignKey(Language, on_delete=models.SET_NULL, null=True)
+    language = ReferenceForeignKey(Language, on_delete=models.SET_NULL, null=True)
+    cover = models.ImageField(upload_to='covers/', blank=True, help_text='Image of the front cover')
+    deleted = models.BooleanField(default=False, editable=False, db_index=True)
+
+    # Content hash naming the cover thumbnails; empty until catalog.covers has made them
+    cover_hash = models.CharField(max_length=16, blank=True, editable=False)
+
+    objects = VisibleManager()
+    all_objects = models.Manager()
+
+    COVER_WIDTHS = (160, 320, 640)
 
     def __str__(self):
         """String for representing the book object"""
         return self.title
 
+    def save(self, *args, **kwargs):
+        # Thumbnails of a replaced or removed cover are hidden until catalog.covers makes new ones
+        self._cover_uploaded = bool(self.cover) and not self.cover._committed
+        if (self._cover_uploaded or not self.cover) and self.cover_hash:
+            self.cover_hash = ''
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = {*kwargs['update_fields'], 'cover_hash'}
+        super().save(*args, **kwargs)
+
     def get_absolute_url(self):
         """Returns the URL to access a detailed record for this book"""
         return reverse('book-detail', args=[str(self.id)])
 
+    def get_genres(self):
+        """Returns the genres of the book, taken from the reference data cache"""
+        if 'genre' in getattr(self, '_prefetched_objects_cache', {}):
+            return list(self.genre.all())
+        from . import refdata
+        if not hasattr(self, '_genre_ids'):
+            refdata.attach_genre_ids([self])
+        genres = refdata.objects(Genre)
+        return [genres[pk] for pk in self._genre_ids if pk in genres]
+
     def display_genre(self):
-        """Returns a genre string (required for the admin panel); note, this query is expensive!"""
-        return ', '.join(genre.name for genre in self.genre.all()[:3])
+        """Returns a genre string (required for the admin panel)"""
+        return ', '.join(genre.name for genre in self.get_genres()[:3])
 
     display_genre.short_description = 'Genre'
 
+    def cover_thumbnail_name(self, width, extension):
+        """Returns the storage name of a cover thumbnail (it never changes, so it can be cached forever)"""
+        return f'covers/thumbs/{self.cover_hash}-{width}.{extension}'
+
+    def cover_srcset(self, extension):
+        return ', '.join(f'{default_storage.url(self.cover_thumbnail_name(width, extension))} {width}w'
+                         for width in self.COVER_WIDTHS)
+
+    @property
+    def cover_webp_srcset(self):
+        return self.cover_srcset('webp')
+
+    @property
+    def cover_jpeg_srcset(self):
+        return self.cover_srcset('jpg')
+
+    @property
+    def cover_thumbnail_url(self):
+        return default_storage.url(self.cover_thumbnail_name(self.COVER_WIDTHS[0], 'jpg'))
+
+
+class Branch(models.Model):
+    """Model representing a physical library branch holding copies of books"""
+    name = models.CharField(max_length=100)
+    slug = models.SlugField(unique=True)
+    database = models.CharField(max_length=100, default='default',
+                                help_text='Database alias storing the copies and loans of this branch')
+
+    class Meta:
+        ordering = ['name']
+        verbose_name_plural = 'branches'
+
+    def __str__(self):
+        """String for representing the branch object"""
+        return self.name
+
+
+class CopyNumber(models.Model):
+    """Model handing out copy numbers, kept in the default database so they are unique across branch databases"""
+    id = models.BigAutoField(primary_key=True)
+    database = models.CharField(max_length=100, default='default', help_text='Database alias storing the copy')
+
+    def __str__(self):
+        """String for representing the copy number object"""
+        return copycodes.encode(self.id)
+
 
-class BookInstance(models.Model):
+class BookInstanceQuerySet(models.QuerySet):
+
+    def create(self, **kwargs):
+        """Creates a copy in the database of its branch, unless a database was chosen with using()"""
+        obj = self.model(**kwargs)
+        obj.save(force_insert=True, using=self._db)
+        return obj
+
+
+class BookInstance(VersionedModel):
     """Model representing a copy of a book (i.e. that can be borrowed)"""
-    id = models.UUIDField(primary_key=True, default=uuid.uuid4, help_text='Unique in-library ID')
-    book = models.ForeignKey(Book, on_delete=models.SET_NULL, null=True)
+    # Numbered from CopyNumber on first save; the public copy code is derived from the number
+    id = models.BigIntegerField(primary_key=True, editable=False, help_text='Copy number, unique across branches')
+    uuid = models.UUIDField(null=True, blank=True, unique=True, editable=False,
+                            help_text='ID of copies catalogued before copy numbers, still accepted in URLs')
+
+    # Copies may live in a branch database, so references to shared tables have no database constraint
+    book = models.ForeignKey(Book, on_delete=models.SET_NULL, null=True, db_constraint=False)
+    branch = models.ForeignKey(Branch, on_delete=models.SET_NULL, null=True, blank=True, db_constraint=False)
     imprint = models.CharField(max_length=200)
     due_back = models.DateField(null=True, blank=True)
-    borrower = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    borrower = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, db_constraint=False)
 
     LOAN_STATUS = (
         ('m', 'Maintenance'),
@@ -87,17 +310,198 @@ class BookInstance(models.Model):
         choices=LOAN_STATUS,
         blank=True,
         default='m',
+        db_index=True,
         help_text='Book availability'
     )
 
+    objects = BookInstanceQuerySet.as_manager()
+
     class Meta:
         ordering = ['due_back']
         permissions = (('can_mark_returned', 'Set book as returned'),)
 
     def __str__(self):
         """String for representing the book instance object"""
-        return f'{self.id} ({self.book.title})'
+        return f'{self.code} ({self.book.title})'
+
+    def save(self, *args, **kwargs):
+        if self.id is None:
+            using = kwargs.get('using') or router.db_for_write(type(self), instance=self)
+            self.id = CopyNumber.objects.create(database=using).id
+            if not kwargs.get('force_update'):
+                # The number is new, so skip looking for a row to update
+                kwargs['force_insert'] = True
+        super().save(*args, **kwargs)
+
+    @property
+    def code(self):
+        """Short checksummed code printed on the copy's barcode and used in URLs"""
+        return copycodes.encode(self.id) if self.id is not None else ''
 
     @property
     def is_overdue(self):
         return self.due_back and date.today() > self.due_back
+
+
+class Loan(models.Model):
+    """Model recording a single loan of a book copy (used for circulation statistics)"""
+    # Loan history is kept in the default database, even for copies stored in a branch database
+    book_instance = models.ForeignKey(BookInstance, on_delete=models.SET_NULL, null=True, db_constraint=False)
+    book = models.ForeignKey(Book, on_delete=models.SET_NULL, null=True)
+    borrower = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    loaned_on = models.DateField(default=date.today)
+    returned_on = models.DateField(null=True, blank=True)
+
+    # Set once the loan has been added to the monthly loan statistics; loan ids do not commit in
+    # order, so a loan with a lower id than one already counted may still be new
+    loan_recorded = models.BooleanField(default=False, db_index=True)
+
+    # Set once the loan length has been added to the circulation summary
+    duration_recorded = models.BooleanField(default=False, db_index=True)
+
+    # Set once a recommendation build has included the loan
+    in_recommendations = models.BooleanField(default=False, db_index=True)
+
+    class Meta:
+        ordering = ['-loaned_on']
+
+    def __str__(self):
+        """String for representing the loan object"""
+        return f'{self.book} ({self.loaned_on})'
+
+
+class BookLoanStat(models.Model):
+    """Model holding the number of loans of a book in a given month"""
+    book = models.ForeignKey(Book, on_delete=models.CASCADE)
+    month = models.DateField(help_text='First day of the month')
+    loans = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('book', 'month')
+        ordering = ['-month', '-loans']
+        indexes = [models.Index(fields=['month', '-loans'])]
+
+
+class GenreLoanStat(models.Model):
+    """Model holding the number of loans of books of a genre in a given month"""
+    genre = models.ForeignKey(Genre, on_delete=models.CASCADE)
+    month = models.DateField(help_text='First day of the month')
+    loans = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('genre', 'month')
+        ordering = ['-month', '-loans']
+        indexes = [models.Index(fields=['month', '-loans'])]
+
+
+class CirculationSummary(models.Model):
+    """Model holding the precomputed circulation figures shown on the staff dashboard (single row)"""
+    on_loan = models.PositiveIntegerField(default=0)
+    overdue = models.PositiveIntegerField(default=0)
+    returned_loans = models.PositiveIntegerField(default=0)
+    total_loan_days = models.PositiveIntegerField(default=0)
+    refreshed_at = models.DateTimeField(null=True, blank=True)
+
+    @classmethod
+    def load(cls):
+        """Returns the summary row, creating it if needed"""
+        summary, _ = cls.objects.get_or_create(pk=1)
+        return summary
+
+    @property
+    def overdue_rate(self):
+        return self.overdue / self.on_loan if self.on_loan else 0
+
+    @property
+    def average_loan_days(self):
+        return self.total_loan_days / self.returned_loans if self.returned_loans else None
+
+
+class BookRecommendation(models.Model):
+    """Model holding a book often borrowed by the borrowers of another book"""
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='recommendations')
+    recommended = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='+')
+    rank = models.PositiveSmallIntegerField()
+    score = models.FloatField(help_text='Cosine similarity of the two books\' borrowers')
+
+    class Meta:
+        ordering = ['book', 'rank']
+        unique_together = ('book', 'rank')
+
+
+class RecommendationBuild(models.Model):
+    """Model recording a run of the build_recommendations command"""
+    built_at = models.DateTimeField(auto_now_add=True)
+    full = models.BooleanField(default=True)
+    loans = models.PositiveIntegerField()
+    books = models.PositiveIntegerField(help_text='Books whose recommendations were computed')
+    seconds = models.FloatField()
+    peak_memory_kb = models.PositiveIntegerField()
+
+    class Meta:
+        ordering = ['-built_at']
+
+
+class DeletionJob(models.Model):
+    """Model tracking the background deletion of a hidden author or book and its dependent rows"""
+    MODELS = (
+        ('author', 'Author'),
+        ('book', 'Book'),
+    )
+
+    model = models.CharField(max_length=20, choices=MODELS)
+    object_id = models.PositiveIntegerField()
+    object_repr = models.CharField(max_length=200)
+    total = models.PositiveIntegerField(default=0, help_text='Dependent rows when the deletion was requested')
+    processed = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['created_at']
+
+    def __str__(self):
+        """String for representing the deletion job object"""
+        return f'{self.get_model_display()}: {self.object_repr}'
+
+    @property
+    def progress(self):
+        if self.finished_at:
+            return 1
+        return min(self.processed / self.total, 1) if self.total else 0
+
+
+class DuplicateCandidate(models.Model):
+    """Model holding two authors or two books that may be the same, found by the find_duplicates command"""
+    MODELS = DeletionJob.MODELS
+
+    STATUS = (
+        ('p', 'Pending'),
+        ('m', 'Merged'),
+        ('d', 'Not duplicates'),
+    )
+
+    model = models.CharField(max_length=20, choices=MODELS)
+    first_id = models.PositiveIntegerField(help_text='The lower of the two ids')
+    second_id = models.PositiveIntegerField()
+    score = models.FloatField(help_text='Similarity of the two records, from 0 to 1')
+    status = models.CharField(max_length=1, choices=STATUS, default='p', db_index=True)
+    found_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-score', 'id']
+        unique_together = ('model', 'first_id', 'second_id')
+
+    def __str__(self):
+        """String for representing the duplicate candidate object"""
+        return f'{self.get_model_display()} {self.first_id} and {self.second_id} ({self.score:.2f})'
+
+
+class StalePage(models.Model):
+    """Model listing pre-rendered catalog pages that must be rendered again"""
+    path = models.CharField(max_length=200, unique=True)
+    marked_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        """String for representing the stale page object"""
+        return self.path
@@ -0,0 +1,219 @@
+"""Static pre-rendering of the public catalog pages.
+
+The book and author lists and detail pages look the same to every anonymous
+visitor, so the prerender_catalog command writes them to PRERENDER_ROOT as
+plain HTML files (with gzip and, when the brotli package is installed, brotli
+variants). PrerenderedPageMiddleware, or any web server, then serves those
+files to anonymous visitors without running the views.
+
+Signal handlers in catalog.signals record the pages affected by each change as
+StalePage rows, and the command re-renders just those pages. A change to a row
+of a list marks the page holding it, as f'{path}?page={page}'; rows added or
+removed also shift the rows after them to the following pages. Only when the
+number of pages changes, which every page of the list shows, is the whole list
+path marked.
+"""
+import gzip
+import os
+import re
+import shutil
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.http import Http404
+from django.test import RequestFactory
+from django.urls import resolve, reverse
+from django.utils import timezone
+
+from .models import Author, Book, StalePage
+
+try:
+    import brotli
+except ImportError:  # Brotli variants are optional
+    brotli = None
+
+# Paths of the list pages; marking one stale re-renders all of its pages
+LIST_PATHS = ('/catalog/books/', '/catalog/authors/')
+
+# Changes spanning more pages of a list than this mark the whole list stale instead
+MAX_MARKED_PAGES = 100
+
+# Files of the list pages after the first one
+PAGE_FILE = re.compile(r'page-([0-9]+)\.html')
+
+
+def is_enabled():
+    """Pages are only tracked once the first full build has created PRERENDER_ROOT"""
+    root = getattr(settings, 'PRERENDER_ROOT', None)
+    return bool(root) and os.path.isdir(root)
+
+
+def page_file(root, path, page=1):
+    """Returns the file a page is pre-rendered to, or None for paths that cannot be pre-rendered"""
+    parts = [part for part in path.split('/') if part]
+    if any(part in ('.', '..') for part in parts):
+        return None
+    name = 'index.html' if page == 1 else f'page-{page}.html'
+    return os.path.join(root, *parts, name)
+
+
+def list_view(path):
+    """Returns the view and model of a list path"""
+    from . import views
+    return {
+        LIST_PATHS[0]: (views.BookListView, Book),
+        LIST_PATHS[1]: (views.AuthorListView, Author),
+    }[path]
+
+
+def page_count(rows, per_page):
+    return max(1, -(-rows // per_page))
+
+
+def list_page_count(path):
+    view, model = list_view(path)
+    return page_count(model.objects.count(), view.paginate_by)
+
+
+def book_position(book_id):
+    """Returns the position (from 0) of a book on the book list, which is in id order"""
+    return Book.objects.filter(pk__lt=book_id).count()
+
+
+def author_position(author_id, last_name, first_name):
+    """Returns the position (from 0) on the author list of an author with the given name"""
+    before = Q(last_name__lt=last_name) | Q(last_name=last_name, first_name__lt=first_name)
+    return Author.objects.exclude(pk=author_id).filter(before).count()
+
+
+def list_pages(path, first, last=None):
+    """Returns the stale paths of the pages of a list holding the rows at positions first to last"""
+    per_page = list_view(path)[0].paginate_by
+    first_page = first // per_page + 1
+    last_page = (first if last is None else last) // per_page + 1
+    if last_page - first_page >= MAX_MARKED_PAGES:
+        return {path}
+    return {f'{path}?page={page}' for page in range(first_page, last_page + 1)}
+
+
+def changed_list_pages(path, position, change):
+    """Returns the stale paths of a list after a row was added at (change 1) or removed from (-1) a position"""
+    view, model = list_view(path)
+    rows = model.objects.count()
+    if page_count(rows, view.paginate_by) != page_count(rows - change, view.paginate_by):
+        return {path}
+    return list_pages(path, position, max(position, rows - 1))
+
+
+def all_pages():
+    """Returns (path, page) for every page that can be pre-rendered"""
+    pages = []
+    for path in LIST_PATHS:
+        pages.extend((path, page) for page in range(1, list_page_count(path) + 1))
+    pages.extend((reverse('book-detail', args=[pk]), 1) for pk in Book.objects.values_list('pk', flat=True))
+    pages.extend((reverse('author-detail', args=[pk]), 1) for pk in Author.objects.values_list('pk', flat=True))
+    return pages
+
+
+def written_list_pages(root, path):
+    """Returns the highest page number of a list written under root, or 0"""
+    directory = os.path.dirname(page_file(root, path))
+    names = os.listdir(directory) if os.path.isdir(directory) else []
+    return max((int(match.group(1)) for match in map(PAGE_FILE.fullmatch, names) if match), default=0)
+
+
+def expand_stale_paths(root, paths):
+    """Returns (path, page) for the pages behind a set of stale paths.
+
+    List paths expand to all of their pages, including those written under
+    root beyond the current page count: they no longer exist, so rendering
+    them removes their files. List paths with a page number stand for that page.
+    """
+    pages = {}
+    for path in paths:
+        list_path, _, page = path.partition('?page=')
+        if path in LIST_PATHS:
+            count = max(list_page_count(path), written_list_pages(root, path))
+            pages.update(((path, number), None) for number in range(1, count + 1))
+        elif list_path in LIST_PATHS and page.isascii() and page.isdigit():
+            pages[list_path, int(page)] = None
+        else:
+            pages[path, 1] = None
+    return list(pages)
+
+
+def render_page(path, page=1):
+    """Renders a page as an anonymous visitor would see it; returns None if it does not exist"""
+    request = RequestFactory().get(path, {'page': page} if page != 1 else {})
+    request.user = AnonymousUser()
+    match = resolve(path)
+    try:
+        response = match.func(request, *match.args, **match.kwargs)
+        if hasattr(response, 'render'):
+            response.render()
+    except Http404:
+        return None
+    return response.content if response.status_code == 200 else None
+
+
+def write_page(root, path, page, content):
+    """Writes a page and its compressed variants, replacing any previous version atomically"""
+    filename = page_file(root, path, page)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    variants = [('', content), ('.gz', gzip.compress(content))]
+    if brotli is not None:
+        variants.append(('.br', brotli.compress(content)))
+    for suffix, data in variants:
+        with open(f'{filename}{suffix}.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(f'{filename}{suffix}.tmp', filename + suffix)
+
+
+def remove_page(root, path, page=1):
+    filename = page_file(root, path, page)
+    for suffix in ('', '.gz', '.br'):
+        if os.path.exists(filename + suffix):
+            os.remove(filename + suffix)
+
+
+def render_pages(root, pages):
+    """Renders and writes pages, removing those that no longer exist; returns the number written"""
+    written = 0
+    for path, page in pages:
+        content = render_page(path, page)
+        if content is None:
+            remove_page(root, path, page)
+        else:
+            write_page(root, path, page, content)
+            written += 1
+    return written
+
+
+def rebuild(root, pages, render):
+    """Renders every page into a fresh directory and swaps it in place of root"""
+    new_root, old_root = root + '.new', root + '.old'
+    shutil.rmtree(new_root, ignore_errors=True)
+    os.makedirs(new_root)
+    written = render(new_root, pages)
+    if os.path.isdir(root):
+        os.rename(root, old_root)
+    os.rename(new_root, root)
+    shutil.rmtree(old_root, ignore_errors=True)
+    return written
+
+
+def mark_stale(paths):
+    """Records that the pages at paths must be rendered again"""
+    paths = set(paths)
+    now = timezone.now()
+    try:
+        with transaction.atomic():
+            existing = set(StalePage.objects.filter(path__in=paths).values_list('path', flat=True))
+            StalePage.objects.filter(path__in=existing).update(marked_at=now)
+            StalePage.objects.bulk_create(StalePage(path=path) for path in paths - existing)
+    except IntegrityError:
+        # Another request marked the same page in the meantime
+        for path in paths:
+            StalePage.objects.update_or_create(path=path, defaults={'marked_at': now})
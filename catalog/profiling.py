@@ -0,0 +1,174 @@
+"""Sampling profiler for production requests.
+
+ProfilingMiddleware (see catalog.middleware) profiles a random fraction
+settings.PROFILE_SAMPLE_RATE of requests, plus the requests of staff members
+who send an "X-Profile: 1" header or add ?profile=1 to the URL. While such a
+request runs, a Sampler thread records the request thread's call stack every
+PROFILE_INTERVAL seconds. Requests that are not profiled only pay for a
+random number and a couple of lookups.
+
+Profiles are appended to PROFILE_ROOT/<url name>.folded in the "folded stacks"
+format read by flamegraph.pl and speedscope: one line per call stack, frames
+separated by semicolons, followed by the number of samples. Every worker
+appends to the same files, and duplicate lines are added up when the file is
+read, so the profile of a view covers all its sampled requests. Appends share
+a lock on a companion .lock file, which compaction takes exclusively, so no
+worker appends to a file while it is being replaced.
+"""
+import fcntl
+import os
+import random
+import re
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+from django.conf import settings
+
+# Profiles larger than this are compacted by adding up their duplicate stacks
+MAX_PROFILE_BYTES = 4 * 1024 * 1024
+
+# Frame of django.core.handlers.base calling the view and rendering its response
+HANDLER_FRAME = 'base._get_response'
+
+_labels = {}
+
+
+def frame_label(code):
+    label = _labels.get(code)
+    if label is None:
+        module = os.path.splitext(os.path.basename(code.co_filename))[0]
+        label = _labels[code] = f'{module}.{code.co_name}'.replace(';', ':').replace(' ', '_')
+    return label
+
+
+def fold(frame):
+    """Returns the call stack of a frame in folded format, outermost frame first"""
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame.f_code))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+class Sampler:
+    """Thread sampling the call stack of another thread at a fixed interval"""
+
+    def __init__(self, thread_id=None, interval=None):
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.interval = interval if interval is not None else getattr(settings, 'PROFILE_INTERVAL', 0.005)
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops sampling and returns a Counter of the folded stacks seen"""
+        self._stopped.set()
+        self._thread.join()
+        return self.stacks
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[fold(frame)] += 1
+
+
+def should_profile(request):
+    """Tells whether to profile a request: a random sample, or on demand by a staff member"""
+    if random.random() < getattr(settings, 'PROFILE_SAMPLE_RATE', 0):
+        return True
+    asked = request.META.get('HTTP_X_PROFILE') == '1' or request.GET.get('profile') == '1'
+    return asked and request.user.is_staff
+
+
+def profile_file(view):
+    name = re.sub(r'[^\w-]', '_', view)
+    return os.path.join(settings.PROFILE_ROOT, f'{name}.folded')
+
+
+def record(view, stacks):
+    """Adds the stacks sampled in one request to the profile of a view"""
+    if not stacks:
+        return
+    filename = profile_file(view)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    lines = ''.join(f'{stack} {count}\n' for stack, count in stacks.items())
+
+    # A single write in append mode, so lines of concurrent workers do not interleave
+    with locked(filename, fcntl.LOCK_SH):
+        fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, lines.encode())
+            size = os.fstat(fd).st_size
+        finally:
+            os.close(fd)
+    if size > MAX_PROFILE_BYTES:
+        compact(filename)
+
+
+@contextmanager
+def locked(filename, operation):
+    """Holds a shared (appending) or exclusive (compacting) lock on a profile"""
+    fd = os.open(f'{filename}.lock', os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, operation)
+        yield
+    finally:
+        os.close(fd)
+
+
+def read(filename):
+    """Returns a Counter of the stacks in a folded profile, adding up duplicate lines"""
+    stacks = Counter()
+    with open(filename) as profile:
+        for line in profile:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            if stack and count.isdigit():
+                stacks[stack] += int(count)
+    return stacks
+
+
+def compact(filename):
+    with locked(filename, fcntl.LOCK_EX):
+        # Another worker may have compacted the file while this one waited for the lock
+        if os.path.getsize(filename) <= MAX_PROFILE_BYTES:
+            return
+        stacks = read(filename)
+        temporary = f'{filename}.{os.getpid()}.tmp'
+        with open(temporary, 'w') as profile:
+            profile.writelines(f'{stack} {count}\n' for stack, count in stacks.items())
+        os.replace(temporary, filename)
+
+
+def profiles():
+    """Returns [(view, number of samples)] for every profiled view, most sampled first"""
+    root = settings.PROFILE_ROOT
+    if not os.path.isdir(root):
+        return []
+    views = []
+    for name in os.listdir(root):
+        if name.endswith('.folded'):
+            views.append((name[:-len('.folded')], sum(read(os.path.join(root, name)).values())))
+    return sorted(views, key=lambda view: -view[1])
+
+
+def view_frames(stack):
+    """Returns the frames of a folded stack below Django's request handler, i.e. the view and its rendering"""
+    frames = stack.split(';')
+    if HANDLER_FRAME in frames:
+        return frames[len(frames) - frames[::-1].index(HANDLER_FRAME):] or frames[-1:]
+    return frames
+
+
+def hottest(stacks, limit=20):
+    """Returns the most sampled stacks and the functions most often on top of the stack, with their counts"""
+    functions = Counter()
+    for stack, count in stacks.items():
+        functions[stack.rpartition(';')[2]] += count
+    return stacks.most_common(limit), functions.most_common(limit)
@@ -0,0 +1,157 @@
+"""Item-to-item "patrons also borrowed" recommendations.
+
+Loan history is turned into a sparse binary borrower-by-book matrix X. The
+cosine similarity of two books is the number of borrowers they share divided by
+the geometric mean of their borrower counts, i.e. the rows of
+D^-1/2 X^T X D^-1/2, where D holds the borrower count of each book. Rows are
+computed in blocks with sparse matrix products, so memory stays bounded by the
+block size rather than the square of the number of books.
+
+This module needs NumPy and SciPy, and is only imported by the
+build_recommendations command.
+"""
+import resource
+import time
+
+import numpy as np
+from django.db import transaction
+from scipy import sparse
+
+from .models import BookRecommendation, Loan, RecommendationBuild
+
+BLOCK_SIZE = 2048
+
+
+def loan_matrix(borrower_ids, book_ids):
+    """Returns (X, books): the binary borrower-by-book matrix and the book id of each column"""
+    borrowers, rows = np.unique(borrower_ids, return_inverse=True)
+    books, columns = np.unique(book_ids, return_inverse=True)
+    matrix = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, columns)),
+                               shape=(len(borrowers), len(books)))
+    # Borrowing the same book twice does not make two books more alike
+    matrix.data[:] = 1
+    return matrix, books
+
+
+def top_similar(matrix, columns, k):
+    """Returns (sources, targets, scores) for the k most similar columns of each of the given columns"""
+    norms = np.sqrt(np.asarray(matrix.sum(axis=0)).ravel())
+    inverse_norms = 1 / np.maximum(norms, 1)
+    by_column = matrix.tocsc()
+
+    sources, targets, scores = [], [], []
+    for start in range(0, len(columns), BLOCK_SIZE):
+        block = columns[start:start + BLOCK_SIZE]
+        shared_borrowers = by_column[:, block].T @ by_column
+        similarity = (sparse.diags(inverse_norms[block]) @ shared_borrowers @ sparse.diags(inverse_norms)).tocsr()
+
+        for row, column in enumerate(block):
+            begin, end = similarity.indptr[row], similarity.indptr[row + 1]
+            others = similarity.indices[begin:end] != column
+            row_targets = similarity.indices[begin:end][others]
+            row_scores = similarity.data[begin:end][others]
+            if not len(row_scores):
+                continue
+            best = np.argsort(-row_scores, kind='stable')[:k]
+            sources.append(np.full(len(best), column))
+            targets.append(row_targets[best])
+            scores.append(row_scores[best])
+
+    if not sources:
+        return np.empty(0, int), np.empty(0, int), np.empty(0, np.float32)
+    return np.concatenate(sources), np.concatenate(targets), np.concatenate(scores)
+
+
+def new_loans():
+    """Returns (loan ids, book ids) of the loans no build has included yet.
+
+    Loans are flagged once included rather than compared with the highest id of
+    the last build, since ids are allocated on insert but become visible on commit.
+    """
+    loans = Loan.objects.filter(in_recommendations=False).order_by()
+    loan_ids = np.fromiter(loans.values_list('id', flat=True).iterator(chunk_size=10000), dtype=np.int64)
+    book_ids = (loans.filter(borrower__isnull=False, book__isnull=False)
+                .values_list('book_id', flat=True).distinct())
+    return loan_ids, np.fromiter(book_ids.iterator(chunk_size=10000), dtype=np.int64)
+
+
+def load_loans():
+    """Returns (borrower ids, book ids) of every loan"""
+    loans = (Loan.objects
+             .filter(borrower__isnull=False, book__isnull=False)
+             .order_by()
+             .values_list('borrower_id', 'book_id'))
+    pairs = np.fromiter((value for pair in loans.iterator(chunk_size=10000) for value in pair), dtype=np.int64)
+    pairs = pairs.reshape(-1, 2)
+    return pairs[:, 0], pairs[:, 1]
+
+
+def affected_books(new_book_ids, borrower_ids, book_ids):
+    """Returns the books whose similarities changed with new loans of the given books.
+
+    A new loan changes the borrower count of its book, and with it the book's
+    score with every book sharing a borrower with it, in both directions. These
+    neighbours are the nonzero columns of X[:, new]^T X, found here from the
+    borrowers of the new books without computing the product.
+    """
+    borrowers = np.unique(borrower_ids[np.isin(book_ids, new_book_ids)])
+    return np.unique(book_ids[np.isin(borrower_ids, borrowers)])
+
+
+def build(k=10, full=False):
+    """Computes and stores recommendations; only books affected by new loans unless full is set"""
+    started = time.perf_counter()
+    previous = RecommendationBuild.objects.first()
+
+    # Read before the loan history, so every loan flagged below is part of it
+    new_loan_ids, new_book_ids = new_loans()
+    borrower_ids, book_ids = load_loans()
+    matrix, books = loan_matrix(borrower_ids, book_ids)
+    if full or previous is None:
+        full, columns = True, np.arange(len(books))
+    else:
+        changed = affected_books(new_book_ids, borrower_ids, book_ids)
+        columns = np.searchsorted(books, changed)
+    sources, targets, scores = top_similar(matrix, columns, k)
+
+    with transaction.atomic():
+        if full:
+            BookRecommendation.objects.all().delete()
+        else:
+            for start in range(0, len(columns), 500):
+                BookRecommendation.objects.filter(book_id__in=books[columns[start:start + 500]].tolist()).delete()
+        ranks = rank_within_source(sources)
+        BookRecommendation.objects.bulk_create(
+            (BookRecommendation(book_id=int(books[source]), recommended_id=int(books[target]),
+                                rank=int(rank), score=float(score))
+             for source, target, rank, score in zip(sources, targets, ranks, scores)),
+            batch_size=1000)
+        for start in range(0, len(new_loan_ids), 500):
+            Loan.objects.filter(id__in=new_loan_ids[start:start + 500].tolist()).update(in_recommendations=True)
+        return RecommendationBuild.objects.create(
+            full=full, loans=len(book_ids), books=len(columns),
+            seconds=time.perf_counter() - started,
+            peak_memory_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def rank_within_source(sources):
+    """Returns 1, 2, 3... restarting for each run of equal source values"""
+    if not len(sources):
+        return sources
+    run_starts = np.flatnonzero(np.r_[True, sources[1:] != sources[:-1]])
+    run_lengths = np.diff(np.r_[run_starts, len(sources)])
+    return np.arange(len(sources)) - np.repeat(run_starts, run_lengths) + 1
+
+
+def benchmark(loans, borrowers, books, k=10, seed=0):
+    """Builds recommendations for synthetic loans in memory; returns (seconds, peak memory in kB)"""
+    random = np.random.RandomState(seed)
+    # Popularity of books follows a Zipf-like distribution, as in real circulation data
+    popularity = 1 / np.arange(1, books + 1)
+    book_ids = random.choice(books, size=loans, p=popularity / popularity.sum())
+    borrower_ids = random.randint(0, borrowers, size=loans)
+
+    started = time.perf_counter()
+    matrix, book_columns = loan_matrix(borrower_ids, book_ids)
+    top_similar(matrix, np.arange(len(book_columns)), k)
+    return time.perf_counter() - started, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
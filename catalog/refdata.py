@@ -0,0 +1,76 @@
+"""Process-local cache of the genre and language reference data.
+
+Genres and languages are few and rarely change, but book forms, templates and
+the admin look them up all the time. Each worker loads them once and keeps them
+in memory along with the version of the 'refdata' namespace in the shared cache
+(see catalog.caching). The version is checked once per request, and saving or
+deleting a genre or language bumps it (see catalog.signals), so every worker
+reloads the data on its next request. Outside requests, call expire() to pick
+up changes made by other processes. If the cache is not shared between workers,
+the version never reaches them, so the data is also reloaded once it is older
+than caching.UNSHARED_TIMEOUT.
+"""
+import time
+from collections import namedtuple
+
+from . import metrics
+from .caching import bump_version, get_version, is_outdated
+from .models import Book, Genre, Language
+
+CACHE_NAMESPACE = 'refdata'
+MODELS = (Genre, Language)
+
+ReferenceData = namedtuple('ReferenceData', 'version loaded_at objects')
+
+_data = None
+_checked = False
+
+
+def _load(version):
+    return ReferenceData(version, time.monotonic(),
+                         {model: {obj.pk: obj for obj in model._base_manager.order_by('pk')} for model in MODELS})
+
+
+def objects(model):
+    """Returns {pk: instance} for every genre or language, in primary key order"""
+    global _data, _checked
+    data = _data
+    if data is None or not _checked:
+        version = get_version(CACHE_NAMESPACE)
+        stale = data is None or data.version != version or is_outdated(data.loaded_at)
+        metrics.cache_lookup('refdata', not stale)
+        if stale:
+            data = _data = _load(version)
+        _checked = True
+    return data.objects[model]
+
+
+def get(model, pk):
+    """Returns a genre or language by primary key, or None if it does not exist"""
+    return objects(model).get(pk)
+
+
+def expire(**kwargs):
+    """Makes the next lookup check the shared version again (connected to request_started)"""
+    global _checked
+    _checked = False
+
+
+def invalidate():
+    """Discards the reference data of this worker and, through the shared version, of every other one"""
+    global _data
+    _data = None
+    bump_version(CACHE_NAMESPACE)
+
+
+def attach_genre_ids(books):
+    """Loads the genre ids of several books in one query, so Book.get_genres() needs none"""
+    books = [book for book in books if not hasattr(book, '_genre_ids')]
+    if not books:
+        return
+    for book in books:
+        book._genre_ids = []
+    by_pk = {book.pk: book for book in books}
+    through = Book.genre.through.objects.filter(book_id__in=by_pk).order_by('pk')
+    for book_id, genre_id in through.values_list('book_id', 'genre_id'):
+        by_pk[book_id]._genre_ids.append(genre_id)
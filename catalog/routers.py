@@ -0,0 +1,69 @@
+"""Database router partitioning copies by branch.
+
+Each Branch names the database alias holding its copies (BookInstance rows),
+so every branch's circulation data can live in its own database. All other
+tables, including books, authors, genres, languages, users and the loan
+history, stay in the default database. Branch databases receive the full
+schema so that migrations apply unchanged, but only copies are stored there.
+"""
+import time
+
+from django.db import DEFAULT_DB_ALIAS
+
+from .caching import bump_version, get_version, is_outdated
+from .models import BookInstance, Branch
+
+CACHE_NAMESPACE = 'branches'
+
+# Branch id -> database alias; branches are rarely added or moved, so this is kept per process and reloaded
+# when the version of the 'branches' namespace in the shared cache shows a branch changed in any worker
+# (or, with a cache that is not shared, once older than caching.UNSHARED_TIMEOUT)
+_branch_databases = (None, 0, {})
+
+
+def branch_databases():
+    """Returns {branch id: alias of the database holding the copies of the branch}"""
+    global _branch_databases
+    version = get_version(CACHE_NAMESPACE)
+    if _branch_databases[0] != version or is_outdated(_branch_databases[1]):
+        databases = dict(Branch.objects.using(DEFAULT_DB_ALIAS).values_list('id', 'database'))
+        _branch_databases = (version, time.monotonic(), databases)
+    return _branch_databases[2]
+
+
+def branch_database(branch_id):
+    """Returns the alias of the database holding the copies of a branch"""
+    return branch_databases().get(branch_id, DEFAULT_DB_ALIAS)
+
+
+def forget_branch_databases():
+    """Makes every worker reload the databases of the branches"""
+    bump_version(CACHE_NAMESPACE)
+
+
+class BranchRouter:
+    """Routes copies to their branch database and everything else to the default database"""
+
+    def db_for_read(self, model, **hints):
+        if model is BookInstance:
+            instance = hints.get('instance')
+            # Copies reached from a copy (e.g. after refresh_from_db) stay in that copy's database
+            if isinstance(instance, BookInstance) and instance._state.db:
+                return instance._state.db
+            return None
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        if model is BookInstance:
+            instance = hints.get('instance')
+            if isinstance(instance, BookInstance):
+                # Assigning the book or branch of a new copy sets its database to theirs, so ignore it
+                if instance._state.adding and instance.branch_id:
+                    return branch_database(instance.branch_id)
+                return instance._state.db
+            return None
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Copies refer to shared rows in the default database by id
+        return True
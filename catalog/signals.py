@@ -0,0 +1,352 @@
+import datetime
+
+from django.contrib.auth.models import Group, Permission, User
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.core.signals import request_started
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from django.urls import reverse
+
+from . import backends, covers, facets, metrics, prerender, refdata, routers, snapshot
+from .caching import bump_version
+from .models import Author, Book, BookInstance, Branch, Genre, Language, Loan, RecommendationBuild
+
+
+# Fields of a copy whose changes are told apart: catalog fields, and circulation fields
+COPY_CATALOG_FIELDS = ('book_id', 'branch_id', 'imprint')
+COPY_CIRCULATION_FIELDS = ('status', 'due_back')
+
+
+@receiver(connection_created)
+def use_write_ahead_log(sender, connection, **kwargs):
+    """Lets SQLite readers work alongside a writer, so loading a record never waits for someone else's save"""
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode = WAL')
+
+
+@receiver(pre_save, sender=BookInstance)
+def remember_copy_state(sender, instance, raw, using, **kwargs):
+    """Stores the fields a copy had before this save, so loans can be opened and closed, and caches kept"""
+    if raw:
+        return
+    instance._previous_state = (BookInstance.objects.using(using)
+                                .filter(pk=instance.pk)
+                                .values(*COPY_CATALOG_FIELDS, *COPY_CIRCULATION_FIELDS)
+                                .first())
+
+
+def changed_copy_fields(instance):
+    """Returns the names of the fields changed by the save of a copy, or None if the copy is new"""
+    previous = getattr(instance, '_previous_state', None)
+    if previous is None:
+        return None
+    return {name for name, value in previous.items() if getattr(instance, name) != value}
+
+
+@receiver(post_save, sender=BookInstance)
+def record_loan(sender, instance, raw, using, **kwargs):
+    """Opens a loan when a copy goes out and closes it when the copy comes back"""
+    if raw:
+        return
+    previous_status = (getattr(instance, '_previous_state', None) or {}).get('status')
+    today = datetime.date.today()
+
+    # Loan history is kept in the default database, wherever the copy is stored
+    if instance.status == 'o' and previous_status != 'o':
+        Loan.objects.create(book_instance_id=instance.pk, book_id=instance.book_id,
+                            borrower_id=instance.borrower_id, loaned_on=today)
+        transaction.on_commit(metrics.LOANS.inc)
+    elif previous_status == 'o' and instance.status != 'o':
+        Loan.objects.filter(book_instance_id=instance.pk, returned_on__isnull=True).update(returned_on=today)
+        transaction.on_commit(metrics.RETURNS.inc)
+
+
+# Fields of a book whose changes alter the facet counts; its genres are followed through m2m_changed
+FACET_BOOK_FIELDS = {'language', 'deleted'}
+
+
+@receiver(post_delete, sender=Book)
+@receiver(post_delete, sender=Genre)
+@receiver(post_delete, sender=Language)
+def invalidate_facet_counts(sender, **kwargs):
+    """Makes every worker reload its facet index, as the books, genres or languages it holds changed"""
+    # Bump again on commit, so indexes read by other requests before the commit are discarded too
+    bump_version(facets.CACHE_NAMESPACE)
+    transaction.on_commit(lambda: bump_version(facets.CACHE_NAMESPACE))
+
+
+@receiver(post_save, sender=Book)
+def invalidate_book_facets(sender, instance, created, **kwargs):
+    """Reloads the facet index when a book is added, hidden or changes language, not on every edit"""
+    # A book saved without being loaded first may have changed anything
+    if created or not hasattr(instance, '_loaded_values') or FACET_BOOK_FIELDS.intersection(instance.changed_fields()):
+        invalidate_facet_counts(sender)
+
+
+@receiver(m2m_changed, sender=Book.genre.through)
+def invalidate_genre_facets(sender, action, pk_set, **kwargs):
+    """Reloads the facet index when books gain or lose genres; adding genres a book has already sends none"""
+    if action == 'post_clear' or (action in ('post_add', 'post_remove') and pk_set):
+        invalidate_facet_counts(sender)
+
+
+def available_book(state):
+    """Returns the id of the book a copy in this state makes available, or None"""
+    return state['book_id'] if state and state['status'] == 'a' else None
+
+
+@receiver(post_save, sender=BookInstance)
+@receiver(post_delete, sender=BookInstance)
+def invalidate_availability_count(sender, instance, raw=False, **kwargs):
+    """Reloads the available books of the facet index when a copy becomes available or unavailable"""
+    if raw:
+        return
+    state = {'book_id': instance.book_id, 'status': instance.status}
+    if 'created' in kwargs:
+        before, after = getattr(instance, '_previous_state', None), state
+    else:
+        before, after = state, None
+    if available_book(before) != available_book(after):
+        bump_version(facets.AVAILABILITY_NAMESPACE)
+        transaction.on_commit(lambda: bump_version(facets.AVAILABILITY_NAMESPACE))
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def forget_user_permissions(sender, instance, **kwargs):
+    """Drops the cached permissions of a user whose flags (e.g. is_superuser) may have changed"""
+    user_id = instance.pk
+    backends.forget_permissions(user_id)
+    transaction.on_commit(lambda: backends.forget_permissions(user_id))
+
+
+@receiver(m2m_changed, sender=User.user_permissions.through)
+@receiver(m2m_changed, sender=User.groups.through)
+def forget_member_permissions(sender, instance, action, reverse, pk_set, **kwargs):
+    """Drops the cached permissions of users whose permissions or groups changed"""
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        user_ids = [instance.pk]
+    elif pk_set is not None and sender is User.groups.through:
+        user_ids = pk_set
+    else:
+        # A permission was given to or taken from a set of users, or a group was cleared
+        invalidate_all_permissions()
+        return
+    for user_id in user_ids:
+        backends.forget_permissions(user_id)
+        transaction.on_commit(lambda user_id=user_id: backends.forget_permissions(user_id))
+
+
+@receiver(m2m_changed, sender=Group.permissions.through)
+def forget_group_permissions(sender, action, **kwargs):
+    """Discards all cached permissions when the permissions of a group change"""
+    if action.startswith('post_'):
+        invalidate_all_permissions()
+
+
+@receiver(post_delete, sender=Group)
+@receiver(post_delete, sender=Permission)
+def forget_deleted_permissions(sender, **kwargs):
+    """Discards all cached permissions when a group or permission disappears"""
+    invalidate_all_permissions()
+
+
+def invalidate_all_permissions():
+    backends.forget_all_permissions()
+    transaction.on_commit(backends.forget_all_permissions)
+
+
+@receiver(pre_save, sender=Book)
+def remember_book_author(sender, instance, raw, using, **kwargs):
+    """Stores the author a book had before this save, whose pre-rendered page lists the book"""
+    if instance.pk and not raw and prerender.is_enabled():
+        instance._previous_author_id = (Book.objects.using(using)
+                                        .filter(pk=instance.pk)
+                                        .values_list('author_id', flat=True)
+                                        .first())
+
+
+def listed(instance, signal, created):
+    """Returns whether a book or author was shown on its list before and after a save or delete"""
+    was_deleted = getattr(instance, '_loaded_values', {}).get('deleted', instance.deleted)
+    return not created and not was_deleted, signal is post_save and not instance.deleted
+
+
+def list_change(path, position, before, after):
+    """Returns the stale pages of a list after a row at a position was added, removed or edited"""
+    if before and after:
+        return prerender.list_pages(path, position)
+    if before or after:
+        return prerender.changed_list_pages(path, position, 1 if after else -1)
+    return set()
+
+
+@receiver(post_save, sender=Book)
+@receiver(post_delete, sender=Book)
+def mark_book_pages_stale(sender, instance, signal, created=False, **kwargs):
+    if not prerender.is_enabled():
+        return
+    paths = {reverse('book-detail', args=[instance.pk])}
+    for author_id in (instance.author_id, getattr(instance, '_previous_author_id', None)):
+        if author_id:
+            paths.add(reverse('author-detail', args=[author_id]))
+    paths.update(list_change(reverse('books'), prerender.book_position(instance.pk),
+                             *listed(instance, signal, created)))
+    prerender.mark_stale(paths)
+
+
+@receiver(pre_delete, sender=Author)
+def remember_author_books(sender, instance, **kwargs):
+    """Stores the books of an author about to be deleted, which lose their author before post_delete"""
+    if prerender.is_enabled():
+        instance._book_ids = list(instance.book_set.values_list('pk', flat=True))
+
+
+@receiver(post_save, sender=Author)
+@receiver(post_delete, sender=Author)
+def mark_author_pages_stale(sender, instance, signal, created=False, **kwargs):
+    if not prerender.is_enabled():
+        return
+    book_ids = getattr(instance, '_book_ids', None)
+    if book_ids is None:
+        book_ids = list(instance.book_set.values_list('pk', flat=True))
+    paths = {reverse('author-detail', args=[instance.pk])}
+    paths.update(reverse('book-detail', args=[pk]) for pk in book_ids)
+
+    loaded = getattr(instance, '_loaded_values', {})
+    old_name = (loaded.get('last_name', instance.last_name), loaded.get('first_name', instance.first_name))
+    new_name = (instance.last_name, instance.first_name)
+    before, after = listed(instance, signal, created)
+    old_position = prerender.author_position(instance.pk, *old_name)
+    new_position = prerender.author_position(instance.pk, *new_name)
+    if before and after and old_position != new_position:
+        # The author moved within the list: the pages in between shift by one row
+        paths.update(prerender.list_pages(reverse('authors'), min(old_position, new_position),
+                                          max(old_position, new_position)))
+    else:
+        paths.update(list_change(reverse('authors'), new_position if after else old_position, before, after))
+
+    # The book list shows the name of the author of each book
+    if old_name != new_name or signal is post_delete:
+        books = reverse('books')
+        if len(book_ids) > prerender.MAX_MARKED_PAGES:
+            paths.add(books)
+        else:
+            for book_id in Book.objects.filter(pk__in=book_ids).values_list('pk', flat=True):
+                paths.update(prerender.list_pages(books, prerender.book_position(book_id)))
+    prerender.mark_stale(paths)
+
+
+@receiver(post_save, sender=BookInstance)
+@receiver(post_delete, sender=BookInstance)
+def mark_copy_pages_stale(sender, instance, **kwargs):
+    if not prerender.is_enabled() or instance.book_id is None:
+        return
+    paths = {reverse('book-detail', args=[instance.book_id])}
+    author_id = Book.objects.filter(pk=instance.book_id).values_list('author_id', flat=True).first()
+    if author_id:
+        paths.add(reverse('author-detail', args=[author_id]))
+    prerender.mark_stale(paths)
+
+
+@receiver(post_save, sender=Genre)
+@receiver(pre_delete, sender=Genre)
+@receiver(post_save, sender=Language)
+@receiver(pre_delete, sender=Language)
+def mark_reference_pages_stale(sender, instance, **kwargs):
+    if not prerender.is_enabled():
+        return
+    books = instance.book_set.values_list('pk', flat=True)
+    prerender.mark_stale(reverse('book-detail', args=[pk]) for pk in books)
+
+
+@receiver(m2m_changed, sender=Book.genre.through)
+def mark_genre_pages_stale(sender, instance, action, pk_set, **kwargs):
+    # Books losing all their genres are looked up before the clear
+    if action not in ('post_add', 'post_remove', 'pre_clear') or not prerender.is_enabled():
+        return
+    if not kwargs['reverse']:
+        book_ids = [instance.pk]
+    elif pk_set is not None:
+        book_ids = pk_set
+    else:
+        book_ids = instance.book_set.values_list('pk', flat=True)
+    prerender.mark_stale(reverse('book-detail', args=[pk]) for pk in book_ids)
+
+
+@receiver(post_save, sender=Branch)
+@receiver(post_delete, sender=Branch)
+def forget_branch_databases(sender, **kwargs):
+    # Forget again on commit, so databases reloaded by other requests before the commit are discarded too
+    routers.forget_branch_databases()
+    transaction.on_commit(routers.forget_branch_databases)
+
+
+@receiver(post_save, sender=Book)
+def make_cover_thumbnails(sender, instance, raw, **kwargs):
+    if not raw and getattr(instance, '_cover_uploaded', False):
+        covers.schedule(instance.pk)
+
+
+@receiver(request_started)
+def check_reference_data(sender, **kwargs):
+    refdata.expire()
+
+
+@receiver(post_save, sender=Genre)
+@receiver(post_delete, sender=Genre)
+@receiver(post_save, sender=Language)
+@receiver(post_delete, sender=Language)
+def invalidate_reference_data(sender, **kwargs):
+    """Makes every worker reload its genres and languages"""
+    # Invalidate again on commit, so data reloaded by other requests before the commit is discarded too
+    refdata.invalidate()
+    transaction.on_commit(refdata.invalidate)
+
+
+@receiver(m2m_changed, sender=Book.genre.through)
+def forget_genre_ids(sender, instance, action, **kwargs):
+    if action.startswith('post_') and not kwargs['reverse']:
+        instance.__dict__.pop('_genre_ids', None)
+
+
+@receiver(request_started)
+def check_catalog_snapshot(sender, **kwargs):
+    snapshot.expire()
+
+
+@receiver(post_save, sender=Author)
+@receiver(post_delete, sender=Author)
+@receiver(post_save, sender=Book)
+@receiver(post_delete, sender=Book)
+@receiver(m2m_changed, sender=Book.genre.through)
+@receiver(post_save, sender=Genre)
+@receiver(post_delete, sender=Genre)
+@receiver(post_save, sender=Language)
+@receiver(post_delete, sender=Language)
+@receiver(post_save, sender=Branch)
+@receiver(post_delete, sender=Branch)
+@receiver(post_save, sender=RecommendationBuild)
+def invalidate_catalog_snapshot(sender, **kwargs):
+    """Serves the catalog pages from the database until the snapshot is rebuilt with the change"""
+    # Bump again on commit, so a snapshot built before the commit is not taken as current
+    bump_version(snapshot.CACHE_NAMESPACE)
+    transaction.on_commit(lambda: bump_version(snapshot.CACHE_NAMESPACE))
+
+
+@receiver(post_save, sender=BookInstance)
+@receiver(post_delete, sender=BookInstance)
+def update_snapshot_copies(sender, instance, raw=False, **kwargs):
+    """Patches the circulation state of the copies in the snapshot, invalidating it only for catalog changes"""
+    if raw:
+        return
+    changed = changed_copy_fields(instance) if 'created' in kwargs else None
+    if changed is None or changed.intersection(COPY_CATALOG_FIELDS):
+        invalidate_catalog_snapshot(sender)
+    elif changed and instance.book_id is not None:
+        # On commit, so the live state read is the committed one
+        transaction.on_commit(lambda: snapshot.patch_copies(instance.book_id))
@@ -0,0 +1,452 @@
+"""Memory-mapped snapshot of the public catalog.
+
+The build_catalog_snapshot command packs the visible books and authors, with
+their copies, branch availability and recommendations, into a single binary
+file at CATALOG_SNAPSHOT_PATH. The file is written next to the old one and
+renamed over it, so readers see either the old or the new snapshot, whole.
+
+Workers map the file read-only. Its pages live in the operating system's page
+cache, shared by every worker, rather than in each worker's memory. Records
+are unpacked from the mapped pages only when a page displays them, and sorted
+id arrays locate a book or author by binary search. With a current snapshot,
+the book and author list and detail views run no database queries.
+
+The snapshot records the version of the 'snapshot' namespace in the shared
+cache (see catalog.caching) at the start of the build. Changes to the catalog
+bump that version (see catalog.signals), so the views go back to the database
+until the next build picks the changes up. Workers check the version and the
+file once per request. This needs a cache shared with the command, as set up
+by $MEMCACHED_LOCATION; otherwise workers never use the snapshot.
+
+Checkouts, returns and renewals only change the status and due date of
+copies, and are far too frequent to send the pages back to the database.
+Instead, patch_copies() stores the live state of the copies of the book in
+the shared cache, under the snapshot version, and book pages read it from
+there in place of the state recorded in the file.
+
+File layout, all integers little-endian:
+
+    header    magic, version, then (offset, length) of each section
+    books     BOOK records in id order, with book_ids the matching sorted ids
+    authors   AUTHOR records in id order, with author_ids the matching sorted ids
+    author_order  indexes of the authors in the order of the author list
+    copies    COPY records, grouped by book
+    links     indexes of the books of each author and of each book's recommendations
+    branches  names of the branches; available holds one count per branch per book
+    strings   UTF-8 text, referred to by (offset, length)
+"""
+import datetime
+import mmap
+import os
+import struct
+from bisect import bisect_left
+from collections import defaultdict, namedtuple
+from collections.abc import Sequence
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.functional import cached_property
+
+from . import branches
+from .caching import get_version
+from .models import Author, Book, BookInstance, BookRecommendation, Branch, Genre, Language
+
+CACHE_NAMESPACE = 'snapshot'
+MAGIC = b'LLSNAP01'
+SECTIONS = ('books', 'book_ids', 'authors', 'author_ids', 'author_order', 'copies', 'links', 'branches',
+            'available', 'strings')
+HEADER = struct.Struct('<8sq' + 'QQ' * len(SECTIONS))
+
+# Strings are (offset, length) pairs in the strings section; dates are ordinals, 0 when missing
+BOOK = struct.Struct('<q' + 'II' * 6 + 'i' + 'II' * 2 + 'I')
+AUTHOR = struct.Struct('<q' + 'II' * 2 + 'ii' + 'II')
+COPY = struct.Struct('<qcxxxiII')
+BRANCH = struct.Struct('<II')
+INDEX = struct.Struct('<i')
+ID = struct.Struct('<q')
+
+# Recommendations kept per book, as many as the book page shows
+RECOMMENDATION_COUNT = 5
+
+# Separates the genre names of a book
+GENRE_SEPARATOR = '\x1f'
+
+STATUS_NAMES = dict(BookInstance.LOAN_STATUS)
+
+Recommendation = namedtuple('Recommendation', 'recommended')
+
+
+def _date(ordinal):
+    return datetime.date.fromordinal(ordinal) if ordinal else None
+
+
+def _ordinal(date):
+    return date.toordinal() if date else 0
+
+
+class Records(Sequence):
+    """Lazy sequence of the records at some indexes, suitable for Paginator"""
+
+    def __init__(self, record, indexes):
+        self._record = record
+        self._indexes = indexes
+
+    def __len__(self):
+        return len(self._indexes)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self._record(index) for index in self._indexes[item]]
+        return self._record(self._indexes[item])
+
+
+class RelatedRecords:
+    """Stands in for a related manager in templates (e.g. book.bookinstance_set.all)"""
+
+    def __init__(self, records):
+        self._records = records
+
+    def all(self):
+        return self._records
+
+    def count(self):
+        return len(self._records)
+
+
+class AuthorRecord:
+    """Author read from a snapshot; templates use it like an Author"""
+    __str__ = Author.__str__
+    get_absolute_url = Author.get_absolute_url
+
+    def __init__(self, snapshot, index):
+        self._snapshot = snapshot
+        fields = AUTHOR.unpack_from(snapshot.sections['authors'], index * AUTHOR.size)
+        self.id = self.pk = fields[0]
+        self.first_name = snapshot.string(*fields[1:3])
+        self.last_name = snapshot.string(*fields[3:5])
+        self.date_of_birth = _date(fields[5])
+        self.date_of_death = _date(fields[6])
+        self._books = fields[7:9]
+
+    @property
+    def book_set(self):
+        return RelatedRecords(self._snapshot.linked_books(*self._books))
+
+
+class CopyRecord:
+    """Copy read from a snapshot; templates use it like a BookInstance"""
+    code = BookInstance.code
+    is_overdue = BookInstance.is_overdue
+
+    def __init__(self, snapshot, index):
+        fields = COPY.unpack_from(snapshot.sections['copies'], index * COPY.size)
+        self.id = self.pk = fields[0]
+        self.status = fields[1].decode()
+        self.due_back = _date(fields[2])
+        self.imprint = snapshot.string(*fields[3:5])
+
+    def get_status_display(self):
+        return STATUS_NAMES.get(self.status, self.status)
+
+
+class BookRecord:
+    """Book read from a snapshot; templates use it like a Book"""
+    __str__ = Book.__str__
+    get_absolute_url = Book.get_absolute_url
+    COVER_WIDTHS = Book.COVER_WIDTHS
+    cover_thumbnail_name = Book.cover_thumbnail_name
+    cover_srcset = Book.cover_srcset
+    cover_webp_srcset = Book.cover_webp_srcset
+    cover_jpeg_srcset = Book.cover_jpeg_srcset
+    cover_thumbnail_url = Book.cover_thumbnail_url
+
+    def __init__(self, snapshot, index):
+        self._snapshot = snapshot
+        self._index = index
+        fields = BOOK.unpack_from(snapshot.sections['books'], index * BOOK.size)
+        self.id = self.pk = fields[0]
+        self.title = snapshot.string(*fields[1:3])
+        self.summary = snapshot.string(*fields[3:5])
+        self.isbn = snapshot.string(*fields[5:7])
+        self.language = snapshot.string(*fields[7:9]) or None
+        self._genres = fields[9:11]
+        self.cover_hash = snapshot.string(*fields[11:13])
+        self._author = fields[13]
+        self._copies = fields[14:16]
+        self._recommendations = fields[16:18]
+        self._available = fields[18]
+
+    @property
+    def author(self):
+        return AuthorRecord(self._snapshot, self._author) if self._author >= 0 else None
+
+    def get_genres(self):
+        genres = self._snapshot.string(*self._genres)
+        return genres.split(GENRE_SEPARATOR) if genres else []
+
+    @cached_property
+    def _patch(self):
+        return cache.get(patch_key(self._snapshot.version, self.id))
+
+    @property
+    def bookinstance_set(self):
+        start, count = self._copies
+        copies = Records(self._snapshot.copy, range(start, start + count))
+        if self._patch is not None:
+            copies = copies[:]
+            for copy in copies:
+                copy.status, due_back = self._patch['copies'].get(copy.id, (copy.status, _ordinal(copy.due_back)))
+                copy.due_back = _date(due_back)
+            copies.sort(key=branches.due_back_order)
+        return RelatedRecords(copies)
+
+    @property
+    def copy_count(self):
+        return self._copies[1]
+
+    @property
+    def recommendations(self):
+        return [Recommendation(book) for book in self._snapshot.linked_books(*self._recommendations)]
+
+    @property
+    def branch_availability(self):
+        """Returns [(branch name, number of available copies)], like catalog.branches.availability"""
+        if self._patch is not None:
+            return self._patch['available']
+        snapshot = self._snapshot
+        counts = snapshot.sections['available'].cast('i')
+        start = self._available
+        return [(name, counts[start + number]) for number, name in enumerate(snapshot.branch_names())]
+
+
+class Snapshot:
+    """Read-only view of a snapshot file mapped into memory"""
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as snapshot_file:
+            self._mmap = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mmap)
+        header = HEADER.unpack_from(view)
+        if header[0] != MAGIC:
+            raise ValueError(f'{filename} is not a catalog snapshot')
+        self.version = header[1]
+        self.sections = {name: view[offset:offset + length]
+                         for name, offset, length in zip(SECTIONS, header[2::2], header[3::2])}
+        self._book_ids = self.sections['book_ids'].cast('q')
+        self._author_ids = self.sections['author_ids'].cast('q')
+        self._links = self.sections['links'].cast('i')
+
+    def string(self, offset, length):
+        return str(self.sections['strings'][offset:offset + length], 'utf-8')
+
+    def branch_names(self):
+        section = self.sections['branches']
+        return [self.string(*BRANCH.unpack_from(section, offset)) for offset in range(0, len(section), BRANCH.size)]
+
+    def book(self, pk):
+        """Returns the visible book with this id, or None"""
+        index = bisect_left(self._book_ids, pk)
+        return BookRecord(self, index) if index < len(self._book_ids) and self._book_ids[index] == pk else None
+
+    def author(self, pk):
+        """Returns the visible author with this id, or None"""
+        index = bisect_left(self._author_ids, pk)
+        return AuthorRecord(self, index) if index < len(self._author_ids) and self._author_ids[index] == pk else None
+
+    def copy(self, index):
+        return CopyRecord(self, index)
+
+    def books(self):
+        """Returns the visible books in id order, as on the book list"""
+        return Records(lambda index: BookRecord(self, index), range(len(self._book_ids)))
+
+    def authors(self):
+        """Returns the visible authors in name order, as on the author list"""
+        return Records(lambda index: AuthorRecord(self, index), self.sections['author_order'].cast('i'))
+
+    def linked_books(self, start, count):
+        return [BookRecord(self, index) for index in self._links[start:start + count]]
+
+
+class StringTable:
+    """Collects the strings of a snapshot, storing repeated ones (languages, imprints...) once"""
+
+    def __init__(self):
+        self.data = bytearray()
+        self._refs = {}
+
+    def add(self, text):
+        text = text or ''
+        ref = self._refs.get(text)
+        if ref is None:
+            encoded = text.encode()
+            ref = self._refs[text] = (len(self.data), len(encoded))
+            self.data += encoded
+        return ref
+
+
+def build(filename):
+    """Writes a snapshot of the catalog to filename, replacing the previous one atomically"""
+    # Read the version first, so changes made while reading the catalog leave the snapshot stale
+    version = get_version(CACHE_NAMESPACE)
+    strings = StringTable()
+    links = []
+
+    books = list(Book.objects.order_by('id').values_list(
+        'id', 'title', 'summary', 'isbn', 'language_id', 'cover_hash', 'author_id'))
+    book_indexes = {book[0]: index for index, book in enumerate(books)}
+    authors = list(Author.objects.order_by('id').values_list(
+        'id', 'first_name', 'last_name', 'date_of_birth', 'date_of_death'))
+    author_indexes = {author[0]: index for index, author in enumerate(authors)}
+    # Sorted here rather than read again, so an author added in between cannot be missing from authors
+    author_order = sorted(range(len(authors)), key=lambda index: (authors[index][2], authors[index][1],
+                                                                  authors[index][0]))
+
+    genre_names = dict(Genre.objects.values_list('id', 'name'))
+    language_names = dict(Language.objects.values_list('id', 'name'))
+    # The queries do not read one consistent state, so rows added or hidden in between are skipped
+    genres = defaultdict(list)
+    for book_id, genre_id in Book.genre.through.objects.order_by('pk').values_list('book_id', 'genre_id'):
+        if book_id in book_indexes and genre_id in genre_names:
+            genres[book_id].append(genre_names[genre_id])
+
+    books_by_author = defaultdict(list)
+    for index, book in enumerate(books):
+        books_by_author[book[6]].append(index)
+
+    recommendations = defaultdict(list)
+    for book_id, recommended_id in (BookRecommendation.objects
+                                    .filter(book__deleted=False, recommended__deleted=False)
+                                    .order_by('book', 'rank')
+                                    .values_list('book_id', 'recommended_id')):
+        if len(recommendations[book_id]) < RECOMMENDATION_COUNT and recommended_id in book_indexes:
+            recommendations[book_id].append(book_indexes[recommended_id])
+
+    # Copies from every branch database, by book then as the book page lists them: by due date
+    copy_rows = [row for queryset in branches.fan_out(BookInstance.objects
+                                                      .filter(book_id__in=book_indexes)
+                                                      .values_list('id', 'book_id', 'status', 'due_back', 'imprint'))
+                 for row in queryset]
+    copy_rows.sort(key=lambda row: (row[1], row[3] is not None, row[3] or datetime.date.min, row[0]))
+    copies = bytearray()
+    copy_ranges = {}
+    count = 0
+    for copy_id, book_id, status, due_back, imprint in copy_rows:
+        start, _ = copy_ranges.get(book_id, (count, 0))
+        copy_ranges[book_id] = (start, count - start + 1)
+        copies += COPY.pack(copy_id, (status or ' ').encode(), _ordinal(due_back), *strings.add(imprint))
+        count += 1
+
+    branch_names = list(Branch.objects.values_list('id', 'name'))
+    available = branches.available_copies()
+    available_counts = []
+
+    packed_books = bytearray()
+    for book_id, title, summary, isbn, language_id, cover_hash, author_id in books:
+        recommended_start = len(links)
+        links.extend(recommendations[book_id])
+        available_start = len(available_counts)
+        available_counts.extend(available.get(book_id, {}).get(branch_id, 0) for branch_id, _ in branch_names)
+        packed_books += BOOK.pack(
+            book_id, *strings.add(title), *strings.add(summary), *strings.add(isbn),
+            *strings.add(language_names.get(language_id)), *strings.add(GENRE_SEPARATOR.join(genres[book_id])),
+            *strings.add(cover_hash), author_indexes.get(author_id, -1), *copy_ranges.get(book_id, (0, 0)),
+            recommended_start, len(recommendations[book_id]), available_start)
+
+    packed_authors = bytearray()
+    for author_id, first_name, last_name, date_of_birth, date_of_death in authors:
+        books_start = len(links)
+        links.extend(books_by_author[author_id])
+        packed_authors += AUTHOR.pack(author_id, *strings.add(first_name), *strings.add(last_name),
+                                      _ordinal(date_of_birth), _ordinal(date_of_death),
+                                      books_start, len(books_by_author[author_id]))
+
+    sections = {
+        'books': packed_books,
+        'book_ids': b''.join(ID.pack(book[0]) for book in books),
+        'authors': packed_authors,
+        'author_ids': b''.join(ID.pack(author[0]) for author in authors),
+        'author_order': b''.join(map(INDEX.pack, author_order)),
+        'copies': copies,
+        'links': b''.join(map(INDEX.pack, links)),
+        'branches': b''.join(BRANCH.pack(*strings.add(name)) for _, name in branch_names),
+        'available': b''.join(map(INDEX.pack, available_counts)),
+        'strings': strings.data,
+    }
+    _write(filename, version, sections)
+    return len(books), len(authors)
+
+
+def patch_key(version, book_id):
+    return f'{CACHE_NAMESPACE}:{version}:copies:{book_id}'
+
+
+def patch_copies(book_id):
+    """Stores the live status and due date of the copies of a book, and its availability, for the snapshot"""
+    states = [row for queryset in branches.fan_out(BookInstance.objects
+                                                   .filter(book_id=book_id)
+                                                   .values_list('id', 'status', 'due_back'))
+              for row in queryset]
+    patch = {
+        'copies': {copy_id: (status, _ordinal(due_back)) for copy_id, status, due_back in states},
+        'available': [(branch.name, count) for branch, count in branches.availability(Book(pk=book_id))],
+    }
+    cache.set(patch_key(get_version(CACHE_NAMESPACE), book_id), patch, None)
+
+
+def _write(filename, version, sections):
+    # Sections start at multiples of 8 bytes, so the arrays in them can be read in place
+    positions = []
+    offset = HEADER.size
+    for name in SECTIONS:
+        offset += -offset % 8
+        positions += [offset, len(sections[name])]
+        offset += len(sections[name])
+
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    temporary = f'{filename}.{os.getpid()}.tmp'
+    with open(temporary, 'wb') as snapshot_file:
+        snapshot_file.write(HEADER.pack(MAGIC, version, *positions))
+        for name, position in zip(SECTIONS, positions[::2]):
+            snapshot_file.write(bytes(position - snapshot_file.tell()))
+            snapshot_file.write(sections[name])
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.replace(temporary, filename)
+
+
+_opened = None
+_current = None
+_checked = False
+
+
+def current():
+    """Returns the snapshot if it exists and nothing changed since it was built, else None"""
+    global _current, _checked
+    if not _checked:
+        _current = _load()
+        _checked = True
+    return _current
+
+
+def _load():
+    global _opened
+    filename = getattr(settings, 'CATALOG_SNAPSHOT_PATH', None)
+    try:
+        stat = os.stat(filename)
+    except (TypeError, OSError):
+        _opened = None
+        return None
+
+    # A rebuild replaces the file, so a new inode means a new snapshot; the old mapping is dropped
+    key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    if _opened is None or _opened[0] != key:
+        _opened = (key, Snapshot(filename))
+    snapshot = _opened[1]
+    return snapshot if snapshot.version == get_version(CACHE_NAMESPACE) else None
+
+
+def expire(**kwargs):
+    """Makes the next call to current() check the file and the shared version again (connected to request_started)"""
+    global _checked
+    _checked = False
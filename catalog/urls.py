@@ -1,5 +1,8 @@
-from django.urls import path
+from django.urls import path, register_converter
 from . import views
+from .copycodes import CopyCodeConverter
+
+register_converter(CopyCodeConverter, 'copycode')
 
 urlpatterns = [
     path('', views.index, name='index'),
@@ -8,10 +11,20 @@ urlpatterns = [
     path('book/<int:pk>', views.BookDetailView.as_view(), name='book-detail'),
     path('authors/', views.AuthorListView.as_view(), name='authors'),
     path('author/<int:pk>', views.AuthorDetailView.as_view(), name='author-detail'),
+    path('choices/<slug:source>/', views.choices, name='choices'),
 
     # Librarian-only paths
     path('borrowed/', views.AllLoanedBooksListView.as_view(), name='all-borrowed'),
-    path('book/<uuid:pk>/renew/', views.renew_book, name='renew-book'),
+    path('borrowed/dashboard/', views.CirculationDashboardView.as_view(), name='circulation-dashboard'),
+    path('book/<copycode:pk>/renew/', views.renew_book, name='renew-book'),
+    path('book/<uuid:uuid>/renew/', views.renew_legacy_copy),
+    path('branch/<slug:branch>/borrowed/', views.BranchLoanedBooksListView.as_view(), name='branch-borrowed'),
+    path('branch/<slug:branch>/book/<copycode:pk>/renew/', views.renew_book, name='branch-renew-book'),
+    path('branch/<slug:branch>/book/<uuid:uuid>/renew/', views.renew_legacy_copy),
+    path('profiles/', views.profile_list, name='profiles'),
+    path('profiles/<str:view>/', views.profile_detail, name='profile-detail'),
+    path('duplicates/', views.DuplicateListView.as_view(), name='duplicates'),
+    path('duplicates/<int:pk>/', views.resolve_duplicate, name='resolve-duplicate'),
 
     # Create/update/delete paths
     path('author/create/', views.AuthorCreate.as_view(), name='author_create'),
@@ -1,15 +1,23 @@
 import datetime
+import os
 
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import permission_required
 from django.contrib.auth.mixins import LoginRequiredMixin, PermissionRequiredMixin
-from django.http import HttpResponseRedirect
-from django.shortcuts import render, get_object_or_404
+from django.core.exceptions import NON_FIELD_ERRORS, ObjectDoesNotExist, ValidationError
+from django.forms import modelform_factory
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseForbidden, HttpResponseRedirect, JsonResponse
+from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse, reverse_lazy
+from django.utils.crypto import constant_time_compare
 from django.views import generic
 from django.views.generic.edit import CreateView, UpdateView, DeleteView
 
-from .forms import RenewBookForm
-from .models import Author, Book, BookInstance, Genre
+from . import autocomplete, branches, deletion, facets, merge, metrics, profiling, refdata, snapshot
+from .forms import CONFLICT_MESSAGE, BookForm, RenewBookForm, VersionedModelForm
+from .models import (Author, Book, BookInstance, BookLoanStat, BookRecommendation, Branch, CirculationSummary,
+                     ConcurrentUpdateError, DuplicateCandidate, Genre, GenreLoanStat)
 
 
 def index(request):
@@ -17,19 +25,19 @@ def index(request):
 
     # Generate counts of some of the main objects
     num_books = Book.objects.count()
-    num_instances = BookInstance.objects.count()
+    num_instances = branches.count(BookInstance.objects.all())
     num_authors = Author.objects.count()
-    num_genres = Genre.objects.count()
+    num_genres = len(refdata.objects(Genre))
 
     # Available books (status = 'a')
-    num_instances_available = BookInstance.objects.filter(status__exact='a').count()
+    num_instances_available = branches.count(BookInstance.objects.filter(status__exact='a'))
 
     # Books about dogs
     num_dog_books = Book.objects.filter(title__icontains='dog').count()
 
-    # Number of visits by this user, as counted in the session variable
-    num_visits = request.session.get('num_visits', 0)
-    request.session['num_visits'] = num_visits + 1
+    # Number of visits by this user, counted in a signed cookie rather than the session: a session
+    # would stop anonymous visitors from being served pre-rendered pages
+    num_visits = int(request.get_signed_cookie('num_visits', '0', salt='catalog.index'))
 
     context = {
         'num_books': num_books,
@@ -42,69 +50,351 @@ def index(request):
     }
 
     # Render the HTML template with the data in the context variable
-    return render(request, 'index.html', context)
+    response = render(request, 'index.html', context)
+    response.set_signed_cookie('num_visits', num_visits + 1, salt='catalog.index', max_age=365 * 24 * 60 * 60,
+                               httponly=True)
+    return response
 
 
 class BookListView(generic.ListView):
+    """Lists books, optionally narrowed down by genre, language and availability facets"""
     model = Book
     paginate_by = 10
+    ordering = ['id']
+    # Named explicitly, as the list may come from the catalog snapshot rather than a queryset
+    template_name = 'catalog/book_list.html'
+    context_object_name = 'book_list'
+
+    def get_queryset(self):
+        self.filters = facets.parse_filters(self.request.GET)
+        catalog = snapshot.current()
+        if catalog is not None and not self.filters:
+            return catalog.books()
+        return facets.filter_books(super().get_queryset(), self.filters)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        counts = facets.facet_counts(self.filters)
+        context['facets'] = [
+            ('Genre', [self.facet_link('genre', *value) for value in counts['genre']]),
+            ('Language', [self.facet_link('language', *value) for value in counts['language']]),
+            ('Availability', [self.facet_link('available', 1, 'Available', counts['available'])]),
+        ]
+
+        # Keep the selected facets when moving between pages
+        query = self.request.GET.copy()
+        query.pop('page', None)
+        context['pagination_query'] = query.urlencode() + '&' if query else ''
+        return context
+
+    def facet_link(self, name, value, label, count):
+        """Returns a facet value with the URL that toggles it on or off"""
+        query = self.request.GET.copy()
+        query.pop('page', None)
+        selected = query.get(name) == str(value)
+        if selected:
+            query.pop(name)
+        else:
+            query[name] = value
+        return {'label': label, 'count': count, 'selected': selected, 'url': '?' + query.urlencode()}
 
 
 class BookDetailView(generic.DetailView):
     model = Book
+    context_object_name = 'book'
+    recommendation_count = 5
+
+    def get_object(self, queryset=None):
+        catalog = snapshot.current()
+        if catalog is None:
+            return super().get_object(queryset)
+        book = catalog.book(self.kwargs['pk'])
+        if book is None:
+            raise Http404('No book found matching the query')
+        return book
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        if isinstance(self.object, snapshot.BookRecord):
+            context['branch_availability'] = self.object.branch_availability
+            context['copies'] = self.object.bookinstance_set.all()
+            context['recommendations'] = self.object.recommendations[:self.recommendation_count]
+            return context
+
+        context['branch_availability'] = branches.availability(self.object)
+        context['copies'] = branches.copies(BookInstance.objects.filter(book=self.object))
+
+        # Precomputed by the build_recommendations command
+        context['recommendations'] = (BookRecommendation.objects
+                                      .filter(book=self.object, recommended__deleted=False)
+                                      .select_related('recommended')[:self.recommendation_count])
+        return context
 
 
 class AuthorListView(generic.ListView):
     model = Author
     paginate_by = 10
+    template_name = 'catalog/author_list.html'
+    context_object_name = 'author_list'
+
+    def get_queryset(self):
+        catalog = snapshot.current()
+        return catalog.authors() if catalog is not None else super().get_queryset()
 
 
 class AuthorDetailView(generic.DetailView):
     model = Author
+    context_object_name = 'author'
+
+    def get_object(self, queryset=None):
+        catalog = snapshot.current()
+        if catalog is None:
+            return super().get_object(queryset)
+        author = catalog.author(self.kwargs['pk'])
+        if author is None:
+            raise Http404('No author found matching the query')
+        return author
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        books = list(self.object.book_set.all())
+        if not isinstance(self.object, snapshot.AuthorRecord):
+            # Copies of the books may be stored in any branch database
+            counts = branches.copy_counts([book.pk for book in books])
+            for book in books:
+                book.copy_count = counts[book.pk]
+        context['books'] = books
+        return context
 
 
 class LoanedBooksByUserListView(LoginRequiredMixin, generic.ListView):
     """Generic class-based view listing books on loan to current user"""
     model = BookInstance
     template_name = 'catalog/bookinstance_list_borrowed_user.html'
+    # Named explicitly, as the list may be merged from several databases rather than a queryset
+    context_object_name = 'bookinstance_list'
     paginate_by = 10
 
     def get_queryset(self):
-        return (BookInstance.objects
-                .filter(borrower=self.request.user)
-                .filter(status__exact='o')
-                .order_by('due_back'))
+        # Copies on loan from every branch database, merged by due date
+        return branches.copies(BookInstance.objects
+                               .filter(borrower=self.request.user)
+                               .filter(status__exact='o')
+                               .prefetch_related('book'))
 
 
 class AllLoanedBooksListView(PermissionRequiredMixin, generic.ListView):
     """Allows librarians to view all books on loan"""
     model = BookInstance
     template_name = 'catalog/bookinstance_list_all.html'
+    context_object_name = 'bookinstance_list'
     paginate_by = 10
 
     # Only librarians can access this page
     permission_required = 'catalog.can_mark_returned'
 
+    def get_queryset(self):
+        # Copies on loan from every branch database, merged by due date
+        return branches.copies(BookInstance.objects
+                               .filter(status__exact='o')
+                               .prefetch_related('book', 'borrower'))
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['branches'] = Branch.objects.all()
+        return context
+
+
+class BranchLoanedBooksListView(AllLoanedBooksListView):
+    """Allows librarians to view the books on loan from one branch"""
+
+    def get_queryset(self):
+        self.branch = get_object_or_404(Branch, slug=self.kwargs['branch'])
+        return (BookInstance.objects
+                .using(self.branch.database)
+                .filter(branch=self.branch, status__exact='o')
+                .prefetch_related('book', 'borrower')
+                .order_by('due_back'))
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['branch'] = self.branch
+        return context
+
+
+class CirculationDashboardView(PermissionRequiredMixin, generic.TemplateView):
+    """Shows librarians circulation statistics precomputed by the refresh_circulation_stats command"""
+    template_name = 'catalog/circulation_dashboard.html'
+    permission_required = 'catalog.can_mark_returned'
+    top_count = 10
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        this_month = datetime.date.today().replace(day=1)
+        context['summary'] = CirculationSummary.load()
+        context['top_books'] = (BookLoanStat.objects
+                                .filter(month=this_month)
+                                .select_related('book')
+                                .order_by('-loans')[:self.top_count])
+        context['top_genres'] = (GenreLoanStat.objects
+                                 .filter(month=this_month)
+                                 .select_related('genre')
+                                 .order_by('-loans')[:self.top_count])
+        return context
+
 
 @permission_required('catalog.can_mark_returned')
-def renew_book(request, pk):
-    book_instance = get_object_or_404(BookInstance, pk=pk)
+def renew_book(request, pk, branch=None):
+    # The copy number records which database holds the copy
+    copies = BookInstance.objects.using(branches.copy_database(pk))
+    success_url = reverse('all-borrowed')
+    if branch is not None:
+        # Only look for the copy in the database of its branch
+        branch = get_object_or_404(Branch, slug=branch)
+        copies = BookInstance.objects.using(branch.database).filter(branch=branch)
+        success_url = reverse('branch-borrowed', args=[branch.slug])
+    book_instance = get_object_or_404(copies, pk=pk)
 
     if request.method == 'POST':
         # Bind the form to the data from the request
         form = RenewBookForm(request.POST)
 
         if form.is_valid():
-            # Write the data to the model and save it to the database
+            # Write the data to the model and save it to the database, unless the copy changed meanwhile
             book_instance.due_back = form.cleaned_data['renewal_date']
-            book_instance.save()
-            return HttpResponseRedirect(reverse('all-borrowed'))
+            if form.cleaned_data['loaded_version'] is not None:
+                book_instance.version = form.cleaned_data['loaded_version']
+            try:
+                book_instance.save()
+                metrics.RENEWALS.inc()
+                return HttpResponseRedirect(success_url)
+            except ConcurrentUpdateError:
+                book_instance = get_object_or_404(copies, pk=pk)
+                form.add_error(None, ValidationError(CONFLICT_MESSAGE, code='conflict'))
+                form.data = form.data.copy()
+                form.data['loaded_version'] = book_instance.version
+                return render(request, 'catalog/book_renew.html',
+                              {'form': form, 'bookinst': book_instance, 'branch': branch}, status=409)
     else:
         # Create an unbound form with a suggested renewal date
         proposed_renew_date = datetime.date.today() + datetime.timedelta(weeks=3)
-        form = RenewBookForm(initial={'renewal_date': proposed_renew_date})
+        form = RenewBookForm(initial={'renewal_date': proposed_renew_date, 'loaded_version': book_instance.version})
+
+    return render(request, 'catalog/book_renew.html', {'form': form, 'bookinst': book_instance, 'branch': branch})
 
-    return render(request, 'catalog/book_renew.html', {'form': form, 'bookinst': book_instance})
+
+@permission_required('catalog.can_mark_returned')
+def renew_legacy_copy(request, uuid, branch=None):
+    """Redirects renewal links of copies catalogued with a UUID to their copy code"""
+    if branch is None:
+        found = branches.copies(BookInstance.objects.only('id', 'due_back').filter(uuid=uuid))
+        if not found:
+            raise Http404('No copy found matching the query')
+        return redirect('renew-book', found[0].id, permanent=True)
+    branch = get_object_or_404(Branch, slug=branch)
+    copy = get_object_or_404(BookInstance.objects.using(branch.database).only('id'), uuid=uuid, branch=branch)
+    return redirect('branch-renew-book', branch.slug, copy.id, permanent=True)
+
+
+def choices(request, source):
+    """Returns a page of author or genre choices for the autocomplete widgets as JSON"""
+    if source not in autocomplete.SOURCES:
+        raise Http404('No such choice list')
+    after = request.GET.get('after', '')
+    after = int(after) if after.isascii() and after.isdigit() else None
+    objects, more = autocomplete.search(source, request.GET.get('q', ''), after)
+
+    next_url = None
+    if more:
+        query = request.GET.copy()
+        query['after'] = objects[-1].pk
+        next_url = f'{request.path}?{query.urlencode()}'
+    return JsonResponse({'results': [{'id': obj.pk, 'text': str(obj)} for obj in objects], 'next': next_url})
+
+
+def export_metrics(request):
+    """Exposes the metrics of every worker process to Prometheus"""
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if token:
+        allowed = constant_time_compare(request.META.get('HTTP_AUTHORIZATION', ''), f'Bearer {token}')
+    else:
+        allowed = request.META.get('REMOTE_ADDR') in ('127.0.0.1', '::1')
+    if not allowed:
+        return HttpResponseForbidden()
+    body, content_type = metrics.render()
+    return HttpResponse(body, content_type=content_type)
+
+
+@staff_member_required
+def profile_list(request):
+    """Lists the views with a sampled profile"""
+    return render(request, 'catalog/profile_list.html', {'profiles': profiling.profiles()})
+
+
+@staff_member_required
+def profile_detail(request, view):
+    """Shows the hottest call stacks and functions of a view, or downloads its folded profile"""
+    filename = profiling.profile_file(view)
+    if not os.path.isfile(filename):
+        raise Http404('No profile for this view')
+    if 'download' in request.GET:
+        return FileResponse(open(filename, 'rb'), as_attachment=True, filename=os.path.basename(filename),
+                            content_type='text/plain')
+
+    stacks = profiling.read(filename)
+    top_stacks, top_functions = profiling.hottest(stacks)
+    context = {
+        'view': view,
+        'samples': sum(stacks.values()),
+        'top_stacks': [(profiling.view_frames(stack), count) for stack, count in top_stacks],
+        'top_functions': top_functions,
+    }
+    return render(request, 'catalog/profile_detail.html', context)
+
+
+class DuplicateListView(PermissionRequiredMixin, generic.ListView):
+    """Lists the pending duplicate candidates, most similar first, for staff to merge or dismiss"""
+    permission_required = 'catalog.change_duplicatecandidate'
+    template_name = 'catalog/duplicate_list.html'
+    paginate_by = 20
+
+    def get_queryset(self):
+        return DuplicateCandidate.objects.filter(status='p')
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        candidates = context['object_list']
+        records = {}
+        for model_name, model in merge.MODELS.items():
+            ids = [pk for c in candidates if c.model == model_name for pk in (c.first_id, c.second_id)]
+            records[model_name] = model.objects.in_bulk(ids) if ids else {}
+        # Records deleted since the candidates were found are left out
+        context['pairs'] = [(c, records[c.model][c.first_id], records[c.model][c.second_id]) for c in candidates
+                            if c.first_id in records[c.model] and c.second_id in records[c.model]]
+        return context
+
+
+@permission_required('catalog.change_duplicatecandidate')
+def resolve_duplicate(request, pk):
+    """Merges the two records of a duplicate candidate into the one chosen, or dismisses the candidate"""
+    candidate = get_object_or_404(DuplicateCandidate, pk=pk, status='p')
+    if request.method != 'POST':
+        return redirect('duplicates')
+    if 'dismiss' in request.POST:
+        candidate.status = 'd'
+        candidate.save()
+        return redirect('duplicates')
+
+    if not request.user.has_perm(f'catalog.delete_{candidate.model}'):
+        return HttpResponseForbidden()
+    keep_id = request.POST.get('keep', '')
+    try:
+        merge.merge(candidate, int(keep_id) if keep_id.isascii() and keep_id.isdigit() else None)
+    except ValueError:
+        return HttpResponse('Choose one of the two records to keep', status=400)
+    except ObjectDoesNotExist:
+        raise Http404('One of the records no longer exists')
+    return redirect('duplicates')
 
 
 class AuthorCreate(PermissionRequiredMixin, CreateView):
@@ -113,13 +403,56 @@ class AuthorCreate(PermissionRequiredMixin, CreateView):
     permission_required = 'catalog.add_author'
 
 
-class AuthorUpdate(PermissionRequiredMixin, UpdateView):
+class VersionedUpdateMixin:
+    """Saves with a VersionedModelForm and shows the latest values instead of overwriting them on a conflict"""
+
+    def get_form_class(self):
+        return modelform_factory(self.model, form=self.form_class or VersionedModelForm, fields=self.fields)
+
+    def form_valid(self, form):
+        try:
+            return super().form_valid(form)
+        except ConcurrentUpdateError:
+            form.add_error(None, ValidationError(CONFLICT_MESSAGE, code='conflict'))
+            return self.form_invalid(form)
+
+    def form_invalid(self, form):
+        if not form.has_error(NON_FIELD_ERRORS, 'conflict'):
+            return super().form_invalid(form)
+
+        current = self.model._base_manager.get(pk=self.object.pk)
+        conflict_values = []
+        for name in self.fields:
+            field = self.model._meta.get_field(name)
+            value = getattr(current, name)
+            if field.many_to_many:
+                value = ', '.join(str(item) for item in value.all())
+            conflict_values.append((form[name].label, value))
+
+        # Submitting the form again replaces the latest values with the ones entered
+        form.data = form.data.copy()
+        form.data['loaded_version'] = current.version
+        context = self.get_context_data(form=form, conflict_values=conflict_values)
+        return self.render_to_response(context, status=409)
+
+
+class AuthorUpdate(PermissionRequiredMixin, VersionedUpdateMixin, UpdateView):
     model = Author
     fields = ['first_name', 'last_name', 'date_of_birth', 'date_of_death']
     permission_required = 'catalog.change_author'
 
 
-class AuthorDelete(PermissionRequiredMixin, DeleteView):
+class DeferredDeleteMixin:
+    """Hides the object straight away and leaves its deletion to the process_deletions command"""
+
+    def delete(self, request, *args, **kwargs):
+        self.object = self.get_object()
+        success_url = self.get_success_url()
+        deletion.schedule(self.object)
+        return HttpResponseRedirect(success_url)
+
+
+class AuthorDelete(PermissionRequiredMixin, DeferredDeleteMixin, DeleteView):
     model = Author
     success_url = reverse_lazy('authors')
     permission_required = 'catalog.delete_author'
@@ -127,17 +460,18 @@ class AuthorDelete(PermissionRequiredMixin, DeleteView):
 
 class BookCreate(PermissionRequiredMixin, CreateView):
     model = Book
-    fields = '__all__'
+    form_class = BookForm
     permission_required = 'catalog.add_book'
 
 
-class BookUpdate(PermissionRequiredMixin, UpdateView):
+class BookUpdate(PermissionRequiredMixin, VersionedUpdateMixin, UpdateView):
     model = Book
-    fields = ['title', 'author', 'summary', 'isbn', 'genre', 'language']
+    form_class = BookForm
+    fields = ['title', 'author', 'summary', 'isbn', 'genre', 'language', 'cover']
     permission_required = 'catalog.change_book'
 
 
-class BookDelete(PermissionRequiredMixin, DeleteView):
+class BookDelete(PermissionRequiredMixin, DeferredDeleteMixin, DeleteView):
     model = Book
     success_url = reverse_lazy('books')
     permission_required = 'catalog.delete_book'
@@ -0,0 +1,58 @@
+"""Select widgets filled in by the browser from the autocomplete choice endpoint.
+
+They render only the selected choices, so a form costs the same to build
+whatever the number of authors or genres; static/js/autocomplete.js adds a
+search box that fetches the other choices page by page.
+"""
+from django import forms
+from django.core.exceptions import ValidationError
+from django.urls import reverse
+
+from . import refdata
+
+
+class AutocompleteMixin:
+
+    def __init__(self, source, attrs=None):
+        super().__init__(attrs)
+        self.source = source
+
+    class Media:
+        js = ('js/autocomplete.js',)
+
+    def build_attrs(self, base_attrs, extra_attrs=None):
+        attrs = super().build_attrs(base_attrs, extra_attrs)
+        attrs['data-autocomplete-url'] = reverse('choices', args=[self.source])
+        return attrs
+
+    def selected_objects(self, values):
+        """Returns the objects chosen by values, without looking at any other choice"""
+        model = self.choices.queryset.model
+        pks = []
+        for value in values:
+            try:
+                pks.append(model._meta.pk.to_python(value))
+            except ValidationError:
+                continue
+        if model in refdata.MODELS:
+            objects = refdata.objects(model)
+            return [objects[pk] for pk in pks if pk in objects]
+        return list(self.choices.queryset.filter(pk__in=pks)) if pks else []
+
+    def optgroups(self, name, value, attrs=None):
+        options = []
+        if not self.allow_multiple_selected:
+            options.append(self.create_option(name, '', self.choices.field.empty_label or '', not any(value), 0))
+        values = [item for item in value if item not in ('', None)]
+        for obj in self.selected_objects(values):
+            label = self.choices.field.label_from_instance(obj)
+            options.append(self.create_option(name, obj.pk, label, True, len(options), attrs=attrs))
+        return [(None, options, 0)]
+
+
+class AutocompleteSelect(AutocompleteMixin, forms.Select):
+    pass
+
+
+class AutocompleteSelectMultiple(AutocompleteMixin, forms.SelectMultiple):
+    pass
@@ -0,0 +1,21 @@
+"""Gunicorn settings (see the Procfile)"""
+import os
+import shutil
+import tempfile
+
+# Worker processes write their metrics to files in this directory, which /metrics adds up (see catalog.metrics).
+# It has to be set before prometheus_client is imported.
+os.environ.setdefault('prometheus_multiproc_dir', os.path.join(tempfile.gettempdir(), 'locallibrary-metrics'))
+
+from prometheus_client import multiprocess  # noqa: E402
+
+
+def on_starting(server):
+    # Start from empty files, so the counters of a previous run are not added in
+    directory = os.environ['prometheus_multiproc_dir']
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+
+
+def child_exit(server, worker):
+    multiprocess.mark_process_dead(worker.pid)
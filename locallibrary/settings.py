@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/2.1/ref/settings/
 """
 
 import os
+import tempfile
 
 import dj_database_url
 
@@ -45,10 +46,14 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
+    'catalog.middleware.MetricsMiddleware',
+    'catalog.middleware.PrerenderedPageMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'catalog.middleware.ProfilingMiddleware',
+    'catalog.middleware.ThrottleMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -85,6 +90,33 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/2.1/topics/cache/
+# The default file-based cache is shared by the workers of one machine; set $MEMCACHED_LOCATION
+# (e.g. 127.0.0.1:11211) so that workers on several machines share one cache
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('CACHE_LOCATION', os.path.join(tempfile.gettempdir(), 'locallibrary-cache')),
+    }
+}
+
+if os.environ.get('MEMCACHED_LOCATION'):
+    CACHES['default'] = {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': os.environ['MEMCACHED_LOCATION'],
+    }
+
+
+# Authentication
+# Permissions are kept in the cache between requests (see catalog.backends)
+
+AUTHENTICATION_BACKENDS = ['catalog.backends.CachedModelBackend']
+
+PERMISSION_CACHE_TIMEOUT = 300
+
+
 # Password validation
 # https://docs.djangoproject.com/en/2.1/ref/settings/#auth-password-validators
 
@@ -124,6 +156,45 @@ USE_TZ = True
 STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 
+# Uploaded files (book covers) and derived cover thumbnails
+# Django serves them only with DEBUG on. In production they are static files served by something else:
+# - object storage: set DEFAULT_FILE_STORAGE to a storage class such as django-storages' S3Boto3Storage and
+#   $MEDIA_URL to the bucket's public URL. Heroku dynos lose their files on every restart, so use this there.
+# - a web server in front of Django serving MEDIA_ROOT at MEDIA_URL (then silence catalog.W001).
+# Thumbnail names contain a hash of the cover, so the server may cache covers/thumbs/ forever
+MEDIA_URL = os.environ.get('MEDIA_URL', '/media/')
+MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+
+# Threads per worker process making cover thumbnails in the background
+COVER_THUMBNAIL_WORKERS = 2
+
+# Pre-rendered catalog pages (see the prerender_catalog command)
+PRERENDER_ROOT = os.path.join(BASE_DIR, 'prerendered')
+
+# Request throttling (see catalog.middleware.ThrottleMiddleware): for each URL name, how many
+# requests an anonymous IP address ('anon') or a logged-in user ('user') may make in a number of seconds
+THROTTLE_RATES = {
+    'index': {'anon': (30, 60), 'user': (120, 60)},
+    'books': {'anon': (30, 60), 'user': (120, 60)},
+    'authors': {'anon': (30, 60), 'user': (120, 60)},
+}
+
+# Number of proxies in front of the site whose X-Forwarded-For entries are trusted. Heroku sets $DYNO,
+# and behind its router REMOTE_ADDR is the router's, so every visitor would share one bucket without it
+THROTTLE_PROXY_COUNT = int(os.environ.get('THROTTLE_PROXY_COUNT', 1 if 'DYNO' in os.environ else 0))
+
+# Sampling profiler (see catalog.profiling): the fraction of requests profiled, the seconds between
+# samples and where the profiles are written. Staff members can also profile a request on demand
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_INTERVAL = 0.005
+PROFILE_ROOT = os.path.join(BASE_DIR, 'profiles')
+
+# Memory-mapped snapshot of the catalog written by the build_catalog_snapshot command (see catalog.snapshot)
+CATALOG_SNAPSHOT_PATH = os.path.join(BASE_DIR, 'snapshot', 'catalog.snapshot')
+
+# Bearer token Prometheus must send to read /metrics; without one, only local requests may read it
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
 # Redirect to home URL after login, instead of the default /accounts/profile/
 LOGIN_REDIRECT_URL = '/'
 
@@ -134,5 +205,13 @@ EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 db_from_env = dj_database_url.config(conn_max_age=500)
 DATABASES['default'].update(db_from_env)
 
+# Branch databases, e.g. $BRANCH_DATABASE_URLS="north=postgres://...,south=postgres://..."
+# A Branch whose database is set to one of these aliases keeps its copies there (see catalog.routers)
+for branch_database in filter(None, os.environ.get('BRANCH_DATABASE_URLS', '').split(',')):
+    alias, url = branch_database.split('=', 1)
+    DATABASES[alias.strip()] = dj_database_url.parse(url.strip(), conn_max_age=500)
+
+DATABASE_ROUTERS = ['catalog.routers.BranchRouter']
+
 # WhiteNoise: Reduce the size of static files when they are served
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
@@ -0,0 +1,20 @@
+"""
+Django settings for running the locallibrary tests.
+
+Used by `python manage.py test`, and by pytest-django through pytest.ini.
+"""
+
+import os
+
+from .settings import *  # noqa: F401,F403
+from .settings import BASE_DIR, DATABASES
+
+# A database file rather than an in-memory one, so that tests can write to it from several threads at once
+if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+    DATABASES['default']['TEST'] = {'NAME': os.path.join(BASE_DIR, 'test_db.sqlite3')}
+
+# The tests keep the copies of some branches in a second database
+DATABASES.setdefault('test_branch', {
+    'ENGINE': 'django.db.backends.sqlite3',
+    'NAME': os.path.join(BASE_DIR, 'test_branch.sqlite3'),
+})
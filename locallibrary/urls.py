@@ -20,9 +20,16 @@ from django.contrib import admin
 from django.urls import path
 from django.views.generic import RedirectView
 
+from catalog.views import export_metrics
+
 urlpatterns = [
     path('', RedirectView.as_view(url='/catalog/')),
     path('admin/', admin.site.urls),
     path('accounts/', include('django.contrib.auth.urls')),
     path('catalog/', include('catalog.urls')),
+    path('metrics', export_metrics, name='metrics'),
 ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
+
+# Uploaded book covers and their thumbnails, in development only (static() adds nothing with DEBUG off).
+# In production a web server or object storage serves them at MEDIA_URL (see settings.MEDIA_URL)
+urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -3,7 +3,9 @@ import os
 import sys
 
 if __name__ == '__main__':
-    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'locallibrary.settings')
+    # The test suite runs with settings of its own (see locallibrary/test_settings.py)
+    settings_module = 'locallibrary.test_settings' if sys.argv[1:2] == ['test'] else 'locallibrary.settings'
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', settings_module)
     try:
         from django.core.management import execute_from_command_line
     except ImportError as exc:
@@ -0,0 +1,92 @@
+// Adds a search box to the selects rendered by catalog.widgets. The selects only
+// hold the chosen options; the other choices are fetched page by page from the
+// JSON endpoint named by their data-autocomplete-url attribute.
+(function () {
+  'use strict';
+
+  function fetchChoices(url, callback) {
+    var request = new XMLHttpRequest();
+    request.open('GET', url);
+    request.onload = function () {
+      if (request.status === 200) {
+        callback(JSON.parse(request.responseText));
+      }
+    };
+    request.send();
+  }
+
+  function choose(select, choice) {
+    var option;
+    for (var i = 0; i < select.options.length; i++) {
+      if (select.options[i].value === String(choice.id)) {
+        option = select.options[i];
+      }
+    }
+    if (!option) {
+      option = new Option(choice.text, choice.id);
+      select.add(option);
+    }
+    if (!select.multiple) {
+      select.value = String(choice.id);
+    }
+    option.selected = true;
+  }
+
+  function enhance(select) {
+    var input = document.createElement('input');
+    var results = document.createElement('ul');
+    var timer;
+
+    input.type = 'search';
+    input.placeholder = 'Type to search';
+    input.setAttribute('aria-label', 'Search choices');
+    results.className = 'autocomplete-results';
+    select.parentNode.insertBefore(input, select);
+    select.parentNode.insertBefore(results, select.nextSibling);
+
+    function show(data, append) {
+      if (!append) {
+        results.innerHTML = '';
+      }
+      data.results.forEach(function (choice) {
+        var item = document.createElement('li');
+        item.textContent = choice.text;
+        item.addEventListener('click', function () {
+          choose(select, choice);
+          results.innerHTML = '';
+          input.value = '';
+        });
+        results.appendChild(item);
+      });
+      if (data.next) {
+        var more = document.createElement('li');
+        more.textContent = 'More…';
+        more.className = 'autocomplete-more';
+        more.addEventListener('click', function () {
+          results.removeChild(more);
+          fetchChoices(data.next, function (page) { show(page, true); });
+        });
+        results.appendChild(more);
+      }
+    }
+
+    input.addEventListener('input', function () {
+      clearTimeout(timer);
+      timer = setTimeout(function () {
+        if (!input.value.trim()) {
+          results.innerHTML = '';
+          return;
+        }
+        var url = select.dataset.autocompleteUrl + '?q=' + encodeURIComponent(input.value);
+        fetchChoices(url, function (page) { show(page, false); });
+      }, 250);
+    });
+  }
+
+  document.addEventListener('DOMContentLoaded', function () {
+    var selects = document.querySelectorAll('select[data-autocomplete-url]');
+    for (var i = 0; i < selects.length; i++) {
+      enhance(selects[i]);
+    }
+  });
+})();
@@ -0,0 +1,123 @@
+from django.contrib.auth.models import Permission, User
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from catalog import autocomplete
+from catalog.models import Author, Book, Genre, Language
+
+
+class ChoicesViewTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        for number in range(5):
+            Author.objects.create(first_name=f'Jo {number}', last_name='Smith')
+        Author.objects.create(first_name='Ann', last_name='Smythe')
+        Author.objects.create(first_name='Bob', last_name='Jones')
+        Author.objects.create(first_name='Juan', last_name='de la Cruz')
+        Genre.objects.create(name='Fantasy')
+        Genre.objects.create(name='Science Fiction')
+
+    def test_searches_name_prefixes(self):
+        resp = self.client.get(reverse('choices', args=['author']), {'q': 'smy'})
+        self.assertEqual(resp.json(), {'results': [{'id': 6, 'text': 'Smythe, Ann'}], 'next': None})
+
+        resp = self.client.get(reverse('choices', args=['author']), {'q': 'Smith, Jo 3'})
+        self.assertEqual([choice['text'] for choice in resp.json()['results']], ['Smith, Jo 3'])
+
+        resp = self.client.get(reverse('choices', args=['genre']), {'q': 'sci'})
+        self.assertEqual([choice['text'] for choice in resp.json()['results']], ['Science Fiction'])
+
+    def test_search_ignores_case(self):
+        for term in ('SMY', 'sMYTHE', 'smythe, ANN'):
+            resp = self.client.get(reverse('choices', args=['author']), {'q': term})
+            self.assertEqual([choice['text'] for choice in resp.json()['results']], ['Smythe, Ann'])
+
+        resp = self.client.get(reverse('choices', args=['author']), {'q': 'de la'})
+        self.assertEqual([choice['text'] for choice in resp.json()['results']], ['de la Cruz, Juan'])
+        resp = self.client.get(reverse('choices', args=['author']), {'q': 'De La'})
+        self.assertEqual([choice['text'] for choice in resp.json()['results']], ['de la Cruz, Juan'])
+
+    def test_renamed_author_is_found_by_new_name(self):
+        author = Author.objects.get(last_name='Jones')
+        author.last_name = 'JONAS'
+        author.save()
+        objects, more = autocomplete.search('author', 'jona')
+        self.assertEqual(objects, [author])
+
+    def test_non_ascii_digits_in_after_are_ignored(self):
+        resp = self.client.get(reverse('choices', args=['genre']), {'after': '\u0661'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(resp.json()['results']), 2)
+
+    def test_pages_follow_on_from_each_other(self):
+        texts = []
+        url = reverse('choices', args=['author']) + '?q=Sm'
+        while url:
+            with CaptureQueriesContext(connection) as queries:
+                data = self.client.get(url).json()
+            texts += [choice['text'] for choice in data['results']]
+            url = data['next']
+            self.assertLessEqual(len(queries), 2)
+        self.assertEqual(texts, [f'Smith, Jo {number}' for number in range(5)] + ['Smythe, Ann'])
+
+    def test_page_size(self):
+        objects, more = autocomplete.search('author', 'Smith', page_size=2)
+        self.assertEqual(len(objects), 2)
+        self.assertTrue(more)
+
+    def test_unknown_choice_list_is_404(self):
+        resp = self.client.get(reverse('choices', args=['borrower']))
+        self.assertEqual(resp.status_code, 404)
+
+
+class BookFormAutocompleteTest(TestCase):
+    PASSWORD = '12345'
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser1', password=self.PASSWORD)
+        self.user.user_permissions.add(Permission.objects.get(codename='change_book'))
+        self.client.login(username=self.user.username, password=self.PASSWORD)
+        self.author = Author.objects.create(first_name='John', last_name='Smith')
+        self.genre = Genre.objects.create(name='Fantasy')
+        self.language = Language.objects.create(name='English')
+        self.book = Book.objects.create(title='Book Title', summary='Summary', isbn='ABCDEFG',
+                                        author=self.author, language=self.language)
+        self.book.genre.set([self.genre])
+
+    def render_form(self):
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.client.get(reverse('book_update', args=[self.book.pk]))
+        return resp, len(queries)
+
+    def test_renders_only_the_selected_choices(self):
+        self.render_form()
+        resp, query_count = self.render_form()
+        self.assertContains(resp, 'data-autocomplete-url="/catalog/choices/author/"')
+        self.assertContains(resp, f'<option value="{self.author.pk}" selected>Smith, John</option>', html=True)
+
+        # More authors and genres make the form no bigger and no slower to build
+        Author.objects.bulk_create(Author(first_name=f'Jo {number}', last_name='Smith') for number in range(50))
+        Genre.objects.bulk_create(Genre(name=f'Genre {number}') for number in range(50))
+        more_resp, more_query_count = self.render_form()
+        self.assertEqual(more_query_count, query_count)
+        self.assertEqual(len(more_resp.content), len(resp.content))
+
+    def test_validates_only_the_submitted_choices(self):
+        data = {'title': 'New title', 'author': self.author.pk, 'summary': 'Summary', 'isbn': 'ABCDEFG',
+                'genre': [self.genre.pk], 'language': self.language.pk, 'loaded_version': self.book.version}
+        resp = self.client.post(reverse('book_update', args=[self.book.pk]), {**data, 'author': 999})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('author', resp.context['form'].errors)
+
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.client.post(reverse('book_update', args=[self.book.pk]), data)
+        author_queries = [query['sql'] for query in queries if 'FROM "catalog_author"' in query['sql']]
+        self.assertNotEqual(author_queries, [])
+        for sql in author_queries:
+            self.assertIn(f'"catalog_author"."id" = {self.author.pk}', sql)
+        self.assertRedirects(resp, self.book.get_absolute_url())
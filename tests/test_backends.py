@@ -0,0 +1,75 @@
+from unittest import mock
+
+from django.contrib.auth.models import Group, Permission, User
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+PERMISSION_TABLES = ('auth_permission', 'auth_group', 'auth_user_user_permissions', 'auth_user_groups')
+
+
+class CachedModelBackendTest(TestCase):
+    PASSWORD = '12345'
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser1', password=self.PASSWORD)
+        self.permission = Permission.objects.get(codename='can_mark_returned')
+
+    def permission_queries(self, url):
+        """Requests url and returns the queries that touched permission tables"""
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        return [query['sql'] for query in queries
+                if any(table in query['sql'] for table in PERMISSION_TABLES)]
+
+    def test_warm_requests_run_no_permission_queries(self):
+        self.user.user_permissions.add(self.permission)
+        self.client.login(username=self.user.username, password=self.PASSWORD)
+
+        self.assertNotEqual(self.permission_queries(reverse('all-borrowed')), [])
+        self.assertEqual(self.permission_queries(reverse('all-borrowed')), [])
+        self.assertEqual(self.permission_queries(reverse('index')), [])
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_per_process_cache_is_not_used(self):
+        # A revocation would only reach the worker that made it
+        self.user.user_permissions.add(self.permission)
+        self.client.login(username=self.user.username, password=self.PASSWORD)
+
+        self.permission_queries(reverse('all-borrowed'))
+        self.assertNotEqual(self.permission_queries(reverse('all-borrowed')), [])
+
+    def test_user_permission_changes_invalidate_cache(self):
+        self.assertFalse(User.objects.get(pk=self.user.pk).has_perm('catalog.can_mark_returned'))
+        self.user.user_permissions.add(self.permission)
+        self.assertTrue(User.objects.get(pk=self.user.pk).has_perm('catalog.can_mark_returned'))
+        self.user.user_permissions.remove(self.permission)
+        self.assertFalse(User.objects.get(pk=self.user.pk).has_perm('catalog.can_mark_returned'))
+
+    def test_group_changes_invalidate_cache(self):
+        group = Group.objects.create(name='Librarians')
+        self.user.groups.add(group)
+        self.assertFalse(User.objects.get(pk=self.user.pk).has_perm('catalog.can_mark_returned'))
+
+        group.permissions.add(self.permission)
+        self.assertTrue(User.objects.get(pk=self.user.pk).has_perm('catalog.can_mark_returned'))
+
+        group.user_set.remove(self.user)
+        self.assertFalse(User.objects.get(pk=self.user.pk).has_perm('catalog.can_mark_returned'))
+
+    def test_superuser_flag_invalidates_cache(self):
+        self.assertFalse(User.objects.get(pk=self.user.pk).has_perm('catalog.can_mark_returned'))
+        self.user.is_superuser = True
+        self.user.save()
+        self.assertTrue(User.objects.get(pk=self.user.pk).has_perm('catalog.can_mark_returned'))
+
+    def test_falls_back_to_database_when_cache_fails(self):
+        self.user.user_permissions.add(self.permission)
+        with mock.patch('catalog.backends.cache') as broken_cache:
+            broken_cache.get.side_effect = ConnectionError
+            broken_cache.delete.side_effect = ConnectionError
+            with self.assertLogs('catalog.backends', 'ERROR'):
+                self.assertTrue(User.objects.get(pk=self.user.pk).has_perm('catalog.can_mark_returned'))
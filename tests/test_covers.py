@@ -0,0 +1,106 @@
+import os
+import shutil
+import tempfile
+from io import BytesIO
+from unittest import mock
+
+from django.contrib.auth.models import Permission, User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from PIL import Image
+
+from catalog import checks, covers
+from catalog.models import Author, Book, Genre, Language
+
+
+def cover_file(name='cover.png', color='red'):
+    output = BytesIO()
+    Image.new('RGB', (800, 1200), color).save(output, 'PNG')
+    return SimpleUploadedFile(name, output.getvalue(), content_type='image/png')
+
+
+class CoverThumbnailTest(TestCase):
+    PASSWORD = '12345'
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.media_root = media_root
+
+        self.user = User.objects.create_user(username='testuser1', password=self.PASSWORD)
+        self.user.user_permissions.add(Permission.objects.get(codename='change_book'))
+        self.book = Book.objects.create(title='Book Title', summary='My book summary', isbn='ABCDEFG')
+
+    def test_upload_schedules_thumbnails_instead_of_making_them(self):
+        self.client.login(username=self.user.username, password=self.PASSWORD)
+        with mock.patch('catalog.covers.schedule') as schedule:
+            resp = self.client.post(reverse('book_update', args=[self.book.pk]), {
+                'title': 'Book Title', 'summary': 'My book summary', 'isbn': 'ABCDEFG', 'cover': cover_file(),
+                'author': Author.objects.create(first_name='John', last_name='Smith').pk,
+                'genre': [Genre.objects.create(name='Fantasy').pk],
+                'language': Language.objects.create(name='English').pk,
+            })
+        self.assertEqual(resp.status_code, 302)
+        schedule.assert_called_once_with(self.book.pk)
+
+        self.book.refresh_from_db()
+        self.assertTrue(self.book.cover)
+        self.assertEqual(self.book.cover_hash, '')
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, 'covers', 'thumbs')))
+
+    def test_thumbnails_are_named_after_content(self):
+        self.book.cover = cover_file()
+        self.book.save()
+        covers.make_thumbnails(self.book.pk)
+        self.book.refresh_from_db()
+
+        self.assertEqual(len(self.book.cover_hash), 16)
+        for width in Book.COVER_WIDTHS:
+            for extension in ('webp', 'jpg'):
+                name = self.book.cover_thumbnail_name(width, extension)
+                with Image.open(os.path.join(self.media_root, name)) as thumbnail:
+                    self.assertEqual(thumbnail.size, (width, width * 3 // 2))
+
+        # The same cover uploaded again yields the same names
+        other = Book.objects.create(title='Other', summary='Summary', isbn='ABCDEFG', cover=cover_file('other.png'))
+        covers.make_thumbnails(other.pk)
+        other.refresh_from_db()
+        self.assertEqual(other.cover_hash, self.book.cover_hash)
+
+    def test_new_cover_hides_old_thumbnails(self):
+        self.book.cover = cover_file()
+        self.book.save()
+        covers.make_thumbnails(self.book.pk)
+        self.book.refresh_from_db()
+
+        self.book.cover = cover_file(color='blue')
+        self.book.save()
+        self.assertEqual(self.book.cover_hash, '')
+
+    def test_list_page_uses_lazy_srcset(self):
+        self.book.cover = cover_file()
+        self.book.save()
+        covers.make_thumbnails(self.book.pk)
+
+        with mock.patch('catalog.covers.make_thumbnails') as make_thumbnails:
+            resp = self.client.get(reverse('books'))
+        make_thumbnails.assert_not_called()
+        self.assertContains(resp, 'loading="lazy"')
+        self.assertContains(resp, f'/media/covers/thumbs/{Book.objects.get().cover_hash}-320.webp 320w')
+
+    def test_thumbnails_are_not_served_by_django(self):
+        self.book.cover = cover_file()
+        self.book.save()
+        covers.make_thumbnails(self.book.pk)
+        self.book.refresh_from_db()
+
+        # With DEBUG off a web server or object storage serves the thumbnails as static files
+        self.assertEqual(self.client.get(self.book.cover_thumbnail_url).status_code, 404)
+        self.assertEqual([error.id for error in checks.check_media_url(None)], ['catalog.W001'])
+        with override_settings(MEDIA_URL='https://covers.example.com/media/'):
+            self.assertEqual(checks.check_media_url(None), [])
+            self.assertTrue(self.book.cover_thumbnail_url.startswith('https://covers.example.com/media/covers/thumbs/'))
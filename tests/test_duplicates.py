@@ -0,0 +1,182 @@
+import datetime
+from io import StringIO
+
+import os
+import shutil
+import tempfile
+
+from django.contrib.auth.models import Permission, User
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from catalog import duplicates, facets, merge, snapshot
+from catalog.caching import get_version
+from catalog.models import Author, Book, BookInstance, BookLoanStat, DuplicateCandidate, Genre, Loan, StalePage
+
+
+class FindDuplicatesTest(TestCase):
+
+    def setUp(self):
+        self.tolkien = Author.objects.create(first_name='John', last_name='Tolkien')
+        self.initials = Author.objects.create(first_name='J.R.R.', last_name='Tolkien')
+        self.christopher = Author.objects.create(first_name='Christopher', last_name='Tolkien')
+        self.typo = Author.objects.create(first_name='Jane', last_name='Austne')
+        self.austen = Author.objects.create(first_name='Jane', last_name='Austen')
+
+    def test_author_pairs_match_initials_and_typos(self):
+        first_ids, second_ids, scores = duplicates.find('author')
+        self.assertEqual(sorted(zip(first_ids.tolist(), second_ids.tolist())),
+                         [(self.tolkien.pk, self.initials.pk), (self.typo.pk, self.austen.pk)])
+        self.assertTrue((scores >= duplicates.THRESHOLD).all())
+
+    def test_book_pairs_match_titles_and_isbns(self):
+        hobbit = Book.objects.create(title='The Hobbit', summary='Summary', isbn='9780261102217',
+                                     author=self.tolkien)
+        hobbit_again = Book.objects.create(title='Hobbit, The', summary='Summary', isbn='978-0-261-10221-7',
+                                           author=self.initials)
+        subtitled = Book.objects.create(title='The Hobbit: or There and Back Again', summary='Summary',
+                                        isbn='', author=self.tolkien)
+        Book.objects.create(title='Emma', summary='Summary', isbn='', author=self.austen)
+
+        first_ids, second_ids, scores = duplicates.find('book')
+        pairs = dict(zip(zip(first_ids.tolist(), second_ids.tolist()), scores.tolist()))
+        self.assertEqual(pairs[(hobbit.pk, hobbit_again.pk)], duplicates.ISBN_SCORE)
+        self.assertNotIn((hobbit.pk, subtitled.pk), pairs)
+
+    def test_command_keeps_dismissed_pairs_out(self):
+        out = StringIO()
+        call_command('find_duplicates', '--model', 'author', stdout=out)
+        self.assertIn('2 pending author duplicates', out.getvalue())
+        DuplicateCandidate.objects.filter(first_id=self.typo.pk).update(status='d')
+
+        call_command('find_duplicates', '--model', 'author', stdout=out)
+        self.assertEqual(list(DuplicateCandidate.objects.values_list('first_id', 'status')),
+                         [(self.tolkien.pk, 'p'), (self.typo.pk, 'd')])
+
+    def test_benchmark_finds_planted_duplicates(self):
+        seconds, candidates, recall = duplicates.benchmark(2000)
+        self.assertGreaterEqual(candidates, 20)
+        self.assertGreater(recall, 0.9)
+
+
+class MergeTest(TestCase):
+
+    def setUp(self):
+        self.keep_author = Author.objects.create(first_name='John', last_name='Tolkien')
+        self.duplicate_author = Author.objects.create(first_name='J.R.R.', last_name='Tolkien')
+        self.fantasy = Genre.objects.create(name='Fantasy')
+        self.classics = Genre.objects.create(name='Classics')
+        self.keep = Book.objects.create(title='The Hobbit', summary='Summary', isbn='ABCDEFG',
+                                        author=self.keep_author)
+        self.duplicate = Book.objects.create(title='Hobbit, The', summary='Summary', isbn='ABCDEFG',
+                                             author=self.duplicate_author)
+        self.keep.genre.add(self.fantasy)
+        self.duplicate.genre.add(self.fantasy, self.classics)
+
+    def test_merge_authors_moves_books(self):
+        candidate = DuplicateCandidate.objects.create(model='author', first_id=self.keep_author.pk,
+                                                      second_id=self.duplicate_author.pk, score=0.95)
+        merge.merge(candidate, self.keep_author.pk)
+
+        self.assertEqual(self.keep_author.book_set.count(), 2)
+        self.assertFalse(Author.objects.filter(pk=self.duplicate_author.pk).exists())
+        self.assertEqual(Book.objects.get(pk=self.duplicate.pk).version, self.duplicate.version + 1)
+        candidate.refresh_from_db()
+        self.assertEqual(candidate.status, 'm')
+
+    def test_merge_books_moves_copies_genres_loans_and_stats(self):
+        copy = BookInstance.objects.create(book=self.duplicate, imprint='Imprint', status='a')
+        borrower = User.objects.create_user(username='reader', password='12345')
+        Loan.objects.create(book=self.duplicate, book_instance=copy, borrower=borrower,
+                            loaned_on=datetime.date(2018, 1, 5))
+        BookLoanStat.objects.create(book=self.keep, month=datetime.date(2018, 1, 1), loans=3)
+        BookLoanStat.objects.create(book=self.duplicate, month=datetime.date(2018, 1, 1), loans=2)
+        BookLoanStat.objects.create(book=self.duplicate, month=datetime.date(2018, 2, 1), loans=1)
+        other = DuplicateCandidate.objects.create(model='book', first_id=self.duplicate.pk,
+                                                  second_id=self.duplicate.pk + 1, score=0.8)
+
+        merge.merge_books(self.keep, self.duplicate)
+
+        self.assertEqual(list(self.keep.bookinstance_set.all()), [copy])
+        self.assertEqual(set(self.keep.genre.all()), {self.fantasy, self.classics})
+        self.assertEqual(Loan.objects.get().book, self.keep)
+        self.assertEqual(list(BookLoanStat.objects.order_by('month').values_list('book', 'loans')),
+                         [(self.keep.pk, 5), (self.keep.pk, 1)])
+        self.assertFalse(Book.all_objects.filter(pk=self.duplicate.pk).exists())
+        self.assertFalse(DuplicateCandidate.objects.filter(pk=other.pk).exists())
+
+    def prerender_root(self):
+        root = os.path.join(tempfile.mkdtemp(), 'prerendered')
+        self.addCleanup(shutil.rmtree, os.path.dirname(root))
+        os.mkdir(root)
+        return root
+
+    def test_merge_books_invalidates_caches_and_pages(self):
+        borrower = User.objects.create_user(username='reader', password='12345')
+        Loan.objects.create(book=self.duplicate, borrower=borrower, in_recommendations=True)
+        namespaces = (facets.CACHE_NAMESPACE, snapshot.CACHE_NAMESPACE)
+        versions = {namespace: get_version(namespace) for namespace in namespaces}
+
+        with override_settings(PRERENDER_ROOT=self.prerender_root()):
+            merge.merge_books(self.keep, self.duplicate)
+
+        for namespace, version in versions.items():
+            self.assertGreater(get_version(namespace), version)
+        self.assertTrue({reverse('book-detail', args=[self.keep.pk]), reverse('books'),
+                         reverse('author-detail', args=[self.keep_author.pk]),
+                         reverse('author-detail', args=[self.duplicate_author.pk])}
+                        .issubset(StalePage.objects.values_list('path', flat=True)))
+        # The next recommendation build recomputes the books of the moved loan's borrower
+        self.assertFalse(Loan.objects.get().in_recommendations)
+
+    def test_merge_authors_marks_book_pages_stale(self):
+        with override_settings(PRERENDER_ROOT=self.prerender_root()):
+            merge.merge_authors(self.keep_author, self.duplicate_author)
+
+        self.assertTrue({reverse('author-detail', args=[self.keep_author.pk]), reverse('authors'),
+                         reverse('books'), reverse('book-detail', args=[self.duplicate.pk])}
+                        .issubset(StalePage.objects.values_list('path', flat=True)))
+
+    def test_keep_must_be_one_of_the_pair(self):
+        candidate = DuplicateCandidate.objects.create(model='book', first_id=self.keep.pk,
+                                                      second_id=self.duplicate.pk, score=1)
+        with self.assertRaises(ValueError):
+            merge.merge(candidate, self.keep.pk + 100)
+
+
+class DuplicateViewsTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='librarian', password='12345')
+        self.user.user_permissions.add(Permission.objects.get(codename='change_duplicatecandidate'))
+        self.keep = Author.objects.create(first_name='John', last_name='Tolkien')
+        self.duplicate = Author.objects.create(first_name='J.R.R.', last_name='Tolkien')
+        self.candidate = DuplicateCandidate.objects.create(model='author', first_id=self.keep.pk,
+                                                           second_id=self.duplicate.pk, score=0.95)
+        self.url = reverse('resolve-duplicate', args=[self.candidate.pk])
+
+    def test_list_requires_permission(self):
+        resp = self.client.get(reverse('duplicates'))
+        self.assertRedirects(resp, '/accounts/login/?next=/catalog/duplicates/')
+
+        self.client.login(username='librarian', password='12345')
+        resp = self.client.get(reverse('duplicates'))
+        self.assertContains(resp, 'Tolkien, J.R.R.')
+
+    def test_dismiss(self):
+        self.client.login(username='librarian', password='12345')
+        self.assertRedirects(self.client.post(self.url, {'dismiss': '1'}), reverse('duplicates'))
+        self.candidate.refresh_from_db()
+        self.assertEqual(self.candidate.status, 'd')
+        self.assertNotContains(self.client.get(reverse('duplicates')), 'Tolkien, J.R.R.')
+
+    def test_merge_requires_delete_permission(self):
+        self.client.login(username='librarian', password='12345')
+        self.assertEqual(self.client.post(self.url, {'keep': self.keep.pk}).status_code, 403)
+
+        self.user.user_permissions.add(Permission.objects.get(codename='delete_author'))
+        self.assertEqual(self.client.post(self.url, {'keep': self.keep.pk + 100}).status_code, 400)
+        self.assertEqual(self.client.post(self.url, {'keep': '\u0661'}).status_code, 400)
+        self.assertRedirects(self.client.post(self.url, {'keep': self.keep.pk}), reverse('duplicates'))
+        self.assertFalse(Author.objects.filter(pk=self.duplicate.pk).exists())
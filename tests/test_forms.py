@@ -1,9 +1,10 @@
 import datetime
 
-from django.test import SimpleTestCase
+from django.test import SimpleTestCase, TestCase
 from django.utils import timezone
 
-from catalog.forms import RenewBookForm
+from catalog.forms import BookForm, RenewBookForm
+from catalog.models import Author, Book, ConcurrentUpdateError, Genre, Language
 
 
 class RenewBookFormTest(SimpleTestCase):
@@ -37,3 +38,47 @@ class RenewBookFormTest(SimpleTestCase):
         date = timezone.now() + datetime.timedelta(weeks=4)
         form = RenewBookForm({'renewal_date': date})
         self.assertTrue(form.is_valid())
+
+
+class BookFormTest(TestCase):
+
+    def setUp(self):
+        self.author = Author.objects.create(first_name='John', last_name='Smith')
+        self.fantasy = Genre.objects.create(name='Fantasy')
+        self.poetry = Genre.objects.create(name='Poetry')
+        self.language = Language.objects.create(name='English')
+        self.book = Book.objects.create(title='Book Title', summary='Summary', isbn='ABCDEFG', author=self.author,
+                                        language=self.language)
+        self.book.genre.add(self.fantasy)
+
+    def form(self, **data):
+        data = {'title': 'Book Title', 'summary': 'Summary', 'isbn': 'ABCDEFG', 'author': self.author.pk,
+                'language': self.language.pk, 'genre': [self.fantasy.pk], **data}
+        return BookForm(data, instance=Book.objects.get(pk=self.book.pk))
+
+    def test_genre_only_edit_bumps_the_version(self):
+        form = self.form(genre=[self.poetry.pk], loaded_version=0)
+        self.assertTrue(form.is_valid(), form.errors)
+        form.save()
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.version, 1)
+        self.assertEqual(list(self.book.genre.all()), [self.poetry])
+
+    def test_stale_genre_only_edit_is_refused(self):
+        # Both forms pass validation before either of them is saved
+        first = self.form(genre=[self.poetry.pk], loaded_version=0)
+        second = self.form(genre=[self.fantasy.pk, self.poetry.pk], loaded_version=0)
+        self.assertTrue(first.is_valid(), first.errors)
+        self.assertTrue(second.is_valid(), second.errors)
+
+        first.save()
+        with self.assertRaises(ConcurrentUpdateError):
+            second.save()
+        self.assertEqual(list(self.book.genre.all()), [self.poetry])
+
+    def test_unchanged_genres_leave_the_version_alone(self):
+        form = self.form(title='New Title', loaded_version=0)
+        self.assertTrue(form.is_valid(), form.errors)
+        form.save()
+        self.book.refresh_from_db()
+        self.assertEqual((self.book.title, self.book.version), ('New Title', 1))
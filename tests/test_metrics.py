@@ -0,0 +1,71 @@
+import datetime
+
+from django.contrib.auth.models import Permission, User
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from prometheus_client import REGISTRY
+
+from catalog.models import Author, Book, BookInstance
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+class MetricsTest(TestCase):
+    PASSWORD = '12345'
+
+    def setUp(self):
+        cache.clear()
+
+    def test_records_requests_by_url_name(self):
+        before = {
+            'requests': sample('catalog_request_latency_seconds_count', view='books'),
+            'bytes': sample('catalog_response_size_bytes_sum', view='books'),
+            'queries': sample('catalog_db_queries_total', view='books'),
+        }
+        resp = self.client.get(reverse('books'))
+
+        self.assertEqual(sample('catalog_request_latency_seconds_count', view='books'), before['requests'] + 1)
+        self.assertEqual(sample('catalog_response_size_bytes_sum', view='books'),
+                         before['bytes'] + len(resp.content))
+        self.assertGreater(sample('catalog_db_queries_total', view='books'), before['queries'])
+
+    def test_counts_cache_hits_and_misses(self):
+        misses = sample('catalog_cache_lookups_total', cache='facets', result='miss')
+        hits = sample('catalog_cache_lookups_total', cache='facets', result='hit')
+        self.client.get(reverse('books'))
+        self.client.get(reverse('books'))
+        # The book list and its facet counts each look the facet index up
+        self.assertEqual(sample('catalog_cache_lookups_total', cache='facets', result='miss'), misses + 1)
+        self.assertEqual(sample('catalog_cache_lookups_total', cache='facets', result='hit'), hits + 3)
+
+    def test_counts_renewals(self):
+        user = User.objects.create_user(username='librarian', password=self.PASSWORD)
+        user.user_permissions.add(Permission.objects.get(codename='can_mark_returned'))
+        book = Book.objects.create(title='Book Title', summary='Summary', isbn='ABCDEFG',
+                                   author=Author.objects.create(first_name='John', last_name='Smith'))
+        copy = BookInstance.objects.create(book=book, imprint='2016', status='o', borrower=user,
+                                           due_back=datetime.date.today())
+        self.client.login(username=user.username, password=self.PASSWORD)
+
+        renewals = sample('catalog_renewals_total')
+        self.client.post(reverse('renew-book', args=[copy.pk]),
+                         {'renewal_date': datetime.date.today() + datetime.timedelta(weeks=1)})
+        self.assertEqual(sample('catalog_renewals_total'), renewals + 1)
+
+    def test_exposes_metrics_to_local_requests(self):
+        self.client.get(reverse('books'))
+        resp = self.client.get(reverse('metrics'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertContains(resp, 'catalog_request_latency_seconds_bucket{le="0.005",view="books"}')
+
+        resp = self.client.get(reverse('metrics'), REMOTE_ADDR='203.0.113.7')
+        self.assertEqual(resp.status_code, 403)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_token_protects_metrics(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        resp = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(resp.status_code, 200)
@@ -1,6 +1,10 @@
-from django.test import TestCase
+import threading
 
-from catalog.models import Author
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+
+from catalog.models import Author, ConcurrentUpdateError
 
 
 class AuthorModelTest(TestCase):
@@ -48,3 +52,113 @@ class AuthorModelTest(TestCase):
     def test_get_absolute_url(self):
         author = Author.objects.get(id=1)
         self.assertEqual(author.get_absolute_url(), '/catalog/author/1')
+
+
+class VersionedModelTest(TestCase):
+
+    def setUp(self):
+        self.author = Author.objects.create(first_name='Big', last_name='Bob')
+
+    def test_save_compares_the_loaded_version(self):
+        author = Author.objects.get(pk=self.author.pk)
+        author.first_name = 'Robert'
+        with CaptureQueriesContext(connection) as queries:
+            author.save()
+        updates = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.assertRegex(updates[0], r'WHERE .*"version" = 0')
+        self.assertFalse(any('FOR UPDATE' in query['sql'] for query in queries.captured_queries))
+
+    def test_stale_save_is_refused(self):
+        # Two librarians open the same record
+        first = Author.objects.get(pk=self.author.pk)
+        second = Author.objects.get(pk=self.author.pk)
+
+        first.first_name = 'Robert'
+        first.save()
+        second.last_name = 'Roberts'
+        with self.assertRaises(ConcurrentUpdateError):
+            second.save()
+
+        # After reloading, the second librarian can save their edit on top of the first
+        second.refresh_from_db()
+        second.last_name = 'Roberts'
+        second.save()
+        author = Author.objects.get(pk=self.author.pk)
+        self.assertEqual((author.first_name, author.last_name, author.version), ('Robert', 'Roberts', 2))
+
+    def test_save_writes_only_changed_fields(self):
+        author = Author.objects.get(pk=self.author.pk)
+        author.last_name = 'Roberts'
+        with CaptureQueriesContext(connection) as queries:
+            author.save()
+        updates = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.assertIn('"last_name"', updates[0])
+        self.assertNotIn('"first_name"', updates[0])
+
+        # Saving an unchanged record does not touch the database
+        with self.assertNumQueries(0):
+            author.save()
+
+
+class ConcurrentEditTest(TransactionTestCase):
+
+    def test_concurrent_edits_do_not_lose_updates(self):
+        author = Author.objects.create(first_name='Big', last_name='Bob')
+        loaded = threading.Barrier(2)
+        outcomes = {}
+
+        def edit(field, value):
+            try:
+                # Both librarians open the record before either of them saves, then both save at once
+                record = Author.objects.get(pk=author.pk)
+                loaded.wait(timeout=5)
+                setattr(record, field, value)
+                record.save()
+                outcomes[field] = 'saved'
+            except ConcurrentUpdateError:
+                outcomes[field] = 'conflict'
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=edit, args=('first_name', 'Robert')),
+                   threading.Thread(target=edit, args=('last_name', 'Roberts'))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Exactly one edit is kept and the other is refused rather than overwritten
+        self.assertEqual(sorted(outcomes.values()), ['conflict', 'saved'])
+        author.refresh_from_db()
+        self.assertEqual(author.version, 1)
+        self.assertIn((author.first_name, author.last_name), [('Robert', 'Bob'), ('Big', 'Roberts')])
+
+    def test_open_records_do_not_hold_up_saves(self):
+        author = Author.objects.create(first_name='Big', last_name='Bob')
+        outcomes = []
+
+        def edit():
+            try:
+                # Fail at once rather than wait if the record were locked
+                with connection.cursor() as cursor:
+                    cursor.execute('PRAGMA busy_timeout = 0')
+                record = Author.objects.get(pk=author.pk)
+                record.first_name = 'Robert'
+                record.save()
+                outcomes.append('saved')
+            finally:
+                connection.close()
+
+        # One librarian has the record open in a transaction while another saves it
+        with transaction.atomic():
+            record = Author.objects.get(pk=author.pk)
+            thread = threading.Thread(target=edit)
+            thread.start()
+            thread.join()
+        self.assertEqual(outcomes, ['saved'])
+
+        record.last_name = 'Roberts'
+        with self.assertRaises(ConcurrentUpdateError):
+            record.save()
@@ -0,0 +1,168 @@
+import gzip
+import os
+import shutil
+import tempfile
+from io import StringIO
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from catalog.management.commands.prerender_catalog import Command
+from catalog.models import Author, Book, BookInstance, StalePage
+
+
+class PrerenderCatalogTest(TestCase):
+    PASSWORD = '12345'
+
+    def setUp(self):
+        self.root = os.path.join(tempfile.mkdtemp(), 'prerendered')
+        self.addCleanup(shutil.rmtree, os.path.dirname(self.root))
+        settings_override = override_settings(PRERENDER_ROOT=self.root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.author = Author.objects.create(first_name='John', last_name='Smith')
+        for book_num in range(12):
+            Book.objects.create(title=f'Book {book_num}', summary='Summary', isbn='ABCDEFG', author=self.author)
+        self.book = Book.objects.first()
+
+    def prerender(self, *args):
+        call_command('prerender_catalog', '--workers', '1', *args, stdout=StringIO())
+
+    def read_page(self, *parts):
+        with open(os.path.join(self.root, *parts), 'rb') as f:
+            return f.read()
+
+    def test_full_build_writes_public_pages(self):
+        self.prerender()
+        self.assertIn(b'Book 0', self.read_page('catalog', 'books', 'index.html'))
+        self.assertIn(b'Book 11', self.read_page('catalog', 'books', 'page-2.html'))
+        self.assertIn(b'Smith, John', self.read_page('catalog', 'authors', 'index.html'))
+        self.assertIn(b'Summary', self.read_page('catalog', 'book', str(self.book.pk), 'index.html'))
+        self.assertIn(b'Book 0', self.read_page('catalog', 'author', str(self.author.pk), 'index.html'))
+
+        page = self.read_page('catalog', 'books', 'index.html')
+        self.assertEqual(gzip.decompress(self.read_page('catalog', 'books', 'index.html.gz')), page)
+
+    def test_only_stale_pages_are_rendered_again(self):
+        self.prerender()
+        self.assertFalse(StalePage.objects.exists())
+
+        self.book.title = 'Renamed book'
+        self.book.save()
+        BookInstance.objects.create(book=self.book, imprint='2016', status='a')
+        self.assertEqual(set(StalePage.objects.values_list('path', flat=True)), {
+            reverse('book-detail', args=[self.book.pk]), reverse('author-detail', args=[self.author.pk]),
+            reverse('books') + '?page=1',
+        })
+
+        # The second page of the book list does not show the book, so it is left as it was
+        with open(os.path.join(self.root, 'catalog', 'books', 'page-2.html'), 'wb') as f:
+            f.write(b'left alone')
+        self.prerender()
+        self.assertIn(b'Renamed book', self.read_page('catalog', 'book', str(self.book.pk), 'index.html'))
+        self.assertIn(b'Renamed book', self.read_page('catalog', 'author', str(self.author.pk), 'index.html'))
+        self.assertIn(b'Renamed book', self.read_page('catalog', 'books', 'index.html'))
+        self.assertEqual(self.read_page('catalog', 'books', 'page-2.html'), b'left alone')
+        self.assertFalse(StalePage.objects.exists())
+
+    def test_added_and_removed_books_mark_the_pages_they_shift(self):
+        self.prerender()
+        # A new book goes at the end of the list, which keeps its two pages
+        Book.objects.create(title='Book 12', summary='Summary', isbn='ABCDEFG')
+        self.assertIn(reverse('books') + '?page=2', StalePage.objects.values_list('path', flat=True))
+        self.assertNotIn(reverse('books') + '?page=1', StalePage.objects.values_list('path', flat=True))
+        self.prerender()
+        self.assertIn(b'Book 12', self.read_page('catalog', 'books', 'page-2.html'))
+
+        # Removing the first book moves a book from the second page to the first
+        self.book.delete()
+        self.assertTrue({reverse('books') + '?page=1', reverse('books') + '?page=2'}.issubset(
+            StalePage.objects.values_list('path', flat=True)))
+        self.prerender()
+        self.assertIn(b'Book 10', self.read_page('catalog', 'books', 'index.html'))
+
+        # Every page shows the number of pages, so a change to it marks the whole list
+        for number in range(13, 22):
+            Book.objects.create(title=f'Book {number}', summary='Summary', isbn='ABCDEFG')
+        self.assertIn(reverse('books'), StalePage.objects.values_list('path', flat=True))
+        self.prerender()
+        self.assertIn(b'Page 1 of 3', self.read_page('catalog', 'books', 'index.html'))
+
+    def test_renamed_authors_mark_the_pages_showing_them(self):
+        Author.objects.create(first_name='Ann', last_name='Adams')
+        self.prerender()
+        self.author.last_name = 'Aaronson'
+        self.author.save()
+        self.assertTrue({reverse('authors') + '?page=1', reverse('books') + '?page=1',
+                         reverse('books') + '?page=2'}.issubset(StalePage.objects.values_list('path', flat=True)))
+        self.prerender()
+        self.assertIn(b'Aaronson, John', self.read_page('catalog', 'books', 'page-2.html'))
+        authors = self.read_page('catalog', 'authors', 'index.html')
+        self.assertLess(authors.index(b'Aaronson'), authors.index(b'Adams'))
+
+    def test_stale_pages_are_rendered_through_the_pool(self):
+        self.prerender()
+        self.author.first_name = 'Jon'
+        self.author.save()
+        with mock.patch.object(Command, 'render_in_pool', autospec=True, return_value=0) as render_in_pool:
+            self.prerender()
+        (_, root, pages), _ = render_in_pool.call_args
+        self.assertEqual(root, self.root)
+        self.assertIn((reverse('books'), 2), pages)
+
+    def test_deleted_pages_are_removed(self):
+        self.prerender()
+        book_page = os.path.join(self.root, 'catalog', 'book', str(self.book.pk), 'index.html')
+        self.book.delete()
+        self.prerender()
+        self.assertFalse(os.path.exists(book_page))
+
+    def test_pages_beyond_a_shrunk_list_are_removed(self):
+        self.prerender()
+        second_page = os.path.join(self.root, 'catalog', 'books', 'page-2.html')
+        self.assertTrue(os.path.exists(second_page + '.gz'))
+        for book in Book.objects.all()[:5]:
+            book.delete()
+        self.prerender()
+        self.assertFalse(os.path.exists(second_page))
+        self.assertFalse(os.path.exists(second_page + '.gz'))
+
+    def test_anonymous_requests_are_served_from_disk(self):
+        self.prerender()
+        with open(os.path.join(self.root, 'catalog', 'books', 'index.html'), 'wb') as f:
+            f.write(b'pre-rendered')
+
+        resp = self.client.get(reverse('books'))
+        self.assertEqual(b''.join(resp.streaming_content), b'pre-rendered')
+        self.assertIn('Cookie', resp['Vary'])
+
+        resp = self.client.get(reverse('books'), HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(resp['Content-Encoding'], 'gzip')
+
+    def test_visiting_the_home_page_creates_no_session(self):
+        self.prerender()
+        self.client.get(reverse('index'))
+        resp = self.client.get(reverse('index'))
+        self.assertEqual(resp.context['num_visits'], 1)
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, self.client.cookies)
+        self.assertTrue(self.client.get(reverse('books')).streaming)
+
+    def test_malformed_page_numbers_reach_views(self):
+        self.prerender()
+        resp = self.client.get(reverse('books'), {'page': '\u00b2'})
+        self.assertEqual(resp.status_code, 404)
+
+    def test_logged_in_and_filtered_requests_reach_views(self):
+        self.prerender()
+        resp = self.client.get(reverse('books'), {'language': 1})
+        self.assertTemplateUsed(resp, 'catalog/book_list.html')
+
+        User.objects.create_user(username='testuser1', password=self.PASSWORD)
+        self.client.login(username='testuser1', password=self.PASSWORD)
+        resp = self.client.get(reverse('books'))
+        self.assertTemplateUsed(resp, 'catalog/book_list.html')
@@ -0,0 +1,128 @@
+import fcntl
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from catalog import profiling
+
+
+def busy_loop(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class SamplerTest(TestCase):
+
+    def test_samples_the_stack_of_the_profiled_thread(self):
+        sampler = profiling.Sampler(interval=0.001).start()
+        busy_loop(0.1)
+        stacks = sampler.stop()
+
+        self.assertGreater(sum(stacks.values()), 0)
+        stack, _ = stacks.most_common(1)[0]
+        self.assertIn('test_profiling.busy_loop', stack.split(';'))
+        self.assertFalse(sampler._thread.is_alive())
+
+    def test_samples_another_thread(self):
+        thread = threading.Thread(target=busy_loop, args=(0.1,))
+        thread.start()
+        sampler = profiling.Sampler(thread.ident, interval=0.001).start()
+        thread.join()
+        self.assertTrue(any('test_profiling.busy_loop' in stack for stack in sampler.stop()))
+
+
+class ProfilingMiddlewareTest(TestCase):
+    PASSWORD = '12345'
+    STACKS = Counter({'base._get_response;views.index;shortcuts.render': 3, 'base._get_response;views.index': 1})
+
+    def setUp(self):
+        cache.clear()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        settings_override = override_settings(PROFILE_ROOT=self.root, PROFILE_SAMPLE_RATE=0)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        patcher = mock.patch.object(profiling.Sampler, 'stop', return_value=self.STACKS)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.staff = User.objects.create_user(username='staff', password=self.PASSWORD, is_staff=True)
+        self.user = User.objects.create_user(username='patron', password=self.PASSWORD)
+
+    def test_staff_can_profile_a_request(self):
+        self.client.login(username=self.staff.username, password=self.PASSWORD)
+        self.client.get(reverse('index'), {'profile': 1})
+        self.client.get(reverse('index'), HTTP_X_PROFILE='1')
+
+        stacks = profiling.read(os.path.join(self.root, 'index.folded'))
+        self.assertEqual(stacks, self.STACKS + self.STACKS)
+
+    def test_other_requests_are_not_profiled(self):
+        self.client.get(reverse('index'), {'profile': 1})
+        self.client.login(username=self.user.username, password=self.PASSWORD)
+        self.client.get(reverse('index'), {'profile': 1})
+        self.client.get(reverse('index'))
+        self.client.logout()
+        self.client.login(username=self.staff.username, password=self.PASSWORD)
+        self.client.get(reverse('index'), {'noprofile': 1})
+        self.client.get(reverse('index'), {'profile': 10})
+        self.assertEqual(os.listdir(self.root), [])
+
+    def test_samples_a_fraction_of_requests(self):
+        with override_settings(PROFILE_SAMPLE_RATE=1):
+            self.client.get(reverse('books'))
+        self.assertEqual(sorted(os.listdir(self.root)), ['books.folded', 'books.folded.lock'])
+
+    def test_staff_can_browse_profiles(self):
+        profiling.record('index', self.STACKS)
+        self.client.login(username=self.staff.username, password=self.PASSWORD)
+
+        resp = self.client.get(reverse('profiles'))
+        self.assertEqual(resp.context['profiles'], [('index', 4)])
+
+        resp = self.client.get(reverse('profile-detail', args=['index']))
+        self.assertEqual(resp.context['top_stacks'][0], (['views.index', 'shortcuts.render'], 3))
+        self.assertEqual(resp.context['top_functions'][0], ('shortcuts.render', 3))
+
+        resp = self.client.get(reverse('profile-detail', args=['index']), {'download': 1})
+        self.assertEqual(b''.join(resp.streaming_content).decode().count('\n'), 2)
+
+        self.client.login(username=self.user.username, password=self.PASSWORD)
+        self.assertEqual(self.client.get(reverse('profiles')).status_code, 302)
+
+    def test_large_profiles_are_compacted(self):
+        with mock.patch.object(profiling, 'MAX_PROFILE_BYTES', 200):
+            for _ in range(5):
+                profiling.record('index', self.STACKS)
+        filename = os.path.join(self.root, 'index.folded')
+        with open(filename) as profile:
+            self.assertLessEqual(len(profile.readlines()), 4)
+        self.assertEqual(sum(profiling.read(filename).values()), 20)
+
+    def test_appends_wait_for_compaction(self):
+        profiling.record('index', self.STACKS)
+        filename = os.path.join(self.root, 'index.folded')
+        appending = threading.Thread(target=profiling.record, args=('index', self.STACKS))
+
+        with profiling.locked(filename, fcntl.LOCK_EX):
+            appending.start()
+            appending.join(0.2)
+            self.assertTrue(appending.is_alive())
+            # Replace the file the way compaction does
+            temporary = f'{filename}.tmp'
+            shutil.copy(filename, temporary)
+            os.replace(temporary, filename)
+        appending.join()
+
+        self.assertEqual(profiling.read(filename), self.STACKS + self.STACKS)
@@ -0,0 +1,107 @@
+import time
+from unittest import mock
+
+from django.contrib.auth.models import Permission, User
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from catalog import caching, refdata
+from catalog.caching import bump_version
+from catalog.forms import BookForm
+from catalog.models import Author, Book, Genre, Language
+
+REFERENCE_TABLES = ('"catalog_genre"', '"catalog_language"')
+
+
+class ReferenceDataTest(TestCase):
+    PASSWORD = '12345'
+
+    def setUp(self):
+        cache.clear()
+        refdata.invalidate()
+        self.user = User.objects.create_user(username='testuser1', password=self.PASSWORD)
+        self.user.user_permissions.add(Permission.objects.get(codename='add_book'))
+        self.fantasy = Genre.objects.create(name='Fantasy')
+        self.english = Language.objects.create(name='English')
+        self.book = Book.objects.create(title='Book Title', summary='Summary', isbn='ABCDEFG',
+                                        author=Author.objects.create(first_name='John', last_name='Smith'),
+                                        language=self.english)
+        self.book.genre.set([self.fantasy])
+
+    def reference_queries(self, url):
+        """Requests url and returns the queries that touched the genre or language tables"""
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        return [query['sql'] for query in queries
+                if any(table in query['sql'] for table in REFERENCE_TABLES)]
+
+    def test_warm_requests_run_no_reference_queries(self):
+        self.client.login(username=self.user.username, password=self.PASSWORD)
+
+        self.assertNotEqual(self.reference_queries(reverse('book_create')), [])
+        self.assertEqual(self.reference_queries(reverse('book_create')), [])
+        self.assertEqual(self.reference_queries(self.book.get_absolute_url()), [])
+        self.assertEqual(self.reference_queries(reverse('index')), [])
+
+    def test_book_detail_shows_cached_genres_and_language(self):
+        resp = self.client.get(self.book.get_absolute_url())
+        self.assertContains(resp, 'Fantasy')
+        self.assertContains(resp, 'English')
+
+    def test_changes_reach_every_worker(self):
+        self.assertEqual(list(refdata.objects(Genre).values()), [self.fantasy])
+
+        # Another worker adds a genre: nothing changes until the version is checked again
+        Genre.objects.bulk_create([Genre(name='Poetry')])
+        bump_version(refdata.CACHE_NAMESPACE)
+        self.assertEqual(len(refdata.objects(Genre)), 1)
+        refdata.expire()
+        self.assertEqual(len(refdata.objects(Genre)), 2)
+
+        # Saves in this worker are visible straight away
+        self.fantasy.name = 'High fantasy'
+        self.fantasy.save()
+        self.assertEqual(refdata.get(Genre, self.fantasy.pk).name, 'High fantasy')
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_changes_reach_every_worker_when_the_cache_is_not_shared(self):
+        self.assertEqual(len(refdata.objects(Genre)), 1)
+
+        # Another worker adds a genre, but cannot bump the version this worker checks
+        Genre.objects.bulk_create([Genre(name='Poetry')])
+        refdata.expire()
+        self.assertEqual(len(refdata.objects(Genre)), 1)
+
+        later = time.monotonic() + caching.UNSHARED_TIMEOUT + 1
+        with mock.patch('time.monotonic', return_value=later):
+            refdata.expire()
+            self.assertEqual(len(refdata.objects(Genre)), 2)
+
+    def test_book_form_validates_against_cached_choices(self):
+        data = {'title': 'Another', 'author': self.book.author_id, 'summary': 'Summary', 'isbn': '123',
+                'genre': [self.fantasy.pk], 'language': self.english.pk}
+        form = BookForm(data)
+        self.assertTrue(form.is_valid(), form.errors)
+        self.assertEqual(form.cleaned_data['genre'], [self.fantasy])
+        self.assertEqual(form.cleaned_data['language'], self.english)
+
+        form = BookForm({**data, 'genre': [self.fantasy.pk + 100], 'language': self.english.pk + 100})
+        self.assertFalse(form.is_valid())
+        self.assertIn('genre', form.errors)
+        self.assertIn('language', form.errors)
+
+    def test_admin_book_list_reads_genres_in_one_query(self):
+        for number in range(3):
+            book = Book.objects.create(title=f'Book {number}', summary='Summary', isbn='ABCDEFG')
+            book.genre.set([self.fantasy])
+        admin = User.objects.create_superuser('admin', 'admin@example.com', self.PASSWORD)
+        self.client.force_login(admin)
+        self.client.get(reverse('admin:catalog_book_changelist'))
+
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.client.get(reverse('admin:catalog_book_changelist'))
+        self.assertContains(resp, 'Fantasy', count=4)
+        self.assertEqual(len([query for query in queries if '"catalog_book_genre"' in query['sql']]), 1)
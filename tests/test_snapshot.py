@@ -0,0 +1,163 @@
+import datetime
+import os
+import shutil
+import tempfile
+from io import StringIO
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from catalog import snapshot
+from catalog.models import Author, Book, BookInstance, BookRecommendation, Branch, Genre, Language
+
+
+class CatalogSnapshotTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.filename = os.path.join(self.root, 'snapshot', 'catalog.snapshot')
+        settings_override = override_settings(CATALOG_SNAPSHOT_PATH=self.filename)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(snapshot.expire)
+
+        self.author = Author.objects.create(first_name='John', last_name='Smith',
+                                            date_of_birth=datetime.date(1950, 1, 2))
+        Author.objects.create(first_name='Jane', last_name='Austen')
+        fantasy = Genre.objects.create(name='Fantasy')
+        english = Language.objects.create(name='English')
+        self.books = []
+        for book_num in range(12):
+            book = Book.objects.create(title=f'Book {book_num}', summary='Summary', isbn='ABCDEFG',
+                                       author=self.author, language=english)
+            book.genre.add(fantasy)
+            self.books.append(book)
+        self.north = Branch.objects.create(name='North', slug='north')
+        self.copy = BookInstance.objects.create(book=self.books[0], imprint='Imprint 2016', status='a',
+                                                branch=self.north)
+        BookRecommendation.objects.create(book=self.books[0], recommended=self.books[1], rank=1, score=0.5)
+
+    def build(self, *args):
+        out = StringIO()
+        call_command('build_catalog_snapshot', *args, stdout=out)
+        snapshot.expire()
+        return out.getvalue()
+
+    def test_snapshot_round_trips_the_catalog(self):
+        self.build()
+        catalog = snapshot.current()
+
+        book = catalog.book(self.books[0].pk)
+        self.assertEqual((book.title, book.isbn, book.language), ('Book 0', 'ABCDEFG', 'English'))
+        self.assertEqual(book.get_genres(), ['Fantasy'])
+        self.assertEqual(str(book.author), 'Smith, John')
+        self.assertEqual(book.author.date_of_birth, datetime.date(1950, 1, 2))
+        self.assertEqual(book.get_absolute_url(), self.books[0].get_absolute_url())
+        self.assertEqual([copy.code for copy in book.bookinstance_set.all()], [self.copy.code])
+        self.assertEqual(book.branch_availability, [('North', 1)])
+        self.assertEqual([r.recommended.title for r in book.recommendations], ['Book 1'])
+        self.assertIsNone(catalog.book(self.books[-1].pk + 1))
+
+        self.assertEqual([str(author) for author in catalog.authors()], ['Austen, Jane', 'Smith, John'])
+        self.assertEqual(catalog.author(self.author.pk).book_set.count(), 12)
+        self.assertEqual([book.title for book in catalog.books()[10:]], ['Book 10', 'Book 11'])
+
+    def test_rows_added_during_the_build_are_skipped(self):
+        Author.objects.create(first_name='Ann', last_name='Smith')
+
+        def add_rows(*fields):
+            # Runs between the queries of the build, which do not read one consistent state
+            book = Book.objects.create(title='New Book', summary='Summary', isbn='ABCDEFG', author=self.author)
+            self.books[0].genre.add(Genre.objects.create(name='Poetry'))
+            BookRecommendation.objects.create(book=self.books[0], recommended=book, rank=2, score=0.4)
+            return Language.objects.values_list(*fields)
+
+        with mock.patch('catalog.snapshot.Language') as languages:
+            languages.objects.values_list.side_effect = add_rows
+            snapshot.build(self.filename)
+
+        catalog = snapshot.Snapshot(self.filename)
+        book = catalog.book(self.books[0].pk)
+        self.assertEqual(book.get_genres(), ['Fantasy'])
+        self.assertEqual([r.recommended.title for r in book.recommendations], ['Book 1'])
+        self.assertEqual([str(author) for author in catalog.authors()], ['Austen, Jane', 'Smith, Ann', 'Smith, John'])
+
+    def test_pages_are_served_without_queries(self):
+        self.build()
+        self.client.get(reverse('books'))  # Caches the facet counts
+
+        with self.assertNumQueries(0):
+            resp = self.client.get(reverse('books'), {'page': 2})
+        self.assertEqual([book.title for book in resp.context['book_list']], ['Book 10', 'Book 11'])
+        with self.assertNumQueries(0):
+            resp = self.client.get(reverse('book-detail', args=[self.books[0].pk]))
+        self.assertContains(resp, self.copy.code)
+        self.assertContains(resp, 'North (1)')
+        with self.assertNumQueries(0):
+            resp = self.client.get(reverse('authors'))
+        self.assertContains(resp, 'Austen, Jane')
+        with self.assertNumQueries(0):
+            resp = self.client.get(reverse('author-detail', args=[self.author.pk]))
+        self.assertContains(resp, 'Book 11')
+
+        self.assertEqual(self.client.get(reverse('book-detail', args=[self.books[-1].pk + 1])).status_code, 404)
+
+    def test_changes_fall_back_to_the_database_until_rebuilt(self):
+        self.build()
+        self.books[0].title = 'New title'
+        self.books[0].save()
+
+        resp = self.client.get(reverse('book-detail', args=[self.books[0].pk]))
+        self.assertIsInstance(resp.context['book'], Book)
+        self.assertContains(resp, 'New title')
+
+        self.assertIn('Wrote 12 books', self.build())
+        self.assertIn('up to date', self.build())
+        resp = self.client.get(reverse('book-detail', args=[self.books[0].pk]))
+        self.assertIsInstance(resp.context['book'], snapshot.BookRecord)
+        self.assertContains(resp, 'New title')
+
+    def test_circulation_patches_the_snapshot(self):
+        self.build()
+        self.copy.status = 'o'
+        self.copy.due_back = datetime.date(2030, 1, 1)
+        self.copy.save()
+        snapshot.expire()
+        self.assertIsNotNone(snapshot.current())
+
+        # Run by the signal handler once the transaction commits, which test transactions never do
+        snapshot.patch_copies(self.books[0].pk)
+        with self.assertNumQueries(0):
+            resp = self.client.get(reverse('book-detail', args=[self.books[0].pk]))
+        self.assertIsInstance(resp.context['book'], snapshot.BookRecord)
+        self.assertContains(resp, 'On loan')
+        self.assertContains(resp, 'Jan. 1, 2030')
+        self.assertContains(resp, 'North (0)')
+
+    def test_new_copies_invalidate_the_snapshot(self):
+        self.build()
+        BookInstance.objects.create(book=self.books[1], imprint='Imprint 2017', status='a')
+        snapshot.expire()
+        self.assertIsNone(snapshot.current())
+
+    def test_filtered_lists_use_the_database(self):
+        self.build()
+        resp = self.client.get(reverse('books'), {'available': 1})
+        self.assertEqual(list(resp.context['book_list']), [self.books[0]])
+
+    def test_rebuild_replaces_the_file_atomically(self):
+        self.build()
+        first = snapshot.current()
+        Book.objects.create(title='Another book', summary='Summary', isbn='ABCDEFG')
+        self.build()
+
+        self.assertIsNot(snapshot.current(), first)
+        self.assertEqual(len(snapshot.current().books()), 13)
+        self.assertEqual(os.listdir(os.path.dirname(self.filename)), ['catalog.snapshot'])
+        # Readers of the previous snapshot keep their mapping
+        self.assertEqual(first.book(self.books[0].pk).title, 'Book 0')
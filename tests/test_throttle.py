@@ -0,0 +1,78 @@
+import datetime
+from unittest import mock
+
+from django.contrib.auth.models import Permission, User
+from django.core.cache import cache
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, reverse
+
+from catalog.middleware import ThrottleMiddleware
+from catalog.models import Book, BookInstance
+
+
+@override_settings(THROTTLE_RATES={'books': {'anon': (5, 60), 'user': (10, 60)}})
+class ThrottleMiddlewareTest(TestCase):
+    PASSWORD = '12345'
+
+    def setUp(self):
+        cache.clear()
+        self.librarian = User.objects.create_user(username='testuser1', password=self.PASSWORD)
+        self.librarian.user_permissions.add(Permission.objects.get(codename='can_mark_returned'))
+        book = Book.objects.create(title='Book Title', summary='My book summary', isbn='ABCDEFG')
+        self.copy = BookInstance.objects.create(book=book, imprint='2016', status='o',
+                                                due_back=datetime.date.today(), borrower=self.librarian)
+
+    def crawl(self, count, **extra):
+        return [self.client.get(reverse('books'), **extra).status_code for _ in range(count)]
+
+    def test_anonymous_client_is_throttled_after_burst(self):
+        self.assertEqual(self.crawl(7), [200] * 5 + [429] * 2)
+        resp = self.client.get(reverse('books'))
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(resp['Retry-After'], '12')
+
+    def test_clients_have_separate_buckets(self):
+        self.crawl(6)
+        self.assertEqual(self.crawl(1, REMOTE_ADDR='10.0.0.2'), [200])
+        self.client.login(username=self.librarian.username, password=self.PASSWORD)
+        self.assertEqual(self.crawl(10), [200] * 10)
+
+    def test_throttled_requests_do_not_reach_database(self):
+        self.crawl(5)
+        self.assertNumQueries(0, self.crawl, 20)
+
+    def test_unthrottled_endpoints_are_unaffected_by_crawl(self):
+        librarian = self.client_class()
+        librarian.login(username=self.librarian.username, password=self.PASSWORD)
+        renew_url = reverse('renew-book', args=[self.copy.pk])
+        librarian.get(renew_url)
+        with CaptureQueriesContext(connection) as queries:
+            librarian.get(renew_url)
+        query_count = len(queries)
+
+        for _ in range(10):
+            self.crawl(20)
+            with mock.patch('catalog.middleware.cache') as throttle_cache, self.assertNumQueries(query_count):
+                resp = librarian.get(renew_url)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(throttle_cache.mock_calls, [])
+
+    def test_throttle_check_takes_two_cache_operations(self):
+        middleware = ThrottleMiddleware(lambda request: None)
+        request = RequestFactory().get(reverse('books'))
+        request.resolver_match = resolve(reverse('books'))
+        request.user = self.librarian
+        middleware.process_view(request, None, (), {})
+
+        with mock.patch('catalog.middleware.cache', wraps=cache) as throttle_cache:
+            for _ in range(5):
+                self.assertIsNone(middleware.process_view(request, None, (), {}))
+        self.assertEqual([name for name, args, kwargs in throttle_cache.mock_calls], ['incr', 'get'] * 5)
+
+    @override_settings(THROTTLE_PROXY_COUNT=1)
+    def test_client_behind_proxy_is_told_apart_by_forwarded_address(self):
+        self.crawl(5, HTTP_X_FORWARDED_FOR='203.0.113.1')
+        self.assertEqual(self.crawl(1, HTTP_X_FORWARDED_FOR='203.0.113.1'), [429])
+        self.assertEqual(self.crawl(1, HTTP_X_FORWARDED_FOR='203.0.113.2'), [200])
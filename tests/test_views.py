@@ -1,12 +1,29 @@
 import datetime
+import os
+import re
+import tempfile
+import time
 import uuid
+from io import StringIO
+from unittest import mock
 
 from django.contrib.auth.models import User, Permission
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, connections
+from django.db.models import F
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
 
-from catalog.models import Author, Genre, Language, Book, BookInstance
+from catalog.models import (Author, Genre, Language, Book, BookInstance, BookLoanStat, BookRecommendation, Branch,
+                            DeletionJob, Loan, RecommendationBuild, StalePage)
+from catalog import caching, deletion, facets, routers, snapshot
+from catalog.caching import bump_version, get_version
+from catalog.routers import BranchRouter
+from catalog.forms import VersionedModelForm
+from catalog.views import BookDetailView
 
 
 class AuthorListViewTest(TestCase):
@@ -61,6 +78,119 @@ def create_book():
     return book
 
 
+class BookListViewTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.fantasy = Genre.objects.create(name='Fantasy')
+        cls.poetry = Genre.objects.create(name='Poetry')
+        cls.english = Language.objects.create(name='English')
+        cls.french = Language.objects.create(name='French')
+
+        # 12 English fantasy books, 3 of them also poetry; 4 French poetry books
+        for book_num in range(16):
+            language = cls.english if book_num < 12 else cls.french
+            book = Book.objects.create(title=f'Book {book_num}', summary='Summary', isbn='ABCDEFG',
+                                       language=language)
+            if book_num < 12:
+                book.genre.add(cls.fantasy)
+            if book_num >= 9:
+                book.genre.add(cls.poetry)
+            BookInstance.objects.create(book=book, imprint='2016', status='a' if book_num % 2 else 'm')
+
+    def setUp(self):
+        # Facet counts cached by other tests may describe rolled back data
+        cache.clear()
+
+    def facet_counts(self, resp):
+        return {name: [(value['label'], value['count']) for value in values]
+                for name, values in resp.context['facets']}
+
+    def test_lists_all_books_with_facet_counts(self):
+        resp = self.client.get(reverse('books'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.context['paginator'].count, 16)
+        self.assertEqual(self.facet_counts(resp), {
+            'Genre': [('Fantasy', 12), ('Poetry', 7)],
+            'Language': [('English', 12), ('French', 4)],
+            'Availability': [('Available', 8)],
+        })
+
+    def test_filters_by_genre_and_language(self):
+        resp = self.client.get(reverse('books'), {'genre': self.poetry.pk, 'language': self.english.pk})
+        self.assertEqual(resp.context['paginator'].count, 3)
+        self.assertEqual(self.facet_counts(resp)['Genre'], [('Fantasy', 3), ('Poetry', 3)])
+
+    def test_filters_by_availability(self):
+        resp = self.client.get(reverse('books'), {'available': '1'})
+        self.assertEqual(resp.context['paginator'].count, 8)
+        for book in resp.context['book_list']:
+            self.assertTrue(book.bookinstance_set.filter(status__exact='a').exists())
+
+    def test_pagination_keeps_filters(self):
+        resp = self.client.get(reverse('books'), {'genre': self.fantasy.pk})
+        self.assertTrue(resp.context['is_paginated'])
+        self.assertContains(resp, f'?genre={self.fantasy.pk}&amp;page=2')
+
+    def test_facet_counts_are_cached_until_data_changes(self):
+        self.client.get(reverse('books'))
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('books'))
+        self.assertFalse(any('catalog_book_genre' in query['sql'] for query in queries))
+
+        Book.objects.create(title='New book', summary='Summary', isbn='ABCDEFG', language=self.french)
+        resp = self.client.get(reverse('books'))
+        self.assertEqual(self.facet_counts(resp)['Language'], [('English', 12), ('French', 5)])
+
+    def test_only_availability_changes_reload_available_books(self):
+        self.client.get(reverse('books'))
+        version = get_version(facets.AVAILABILITY_NAMESPACE)
+        copy = BookInstance.objects.filter(status='m').first()
+        copy.status = 'r'
+        copy.save()
+        self.assertEqual(get_version(facets.AVAILABILITY_NAMESPACE), version)
+
+        catalog_version = get_version(facets.CACHE_NAMESPACE)
+        copy = BookInstance.objects.filter(status='a').first()
+        copy.status = 'o'
+        copy.save()
+        self.assertNotEqual(get_version(facets.AVAILABILITY_NAMESPACE), version)
+        self.assertEqual(get_version(facets.CACHE_NAMESPACE), catalog_version)
+        resp = self.client.get(reverse('books'))
+        self.assertEqual(self.facet_counts(resp)['Availability'], [('Available', 7)])
+
+    def test_only_changes_to_facets_reload_the_index(self):
+        version = get_version(facets.CACHE_NAMESPACE)
+        book = Book.objects.get(title='Book 0')
+        book.title = 'Book zero'
+        book.save()
+        book.genre.add(self.fantasy)
+        self.assertEqual(get_version(facets.CACHE_NAMESPACE), version)
+
+        book.genre.add(self.poetry)
+        self.assertNotEqual(get_version(facets.CACHE_NAMESPACE), version)
+        version = get_version(facets.CACHE_NAMESPACE)
+        book.language = self.french
+        book.save()
+        self.assertNotEqual(get_version(facets.CACHE_NAMESPACE), version)
+        resp = self.client.get(reverse('books'))
+        self.assertEqual(self.facet_counts(resp), {
+            'Genre': [('Fantasy', 12), ('Poetry', 8)],
+            'Language': [('English', 11), ('French', 5)],
+            'Availability': [('Available', 8)],
+        })
+
+    def test_malformed_filters_are_ignored(self):
+        resp = self.client.get(reverse('books'), {'genre': '\u00b2'})
+        self.assertEqual(resp.context['paginator'].count, 16)
+
+    def test_benchmark_counts_a_scratch_catalog(self):
+        out = StringIO()
+        call_command('benchmark_facets', '--books', '200', '--repeat', '1', stdout=out)
+        self.assertIn('Populated 200 books', out.getvalue())
+        self.assertIn('genre + language + available', out.getvalue())
+
+
 class LoanedBooksByUserListViewTest(TestCase):
     PASSWORD = '12345'
 
@@ -196,10 +326,36 @@ class RenewBookViewTest(TestCase):
         self.assertEqual(resp.status_code, 200)
 
     def test_404_for_invalid_book_if_logged_in(self):
-        fake_uuid = uuid.uuid4()
         self.client.login(username=self.user2.username, password=self.PASSWORD)
 
-        resp = self.client.get(reverse('renew-book', args=[fake_uuid]))
+        resp = self.client.get(reverse('renew-book', args=[self.copy2.pk + 1]))
+        self.assertEqual(resp.status_code, 404)
+
+    def test_404_for_mistyped_copy_code(self):
+        self.client.login(username=self.user2.username, password=self.PASSWORD)
+        code = self.copy1.code
+        mistyped = code[:-2] + ('1' if code[-2] != '1' else '2') + code[-1]
+
+        resp = self.client.get(f'/catalog/book/{mistyped}/renew/')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_copy_code_in_url(self):
+        self.client.login(username=self.user2.username, password=self.PASSWORD)
+        url = reverse('renew-book', args=[self.copy1.pk])
+        self.assertEqual(url, f'/catalog/book/{self.copy1.code}/renew/')
+
+        resp = self.client.get(url.lower())
+        self.assertEqual(resp.context['bookinst'], self.copy1)
+
+    def test_old_uuid_links_redirect_to_copy_code(self):
+        self.copy1.uuid = uuid.uuid4()
+        self.copy1.save()
+        self.client.login(username=self.user2.username, password=self.PASSWORD)
+
+        resp = self.client.get(f'/catalog/book/{self.copy1.uuid}/renew/')
+        self.assertRedirects(resp, reverse('renew-book', args=[self.copy1.pk]), status_code=301)
+
+        resp = self.client.get(f'/catalog/book/{uuid.uuid4()}/renew/')
         self.assertEqual(resp.status_code, 404)
 
     def test_uses_correct_template(self):
@@ -226,6 +382,22 @@ class RenewBookViewTest(TestCase):
                                 {'renewal_date': valid_date})
         self.assertRedirects(resp, reverse('all-borrowed'))
 
+    def test_stale_renewal_shows_conflict(self):
+        self.client.login(username=self.user2.username, password=self.PASSWORD)
+
+        # Another librarian renews the copy after the form was displayed
+        other_date = datetime.date.today() + datetime.timedelta(weeks=1)
+        copy = BookInstance.objects.get(pk=self.copy1.pk)
+        copy.due_back = other_date
+        copy.save()
+
+        valid_date = datetime.date.today() + datetime.timedelta(weeks=2)
+        resp = self.client.post(reverse('renew-book', args=[self.copy1.pk]),
+                                {'renewal_date': valid_date, 'loaded_version': 0})
+        self.assertEqual(resp.status_code, 409)
+        self.assertEqual(resp.context['bookinst'].due_back, other_date)
+        self.assertEqual(BookInstance.objects.get(pk=self.copy1.pk).due_back, other_date)
+
     def test_form_invalid_renewal_date_past(self):
         self.client.login(username=self.user2.username, password=self.PASSWORD)
 
@@ -247,6 +419,87 @@ class RenewBookViewTest(TestCase):
                              'Invalid date - renewal cannot exceed 4 weeks')
 
 
+class AuthorUpdateViewTest(TestCase):
+    PASSWORD = '12345'
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password=self.PASSWORD)
+        self.user.user_permissions.add(Permission.objects.get(codename='change_author'))
+        self.author = Author.objects.create(first_name='John', last_name='Smith')
+        self.client.login(username=self.user.username, password=self.PASSWORD)
+
+    def post(self, **data):
+        return self.client.post(reverse('author_update', args=[self.author.pk]), {
+            'first_name': 'John',
+            'last_name': 'Smith',
+            'date_of_birth': '',
+            'date_of_death': '',
+            **data,
+        })
+
+    def test_form_carries_the_version(self):
+        resp = self.client.get(reverse('author_update', args=[self.author.pk]))
+        self.assertEqual(resp.context['form'].initial['loaded_version'], 0)
+
+    def test_saves_up_to_date_submission(self):
+        resp = self.post(first_name='Jack', loaded_version=0)
+        self.assertRedirects(resp, self.author.get_absolute_url())
+        self.author.refresh_from_db()
+        self.assertEqual((self.author.first_name, self.author.version), ('Jack', 1))
+
+    def test_stale_submission_shows_conflict(self):
+        # Someone else renames the author after the form was displayed
+        author = Author.objects.get(pk=self.author.pk)
+        author.last_name = 'Smythe'
+        author.save()
+
+        resp = self.post(first_name='Jack', loaded_version=0)
+        self.assertEqual(resp.status_code, 409)
+        self.assertIn('changed by someone else', str(resp.context['form'].non_field_errors()))
+        self.assertIn(('Last name', 'Smythe'), resp.context['conflict_values'])
+        self.author.refresh_from_db()
+        self.assertEqual((self.author.first_name, self.author.last_name), ('John', 'Smythe'))
+
+        # Submitting the form again knowingly replaces the latest values
+        self.assertEqual(resp.context['form']['loaded_version'].value(), 1)
+        resp = self.post(first_name='Jack', loaded_version=1)
+        self.assertRedirects(resp, self.author.get_absolute_url())
+        self.author.refresh_from_db()
+        self.assertEqual((self.author.first_name, self.author.last_name), ('Jack', 'Smith'))
+
+
+class VersionedAdminTest(TestCase):
+    PASSWORD = '12345'
+
+    def setUp(self):
+        self.librarian = User.objects.create_superuser(username='librarian', email='librarian@example.com',
+                                                       password=self.PASSWORD)
+        self.author = Author.objects.create(first_name='John', last_name='Smith')
+        self.client.login(username=self.librarian.username, password=self.PASSWORD)
+
+    def test_record_changed_while_saving_is_reported(self):
+        clean = VersionedModelForm.clean
+
+        def clean_then_rename(form):
+            # Someone else renames the author after the form was checked, just before it is saved
+            cleaned_data = clean(form)
+            Author.objects.filter(pk=self.author.pk).update(last_name='Smythe', version=F('version') + 1)
+            return cleaned_data
+
+        url = reverse('admin:catalog_author_change', args=[self.author.pk])
+        with mock.patch.object(VersionedModelForm, 'clean', autospec=True, side_effect=clean_then_rename):
+            resp = self.client.post(url, {
+                'first_name': 'Jack', 'last_name': 'Smith', 'date_of_birth': '', 'date_of_death': '',
+                'loaded_version': 0, 'book_set-TOTAL_FORMS': 0, 'book_set-INITIAL_FORMS': 0,
+            }, follow=True)
+
+        self.assertRedirects(resp, url)
+        self.assertContains(resp, 'changed by someone else')
+        # The librarian's edit was not written
+        self.author.refresh_from_db()
+        self.assertEqual(self.author.first_name, 'John')
+
+
 class AuthorCreateViewTest(TestCase):
     PASSWORD = '12345'
 
@@ -295,3 +548,394 @@ class AuthorCreateViewTest(TestCase):
             'date_of_death': '',
         })
         self.assertRedirects(resp, '/catalog/author/1')
+
+
+class CirculationDashboardViewTest(TestCase):
+    PASSWORD = '12345'
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser1', password=self.PASSWORD)
+        self.librarian = User.objects.create_user(username='testuser2', password=self.PASSWORD)
+        permission = Permission.objects.get(codename='can_mark_returned')
+        self.librarian.user_permissions.add(permission)
+
+        # Loan three copies of a book, one of them already overdue
+        self.book = create_book()
+        self.copies = [BookInstance.objects.create(book=self.book, imprint='2016', status='a')
+                       for _ in range(3)]
+        for days, copy in zip((-1, 5, 5), self.copies):
+            copy.status = 'o'
+            copy.borrower = self.user
+            copy.due_back = datetime.date.today() + datetime.timedelta(days=days)
+            copy.save()
+
+    def test_redirect_if_logged_in_but_incorrect_permission(self):
+        self.client.login(username=self.user.username, password=self.PASSWORD)
+        resp = self.client.get(reverse('circulation-dashboard'))
+        self.assertEqual(resp.status_code, 403)
+
+    def test_uses_correct_template(self):
+        self.client.login(username=self.librarian.username, password=self.PASSWORD)
+        resp = self.client.get(reverse('circulation-dashboard'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertTemplateUsed(resp, 'catalog/circulation_dashboard.html')
+
+    def test_shows_refreshed_statistics(self):
+        # Return one of the copies, then fold everything into the aggregates
+        self.copies[2].status = 'a'
+        self.copies[2].save()
+        call_command('refresh_circulation_stats', stdout=StringIO())
+
+        self.client.login(username=self.librarian.username, password=self.PASSWORD)
+        resp = self.client.get(reverse('circulation-dashboard'))
+        summary = resp.context['summary']
+        self.assertEqual(summary.on_loan, 2)
+        self.assertEqual(summary.overdue, 1)
+        self.assertEqual(summary.returned_loans, 1)
+        self.assertEqual(summary.average_loan_days, 0)
+        self.assertEqual([(stat.book, stat.loans) for stat in resp.context['top_books']], [(self.book, 3)])
+        self.assertEqual([stat.loans for stat in resp.context['top_genres']], [3])
+
+    def test_refresh_is_incremental(self):
+        call_command('refresh_circulation_stats', stdout=StringIO())
+        call_command('refresh_circulation_stats', stdout=StringIO())
+        self.assertEqual(BookLoanStat.objects.get(book=self.book).loans, 3)
+
+        self.copies[0].status = 'a'
+        self.copies[0].save()
+        self.copies[0].status = 'o'
+        self.copies[0].save()
+        call_command('refresh_circulation_stats', stdout=StringIO())
+        self.assertEqual(BookLoanStat.objects.get(book=self.book).loans, 4)
+
+    def test_refresh_counts_loans_committed_out_of_order(self):
+        Loan.objects.create(id=1000, book=self.book, borrower=self.user)
+        call_command('refresh_circulation_stats', stdout=StringIO())
+        self.assertEqual(BookLoanStat.objects.get(book=self.book).loans, 4)
+
+        # A loan given a lower id, whose transaction only committed after the refresh
+        Loan.objects.create(id=900, book=self.book, borrower=self.user)
+        call_command('refresh_circulation_stats', stdout=StringIO())
+        self.assertEqual(BookLoanStat.objects.get(book=self.book).loans, 5)
+
+    def test_query_count_does_not_grow_with_history(self):
+        call_command('refresh_circulation_stats', stdout=StringIO())
+        self.client.login(username=self.librarian.username, password=self.PASSWORD)
+        self.client.get(reverse('circulation-dashboard'))
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('circulation-dashboard'))
+
+        for _ in range(20):
+            copy = BookInstance.objects.create(book=create_book(), imprint='2016', status='a')
+            copy.status = 'o'
+            copy.save()
+        call_command('refresh_circulation_stats', stdout=StringIO())
+        self.assertNumQueries(len(queries), self.client.get, reverse('circulation-dashboard'))
+
+
+class DeferredDeleteViewTest(TestCase):
+    PASSWORD = '12345'
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser1', password=self.PASSWORD)
+        for codename in ('delete_author', 'delete_book'):
+            self.user.user_permissions.add(Permission.objects.get(codename=codename))
+        self.client.login(username=self.user.username, password=self.PASSWORD)
+
+        self.book = create_book()
+        self.author = self.book.author
+        for _ in range(5):
+            BookInstance.objects.create(book=self.book, imprint='2016', status='a')
+
+    def test_delete_book_hides_it_immediately(self):
+        resp = self.client.post(reverse('book_delete', args=[self.book.pk]))
+        self.assertRedirects(resp, reverse('books'))
+
+        self.assertFalse(Book.objects.filter(pk=self.book.pk).exists())
+        self.assertTrue(Book.all_objects.filter(pk=self.book.pk).exists())
+        self.assertEqual(BookInstance.objects.filter(book=self.book).count(), 5)
+        self.assertEqual(self.client.get(reverse('book-detail', args=[self.book.pk])).status_code, 404)
+
+        job = DeletionJob.objects.get()
+        self.assertEqual((job.model, job.object_id, job.total), ('book', self.book.pk, 5))
+
+    def test_process_deletions_removes_book_in_batches(self):
+        self.client.post(reverse('book_delete', args=[self.book.pk]))
+        out = StringIO()
+        call_command('process_deletions', '--batch-size', '2', stdout=out)
+
+        self.assertFalse(Book.all_objects.filter(pk=self.book.pk).exists())
+        self.assertEqual(BookInstance.objects.filter(book__isnull=True).count(), 5)
+        job = DeletionJob.objects.get()
+        self.assertEqual(job.processed, 5)
+        self.assertEqual(job.progress, 1)
+        self.assertIn('4/5 dependent rows processed', out.getvalue())
+
+    def test_process_deletions_resumes_interrupted_job(self):
+        self.client.post(reverse('author_delete', args=[self.author.pk]))
+        job = DeletionJob.objects.get()
+
+        # Simulate a crash after part of the dependent rows were processed
+        Book.all_objects.filter(author=self.author).update(author=None)
+        call_command('process_deletions', stdout=StringIO())
+
+        self.assertFalse(Author.all_objects.filter(pk=self.author.pk).exists())
+        self.assertTrue(Book.objects.filter(pk=self.book.pk, author__isnull=True).exists())
+        job.refresh_from_db()
+        self.assertIsNotNone(job.finished_at)
+
+    def test_process_deletions_invalidates_caches_and_pages(self):
+        other_book = Book.objects.create(title='Other Book', summary='Summary', isbn='ABCDEFG', author=self.author)
+        self.client.post(reverse('author_delete', args=[self.author.pk]))
+        namespaces = (facets.CACHE_NAMESPACE, snapshot.CACHE_NAMESPACE)
+        versions = {namespace: get_version(namespace) for namespace in namespaces}
+
+        with tempfile.TemporaryDirectory() as root, override_settings(PRERENDER_ROOT=root):
+            call_command('process_deletions', '--batch-size', '1', stdout=StringIO())
+
+        for namespace, version in versions.items():
+            self.assertGreater(get_version(namespace), version)
+        # The books were taken off the author before the author's own pages were marked
+        self.assertTrue({reverse('author-detail', args=[self.author.pk]), reverse('authors'), reverse('books'),
+                         reverse('book-detail', args=[self.book.pk]), reverse('book-detail', args=[other_book.pk])}
+                        .issubset(StalePage.objects.values_list('path', flat=True)))
+
+
+class BranchViewsTest(TestCase):
+    PASSWORD = '12345'
+
+    def setUp(self):
+        self.librarian = User.objects.create_user(username='testuser1', password=self.PASSWORD)
+        self.librarian.user_permissions.add(Permission.objects.get(codename='can_mark_returned'))
+        self.client.login(username=self.librarian.username, password=self.PASSWORD)
+
+        self.north = Branch.objects.create(name='North', slug='north')
+        self.south = Branch.objects.create(name='South', slug='south')
+        self.book = create_book()
+        due_date = datetime.date.today() + datetime.timedelta(days=5)
+        self.north_copy = BookInstance.objects.create(book=self.book, imprint='2016', branch=self.north,
+                                                      status='o', due_back=due_date, borrower=self.librarian)
+        BookInstance.objects.create(book=self.book, imprint='2016', branch=self.south,
+                                    status='o', due_back=due_date, borrower=self.librarian)
+        BookInstance.objects.create(book=self.book, imprint='2016', branch=self.south, status='a')
+
+    def test_branch_list_shows_only_branch_loans(self):
+        resp = self.client.get(reverse('branch-borrowed', args=['north']))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(list(resp.context['bookinstance_list']), [self.north_copy])
+        self.assertContains(resp, reverse('branch-renew-book', args=['north', self.north_copy.pk]))
+
+    def test_unknown_branch_is_404(self):
+        resp = self.client.get(reverse('branch-borrowed', args=['east']))
+        self.assertEqual(resp.status_code, 404)
+
+    def test_branch_renewal_redirects_to_branch_list(self):
+        valid_date = datetime.date.today() + datetime.timedelta(weeks=2)
+        resp = self.client.post(reverse('branch-renew-book', args=['north', self.north_copy.pk]),
+                                {'renewal_date': valid_date})
+        self.assertRedirects(resp, reverse('branch-borrowed', args=['north']))
+
+    def test_renewal_from_other_branch_is_404(self):
+        resp = self.client.get(reverse('branch-renew-book', args=['south', self.north_copy.pk]))
+        self.assertEqual(resp.status_code, 404)
+
+    def test_book_detail_shows_availability_per_branch(self):
+        resp = self.client.get(reverse('book-detail', args=[self.book.pk]))
+        self.assertEqual(resp.context['branch_availability'], [(self.north, 0), (self.south, 1)])
+
+    def test_router_sends_new_copies_to_branch_database(self):
+        self.north.database = 'north'
+        self.north.save()
+        copy = BookInstance(book=self.book, imprint='2016', branch=self.north)
+        self.assertEqual(BranchRouter().db_for_write(BookInstance, instance=copy), 'north')
+        self.assertEqual(BranchRouter().db_for_read(Book, instance=copy), 'default')
+
+
+class BranchDatabaseTest(TestCase):
+    """Copies of the North branch are stored in a second database"""
+    multi_db = True
+    PASSWORD = '12345'
+
+    def setUp(self):
+        self.librarian = User.objects.create_superuser(username='librarian', email='librarian@example.com',
+                                                       password=self.PASSWORD)
+        self.client.login(username=self.librarian.username, password=self.PASSWORD)
+
+        self.north = Branch.objects.create(name='North', slug='north', database='test_branch')
+        self.south = Branch.objects.create(name='South', slug='south')
+        self.book = create_book()
+        today = datetime.date.today()
+        self.north_loan = BookInstance.objects.create(book=self.book, imprint='2016', branch=self.north, status='o',
+                                                      due_back=today + datetime.timedelta(days=3),
+                                                      borrower=self.librarian)
+        self.south_loan = BookInstance.objects.create(book=self.book, imprint='2016', branch=self.south, status='o',
+                                                      due_back=today + datetime.timedelta(days=5),
+                                                      borrower=self.librarian)
+        self.north_copy = BookInstance.objects.create(book=self.book, imprint='2016', branch=self.north, status='a')
+
+    def test_copies_are_stored_in_the_branch_database(self):
+        self.assertEqual(set(BookInstance.objects.using('test_branch').values_list('pk', flat=True)),
+                         {self.north_loan.pk, self.north_copy.pk})
+        self.assertEqual(list(BookInstance.objects.values_list('pk', flat=True)), [self.south_loan.pk])
+
+    def test_loan_lists_include_every_database(self):
+        resp = self.client.get(reverse('all-borrowed'))
+        self.assertEqual(list(resp.context['bookinstance_list']), [self.north_loan, self.south_loan])
+        resp = self.client.get(reverse('my-borrowed'))
+        self.assertEqual(list(resp.context['bookinstance_list']), [self.north_loan, self.south_loan])
+
+    def test_loan_list_pages_read_only_the_start_of_each_database(self):
+        today = datetime.date.today()
+        for days in range(10, 22):
+            BookInstance.objects.create(book=self.book, imprint='2016', branch=(self.north, self.south)[days % 2],
+                                        status='o', due_back=today + datetime.timedelta(days=days),
+                                        borrower=self.librarian)
+
+        with CaptureQueriesContext(connections['test_branch']) as queries:
+            resp = self.client.get(reverse('all-borrowed'), {'page': 2})
+        self.assertEqual([copy.due_back for copy in resp.context['bookinstance_list']],
+                         [today + datetime.timedelta(days=days) for days in range(18, 22)])
+        copy_queries = [query['sql'] for query in queries if not query['sql'].startswith('SELECT COUNT')]
+        self.assertEqual(len(copy_queries), 1)
+        self.assertIn('LIMIT 14', copy_queries[0])
+
+    def test_catalog_pages_include_every_database(self):
+        resp = self.client.get(reverse('index'))
+        self.assertEqual((resp.context['num_instances'], resp.context['num_instances_available']), (3, 1))
+        resp = self.client.get(reverse('book-detail', args=[self.book.pk]))
+        self.assertEqual(list(resp.context['copies']), [self.north_copy, self.north_loan, self.south_loan])
+        resp = self.client.get(reverse('author-detail', args=[self.book.author_id]))
+        self.assertEqual(resp.context['books'][0].copy_count, 3)
+        # The only available copy is in the branch database
+        resp = self.client.get(reverse('books'), {'available': 1})
+        self.assertEqual(list(resp.context['book_list']), [self.book])
+        self.assertEqual(resp.context['facets'][2][1][0]['count'], 1)
+
+    def test_available_books_are_read_a_page_at_a_time(self):
+        for number in range(12):
+            book = Book.objects.create(title=f'Book {number}', summary='Summary', isbn='ABCDEFG')
+            BookInstance.objects.create(book=book, imprint='2016', branch=self.north, status='a')
+
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.client.get(reverse('books'), {'available': 1})
+        self.assertEqual(resp.context['paginator'].count, 13)
+        self.assertEqual(len(resp.context['book_list']), 10)
+        # Only the ids of the page are sent to the database, however many books are available
+        id_lists = [re.findall(r'IN \(([^)]*)\)', query['sql']) for query in queries
+                    if query['sql'].startswith('SELECT "catalog_book"."id"')]
+        self.assertEqual([len(ids.split(',')) for ids in sum(id_lists, [])], [10])
+
+    def test_renewal_finds_copy_in_branch_database(self):
+        valid_date = datetime.date.today() + datetime.timedelta(weeks=2)
+        resp = self.client.post(reverse('renew-book', args=[self.north_loan.pk]), {'renewal_date': valid_date})
+        self.assertRedirects(resp, reverse('all-borrowed'))
+        self.assertEqual(BookInstance.objects.using('test_branch').get(pk=self.north_loan.pk).due_back, valid_date)
+
+    def test_admin_lists_and_edits_copies_of_each_database(self):
+        resp = self.client.get(reverse('admin:catalog_bookinstance_changelist'), {'database': 'test_branch'})
+        self.assertEqual(set(resp.context['cl'].result_list), {self.north_loan, self.north_copy})
+        resp = self.client.get(reverse('admin:catalog_bookinstance_change', args=[self.north_copy.pk]))
+        self.assertEqual(resp.context['original'], self.north_copy)
+
+    def test_deletion_clears_copies_in_branch_database(self):
+        deletion.run(deletion.schedule(self.book))
+        self.assertEqual(list(BookInstance.objects.using('test_branch').values_list('book', flat=True)), [None, None])
+
+    def test_snapshot_includes_copies_in_branch_database(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'catalog.snapshot')
+            snapshot.build(filename)
+            book = snapshot.Snapshot(filename).book(self.book.pk)
+            self.assertEqual([copy.pk for copy in book.bookinstance_set.all()],
+                             [self.north_copy.pk, self.north_loan.pk, self.south_loan.pk])
+
+    def test_branch_changed_by_another_worker_is_routed_to_its_new_database(self):
+        self.assertEqual(routers.branch_database(self.north.pk), 'test_branch')
+        # Another worker moves the branch: its signal bumps the shared version, but not this worker's cache
+        Branch.objects.filter(pk=self.north.pk).update(database='default')
+        bump_version(routers.CACHE_NAMESPACE)
+        self.assertEqual(routers.branch_database(self.north.pk), 'default')
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_branch_databases_expire_when_the_cache_is_not_shared(self):
+        self.assertEqual(routers.branch_database(self.north.pk), 'test_branch')
+        # Another worker moves the branch, but cannot bump this worker's version
+        Branch.objects.filter(pk=self.north.pk).update(database='default')
+        self.assertEqual(routers.branch_database(self.north.pk), 'test_branch')
+        later = time.monotonic() + caching.UNSHARED_TIMEOUT + 1
+        with mock.patch('time.monotonic', return_value=later):
+            self.assertEqual(routers.branch_database(self.north.pk), 'default')
+
+
+class BookRecommendationTest(TestCase):
+
+    def setUp(self):
+        self.users = [User.objects.create_user(username=f'testuser{user_num}') for user_num in range(3)]
+        self.books = [Book.objects.create(title=f'Book {book_num}', summary='Summary', isbn='ABCDEFG')
+                      for book_num in range(4)]
+        self.copies = [BookInstance.objects.create(book=book, imprint='2016', status='a') for book in self.books]
+
+        # Books 0 and 1 are borrowed together twice, books 0 and 2 once; nobody borrows book 3
+        for user, book_nums in zip(self.users, ((0, 1), (0, 1, 2), (2,))):
+            for book_num in book_nums:
+                self.lend(book_num, user)
+
+    def lend(self, book_num, user):
+        copy = self.copies[book_num]
+        copy.status, copy.borrower = 'o', user
+        copy.save()
+        copy.status, copy.borrower = 'a', None
+        copy.save()
+
+    def recommended(self, book_num):
+        resp = self.client.get(reverse('book-detail', args=[self.books[book_num].pk]))
+        return [recommendation.recommended for recommendation in resp.context['recommendations']]
+
+    def test_recommends_books_with_shared_borrowers(self):
+        call_command('build_recommendations', stdout=StringIO())
+        self.assertEqual(self.recommended(0), [self.books[1], self.books[2]])
+        self.assertEqual(self.recommended(1), [self.books[0], self.books[2]])
+        self.assertEqual(self.recommended(3), [])
+
+        build = RecommendationBuild.objects.get()
+        self.assertEqual((build.full, build.loans, build.books), (True, 6, 3))
+
+    def test_incremental_build_only_updates_affected_books(self):
+        call_command('build_recommendations', stdout=StringIO())
+        self.lend(3, self.users[2])
+        call_command('build_recommendations', stdout=StringIO())
+
+        self.assertEqual(self.recommended(3), [self.books[2]])
+        self.assertEqual(self.recommended(2)[0], self.books[3])
+        build = RecommendationBuild.objects.first()
+        self.assertEqual((build.full, build.books), (False, 2))
+
+    def test_incremental_build_includes_loans_committed_out_of_order(self):
+        Loan.objects.create(id=1000, book=self.books[3], borrower=self.users[0])
+        call_command('build_recommendations', stdout=StringIO())
+
+        # A loan given a lower id, whose transaction only committed after the build
+        Loan.objects.create(id=900, book=self.books[3], borrower=self.users[2])
+        call_command('build_recommendations', stdout=StringIO())
+        self.assertIn(self.books[3], self.recommended(2))
+
+    def test_incremental_build_updates_scores_of_neighbours(self):
+        def stored():
+            return list(BookRecommendation.objects.order_by('book', 'rank')
+                        .values_list('book', 'recommended', 'score'))
+
+        call_command('build_recommendations', stdout=StringIO())
+        # A new borrower of book 1 changes its score with book 0, which they did not borrow
+        self.lend(1, User.objects.create_user(username='newuser'))
+        call_command('build_recommendations', stdout=StringIO())
+        incremental = stored()
+        self.assertEqual(RecommendationBuild.objects.first().books, 3)
+
+        call_command('build_recommendations', '--full', stdout=StringIO())
+        self.assertEqual(incremental, stored())
+
+    def test_recommendations_are_read_in_one_query(self):
+        call_command('build_recommendations', stdout=StringIO())
+        view = BookDetailView(object=self.books[0], kwargs={})
+        context = view.get_context_data()
+        self.assertNumQueries(1, list, context['recommendations'])